@@ -1,7 +1,10 @@
 
 import os
 from nydus.common import validity
-from nydus.common import Config
+from nydus.common.Config import Config
+from nydus.common.AllocStore import ALLOC_BACKENDS
+from nydus.common.AllocPolicy import ALLOC_POLICIES, DEFAULT_ALLOC_POLICY
+from nydus.server.AllocPools import AllocPools
 
 # Remember this needs to be the same as the server config file
 CLI_CONFIG_FILE = "/etc/nydus-launcher/server.conf"
@@ -11,11 +14,31 @@ PORT = "Port"
 CERTFILE = "CertFile"
 CERTPRIVKEY = "CertPrivKey"
 MCVERSION = "McVersion"
-MSALCID = "MSALClientID"
+MSALCID = "MSALClientId"
 ALLOCFILE = "AllocFile"
 ACCOUNTSFILE = "AccountsFile"
+SERVERMODE = "ServerMode"
+MAXEXCHANGES = "MaxExchanges"
+LISTENBACKLOG = "ListenBacklog"
+HANDSHAKETIMEOUT = "HandshakeTimeout"
+WORKERS = "Workers"
+CONTROLSOCKET = "ControlSocket"
+SESSIONTIMEOUT = "SessionTimeout"
+LEASETIME = "LeaseTime"
+CLIENTRATE = "ClientRate"
+CLIENTBURST = "ClientBurst"
+MAXINFLIGHT = "MaxInFlight"
+RETRYWINDOW = "RetryWindow"
+ALLOCBACKEND = "AllocBackend"
+ALLOCPOLICY = "AllocPolicy"
+COMMITWINDOW = "CommitWindow"
+REPLICATIONROLE = "ReplicationRole"
+REPLICATIONPORT = "ReplicationPort"
+PRIMARYIPADDR = "PrimaryIpAddr"
+REPLICATIONCACHAIN = "ReplicationCaChain"
+POOLSFILE = "PoolsFile"
 
-SERVER_PARNAMES = [
+CLI_PARNAMES = [
     IPADDR, 
     PORT,
     CERTFILE,
@@ -24,6 +47,26 @@ SERVER_PARNAMES = [
     MSALCID,
     ALLOCFILE,
     ACCOUNTSFILE,
+    SERVERMODE,
+    MAXEXCHANGES,
+    LISTENBACKLOG,
+    HANDSHAKETIMEOUT,
+    WORKERS,
+    CONTROLSOCKET,
+    SESSIONTIMEOUT,
+    LEASETIME,
+    CLIENTRATE,
+    CLIENTBURST,
+    MAXINFLIGHT,
+    RETRYWINDOW,
+    ALLOCBACKEND,
+    ALLOCPOLICY,
+    COMMITWINDOW,
+    REPLICATIONROLE,
+    REPLICATIONPORT,
+    PRIMARYIPADDR,
+    REPLICATIONCACHAIN,
+    POOLSFILE,
 ]
 
 CLI_DEFCONFIG = {
@@ -35,6 +78,26 @@ CLI_DEFCONFIG = {
     MSALCID: "1ab23456-7890-1c2d-e3fg-45h6789ijk01",
     ALLOCFILE: "nydus-alloc.csv",
     ACCOUNTSFILE: "ms-usernames.txt",
+    SERVERMODE: "threaded",
+    MAXEXCHANGES: "32",
+    LISTENBACKLOG: "128",
+    HANDSHAKETIMEOUT: "5",
+    WORKERS: "1",
+    CONTROLSOCKET: "/run/nydus/nydus-server.sock",
+    SESSIONTIMEOUT: "90",
+    LEASETIME: "120",
+    CLIENTRATE: "30",
+    CLIENTBURST: "5",
+    MAXINFLIGHT: "64",
+    RETRYWINDOW: "10",
+    ALLOCBACKEND: "csv",
+    ALLOCPOLICY: DEFAULT_ALLOC_POLICY,
+    COMMITWINDOW: "0",
+    REPLICATIONROLE: "primary",
+    REPLICATIONPORT: "0",
+    PRIMARYIPADDR: "192.168.1.1",
+    REPLICATIONCACHAIN: "nydus-ca.crt",
+    POOLSFILE: "",
 }
 
 # Maps between the parameter name used in the config file
@@ -47,12 +110,16 @@ CLI_VARNAMES = {
     MSALCID: "msal_cid",
     ALLOCFILE: "alloc_file",
     ACCOUNTSFILE: "accounts_file",
+    CONTROLSOCKET: "control_socket",
+    ALLOCBACKEND: "alloc_backend",
+    ALLOCPOLICY: "alloc_policy",
+    POOLSFILE: "pools_file",
 }
 
 class CliConfig(Config):
 
     def __init__(self, path=CLI_CONFIG_FILE, parnames=CLI_PARNAMES, defconfig=CLI_DEFCONFIG, varnames=CLI_VARNAMES):
-        super().__init(path, parnames, defconfig, varnames)
+        super().__init__(path, parnames, defconfig, varnames)
 
     def validate_config(self):
         if not validity.is_valid_msal_cid(self.msal_cid):
@@ -64,6 +131,18 @@ class CliConfig(Config):
         if not validity.is_valid_file(self.accounts_file):
             raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(ACCOUNTSFILE, self.accounts_file))
 
+        if not self.alloc_backend in ALLOC_BACKENDS:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(ALLOCBACKEND, ", ".join(ALLOC_BACKENDS), self.alloc_backend))
+
+        if not self.alloc_policy in ALLOC_POLICIES:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(ALLOCPOLICY, ", ".join(ALLOC_POLICIES), self.alloc_policy))
+
+        if self.pools_file != "" and not os.path.isfile(self.pools_file):
+            raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(POOLSFILE, self.pools_file))
+
+        # nydus-cli has no use for the Minecraft version
+        self.alloc_pools = AllocPools.read(self.alloc_file, self.accounts_file, None, self.pools_file)
+
     def get_msal_cid(self):
         return self.msal_cid
 
@@ -72,3 +151,19 @@ class CliConfig(Config):
 
     def get_accounts_file(self):
         return self.accounts_file
+
+    def get_control_socket(self):
+        return self.control_socket
+
+    def get_alloc_backend(self):
+        return self.alloc_backend
+
+    def get_alloc_policy(self):
+        return self.alloc_policy
+
+    """
+    The AllocPools read from the pools file, with the
+    default pool made of AllocFile and AccountsFile.
+    """
+    def get_alloc_pools(self):
+        return self.alloc_pools
@@ -1,18 +1,20 @@
 
 import os
 from nydus.common import validity
-from nydus.common import Config
+from nydus.common.Config import Config
 
 CLIENT_CONFIG_FILE = "/etc/nydus-launcher/client.conf"
 
 SERVERIPADDR = "ServerIpAddr"
 PORT = "Port"
 CACHAINFILE = "CaChainFile"
-CLIENT_PARNAMES = [SERVERIPADDR, PORT, CACHAINFILE]
+HEARTBEATINTERVAL = "HeartbeatInterval"
+CLIENT_PARNAMES = [SERVERIPADDR, PORT, CACHAINFILE, HEARTBEATINTERVAL]
 CLIENT_DEFCONFIG = {
     SERVERIPADDR: "192.168.1.1",
     PORT: "2011",
     CACHAINFILE: "nydus-ca.crt",
+    HEARTBEATINTERVAL: "30",
 }
 
 # Maps between the parameter named used in the config file
@@ -21,6 +23,7 @@ CLIENT_VARNAMES = {
     SERVERIPADDR: "server_ip",
     PORT: "port",
     CACHAINFILE: "ca_chain",
+    HEARTBEATINTERVAL: "heartbeat_interval",
 }
 
 class ClientConfig(Config):
@@ -41,11 +44,20 @@ class ClientConfig(Config):
         if not validity.is_valid_file(self.ca_chain):
             raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(CACHAINFILE, self.ca_chain))
 
-        def get_server_ip(self):
-            return self.server_ip
+        if not validity.is_positive_integer(self.heartbeat_interval):
+            raise ValueError("Value for {} is not a positive integer: {}".format(HEARTBEATINTERVAL, self.heartbeat_interval))
 
-        def get_port(self):
-            return self.port
+    def get_server_ip(self):
+        return self.server_ip
 
-        def get_ca_chain(self):
-            return self.ca_chain
+    def get_port(self):
+        return int(self.port)
+
+    def get_ca_chain(self):
+        return self.ca_chain
+
+    """
+    In seconds
+    """
+    def get_heartbeat_interval(self):
+        return int(self.heartbeat_interval)
@@ -7,6 +7,9 @@ from nydus.common import validity
 
 class AccessToken:
 
+    # Four of these per account; slots keep each one small
+    __slots__ = ("token", "expire_time", "tokhash")
+
     """
     token: nonempty string representing some access token
     expire_time: a datetime object, the point at which the token expires
@@ -47,16 +50,16 @@ class AccessToken:
     if the server happens to be down during the final check interval.
     """
     def needs_renewal(self, check_interval, num_intervals=2):
-        if not isintance(check_interval, datetime.timedelta):
+        if not isinstance(check_interval, datetime.timedelta):
             raise TypeError("check_interval for AccessToken.needs_renewal must be a datetime.timedelta. Was given a {}".format(type(check_interval)))
 
-        if not validity.is_positive_integer(num_intervals):
+        if not isinstance(num_intervals, int) or num_intervals <= 0:
             raise ValueError("num_intervals for AccessToken.needs_renewal must be a positive integer. Was {}".format(num_intervals))
 
         if self.is_expired():
             return True
 
-        if datetime.datetime.now() + (2 * check_interval)  > self.get_expiry():
+        if datetime.datetime.now() + (num_intervals * check_interval) > self.get_expiry():
             return True
 
         return False
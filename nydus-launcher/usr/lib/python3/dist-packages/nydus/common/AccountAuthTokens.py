@@ -8,8 +8,11 @@ from nydus.common.MCAccount import MCAccount
 # This class is for keeping all that data in one place for one
 # account.
 
-class AccountAuthTokens
-    
+class AccountAuthTokens:
+
+    # Attributes are fixed, to save a __dict__ per account
+    __slots__ = ("ms_username", "msal_token", "xbl_token", "xsts_token", "mc_token", "mc_account")
+
     """
     ms_username: string, Microsoft account username (email address)
     msal_token: AccessToken from auth to MSAL
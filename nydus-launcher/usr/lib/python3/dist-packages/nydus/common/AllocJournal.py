@@ -0,0 +1,181 @@
+import os
+
+# An append-only log of changes to the account allocation database,
+# kept next to the allocation file. Committing a change (allocating an
+# account, say) appends a line or two here rather than rewriting the
+# whole allocation file, every token of every account included.
+#
+# The allocation file is then a snapshot: the state as it was at some
+# point, which the journal's lines bring up to date when they're
+# replayed over it at startup. Every so often the journal is folded
+# into a new snapshot (compaction) so it doesn't grow forever:
+# 1) rotate: the journal is moved aside to the old journal, and new
+#    changes go to a fresh one
+# 2) the snapshot, taken at the moment of rotating, is written to a
+#    temporary file which is then renamed over the allocation file
+# 3) the old journal is deleted
+# Should nydus-server die partway through, nothing is lost. Before step
+# 2 the old snapshot, old journal and journal together hold everything.
+# After it the old journal is replayed over a snapshot which already
+# includes its changes, which does no harm: each line sets fields to
+# values, rather than changing them relative to what they were.
+#
+# This class only deals in lines. What goes in them is up to
+# the AllocEngine (see the allocater module).
+
+JOURNAL_SUFFIX = ".journal"
+OLD_JOURNAL_SUFFIX = ".journal.old"
+SNAPSHOT_TEMP_SUFFIX = ".tmp"
+
+"""
+Makes a rename or delete of a file in the directory
+holding path survive a power cut.
+"""
+def fsync_dir(path):
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+"""
+Replaces the file at path with one containing text, such that after
+a crash the file holds either all of the old contents or all of the new.
+"""
+def write_atomically(path, text):
+    temp_path = path + SNAPSHOT_TEMP_SUFFIX
+    with open(temp_path, "w") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    fsync_dir(path)
+
+class AllocJournal:
+
+    """
+    alloc_file: path to the account allocation database file
+    whose changes this journal records.
+    Neither journal file is created until something is appended.
+    """
+    def __init__(self, alloc_file):
+        if not isinstance(alloc_file, str):
+            raise TypeError("Path to accounts database file must be a string. Was {}".format(alloc_file))
+
+        self.path = alloc_file + JOURNAL_SUFFIX
+        self.old_path = alloc_file + OLD_JOURNAL_SUFFIX
+
+        # Opened for appending on first use
+        self.file = None
+
+        # Bytes in the journal, not counting the old journal
+        self.size = 0
+
+    """
+    Returns the complete lines of the file at path, without their newlines.
+    A last line without a newline was cut short by a crash while it was
+    being appended, so was never committed; it's left out, and if
+    truncate is True it's removed from the file so the next append
+    doesn't run on from it.
+    """
+    def read_file_lines(path, truncate):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        end = data.rfind(b"\n") + 1
+        if end < len(data) and truncate:
+            with open(path, "r+b") as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+
+        return data[:end].decode().splitlines()
+
+    """
+    Returns every line committed to the journal, oldest first,
+    including those in an old journal left by a compaction which
+    didn't finish.
+    """
+    def read_lines(self):
+        lines = AllocJournal.read_file_lines(self.old_path, False)
+        lines += AllocJournal.read_file_lines(self.path, True)
+        self.find_size()
+        return lines
+
+    """
+    Sets the journal's size from its file, as read_lines
+    does, for when the journal isn't read.
+    """
+    def find_size(self):
+        self.size = os.path.getsize(self.path) if os.path.isfile(self.path) else 0
+
+    """
+    lines: a list of strings, without newlines
+    Appends the lines and doesn't return until they're on disk.
+    They're written with one write, so a commit of several
+    lines costs one fsync.
+    """
+    def append(self, lines):
+        if not lines:
+            return
+
+        if self.file == None:
+            self.file = open(self.path, "a")
+            self.size = self.file.tell()
+
+        text = "".join("{}\n".format(line) for line in lines)
+        self.file.write(text)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.size += len(text.encode())
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
+            self.file = None
+
+    """
+    Step 1 of compaction. Moves the journal aside to the old journal,
+    so appends after this go to a new, empty journal.
+    If an old journal is still there because an earlier compaction
+    didn't finish, the journal is added onto the end of it instead,
+    because nothing in it has reached a snapshot yet.
+    """
+    def rotate(self):
+        self.close()
+        if not os.path.isfile(self.path):
+            return
+
+        if os.path.isfile(self.old_path):
+            lines = AllocJournal.read_file_lines(self.path, False)
+            with open(self.old_path, "a") as f:
+                f.write("".join("{}\n".format(line) for line in lines))
+                f.flush()
+                os.fsync(f.fileno())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.old_path)
+
+        fsync_dir(self.path)
+        self.size = 0
+
+    """
+    Step 3 of compaction, once a snapshot taken
+    at the time of rotate has been written.
+    """
+    def discard_old(self):
+        if os.path.isfile(self.old_path):
+            os.remove(self.old_path)
+            fsync_dir(self.old_path)
+
+    def get_path(self):
+        return self.path
+
+    def get_old_path(self):
+        return self.old_path
+
+    def get_size(self):
+        return self.size
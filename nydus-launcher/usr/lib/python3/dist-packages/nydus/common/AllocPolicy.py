@@ -0,0 +1,182 @@
+import heapq
+
+# Decides which unallocated account the AllocEngine gives out next.
+#
+# Each policy keeps the unallocated accounts in a heap, ordered by a key
+# it works out for each account when the account is queued, so that
+# queueing an account and taking the best one are both O(log n) however
+# many accounts there are. Accounts with equal keys come out in the
+# order they were queued.
+#
+# The engine queues an account whenever it's released (or loaded
+# unallocated), and tells the policy when a queued account is allocated
+# by other means, or has its tokens renewed. Entries for those aren't
+# dug out of the heap; each account's latest entry is remembered, and
+# any other is skipped when it reaches the top. The heap is rebuilt
+# without them if they come to outnumber the live entries.
+#
+# The policies, chosen with the AllocPolicy setting:
+# - least-recently-used: the account which has been unallocated
+#   longest, which spreads use evenly over the accounts
+# - freshest-token: the account whose Minecraft token expires last, so
+#   clients are rarely given a token which is about to expire
+# - round-robin: the accounts in the order they're listed in the
+#   allocation file, starting again from the top after the last
+
+LRU_POLICY = "least-recently-used"
+FRESHEST_TOKEN_POLICY = "freshest-token"
+ROUND_ROBIN_POLICY = "round-robin"
+
+ALLOC_POLICIES = [
+    LRU_POLICY,
+    FRESHEST_TOKEN_POLICY,
+    ROUND_ROBIN_POLICY,
+]
+
+# What the engine uses, and the AllocPolicy setting
+# defaults to, when no policy is given
+DEFAULT_ALLOC_POLICY = FRESHEST_TOKEN_POLICY
+
+# Dead entries the heap may hold beyond the number of live
+# ones before it's rebuilt without them
+REBUILD_SLACK = 64
+
+"""
+The queue of unallocated accounts. Subclasses say what order
+they come out in by giving each a key; the lowest comes first.
+"""
+class HeapPolicy:
+
+    def __init__(self):
+        # (key, number, account) for every account queued, and
+        # some which have since been taken out of the queue
+        self.heap = []
+
+        # Account -> the number of its live entry in the heap
+        self.entries = {}
+
+        # Entries are numbered in the order they're made
+        self.num_entries = 0
+
+    """
+    The key ordering acc in the heap.
+    row: its row in the engine
+    """
+    def key(self, acc, row):
+        raise NotImplementedError("{} must say how to order accounts".format(type(self).__name__))
+
+    """
+    Called with the key of each account given out.
+    """
+    def took(self, key):
+        pass
+
+    """
+    Queues acc, an unallocated account, to be given out.
+    Does nothing if it's already queued.
+    """
+    def add(self, acc, row):
+        if acc not in self.entries:
+            self.push(acc, row)
+
+    def push(self, acc, row):
+        self.num_entries += 1
+        self.entries[acc] = self.num_entries
+        heapq.heappush(self.heap, (self.key(acc, row), self.num_entries, acc))
+        if len(self.heap) > 2 * len(self.entries) + REBUILD_SLACK:
+            self.rebuild()
+
+    """
+    Takes acc out of the queue, because it's been allocated.
+    """
+    def remove(self, acc):
+        self.entries.pop(acc, None)
+
+    """
+    Called when acc's tokens have changed, which may change its key.
+    """
+    def tokens_changed(self, acc, row):
+        pass
+
+    """
+    Removes and returns the account to give out next,
+    or None if there are none unallocated.
+    """
+    def take(self):
+        while self.heap:
+            key, number, acc = heapq.heappop(self.heap)
+            if self.entries.get(acc) != number:
+                continue
+            del self.entries[acc]
+            if not acc.is_allocated():
+                self.took(key)
+                return acc
+        return None
+
+    def rebuild(self):
+        self.heap = [entry for entry in self.heap if self.entries.get(entry[2]) == entry[1]]
+        heapq.heapify(self.heap)
+
+    def num_queued(self):
+        return len(self.entries)
+
+
+"""
+Equal keys, so accounts come out in the order they were queued.
+"""
+class LruPolicy(HeapPolicy):
+
+    def key(self, acc, row):
+        return 0
+
+
+class FreshestTokenPolicy(HeapPolicy):
+
+    """
+    Later expiry times sort first.
+    """
+    def key(self, acc, row):
+        return -acc.get_mc_expiry().timestamp()
+
+    """
+    A renewed token moves its account up the queue.
+    """
+    def tokens_changed(self, acc, row):
+        if acc in self.entries:
+            self.push(acc, row)
+
+
+"""
+Keys are (lap, row): an account queued behind the last one given out
+waits for the next time round.
+"""
+class RoundRobinPolicy(HeapPolicy):
+
+    def __init__(self):
+        super().__init__()
+        self.last_taken = (0, -1)
+
+    def key(self, acc, row):
+        lap, last_row = self.last_taken
+        if row > last_row:
+            return (lap, row)
+        return (lap + 1, row)
+
+    def took(self, key):
+        self.last_taken = key
+
+
+POLICY_CLASSES = {
+    LRU_POLICY: LruPolicy,
+    FRESHEST_TOKEN_POLICY: FreshestTokenPolicy,
+    ROUND_ROBIN_POLICY: RoundRobinPolicy,
+}
+
+"""
+policy: one of ALLOC_POLICIES
+Returns a new, empty queue ordered by that policy.
+"""
+def make_policy(policy):
+    if policy not in POLICY_CLASSES:
+        raise ValueError("Allocation policy must be one of {}. Was {}".format(", ".join(ALLOC_POLICIES), policy))
+    return POLICY_CLASSES[policy]()
@@ -0,0 +1,184 @@
+import datetime
+import mmap
+import os
+import pwd
+import socket
+import struct
+from nydus.common import validity
+from nydus.common.validity import TIME_FORMAT
+from nydus.common.AllocJournal import fsync_dir, SNAPSHOT_TEMP_SUFFIX
+
+# The allocation state of every account as a binary file of fixed-size
+# records, one for each account in row order, which is mapped into
+# memory and changed in place.
+#
+# Allocating or releasing an account writes its one record and flushes
+# the page holding it, however many accounts there are, and there's no
+# journal to replay at startup or compact now and then.
+#
+# Each record is RECORD_SIZE bytes, holding
+# - whether the account is allocated
+# - the client's IPv4 address
+# - the uid of the client's system user
+# - when it was allocated, as seconds from 1970 in local time (which
+#   is what the alloc_time field holds)
+# A free account's record is all zeros, so growing the file for new
+# accounts gives them free records.
+#
+# The records are RECORD_SIZE-aligned after a header of the same size,
+# so no record spans two disk sectors; a crash while one is being
+# written leaves it either as it was or as it was being made.
+# A crash while several are being written may leave only some written.
+
+MAGIC = b"NYDALLOC"
+VERSION = 1
+
+# magic, version, record size
+HEADER_FORMAT = "<8sII16x"
+
+# allocated, client IP, client uid, alloc time
+RECORD_FORMAT = "<B3x4sIq12x"
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+assert struct.calcsize(HEADER_FORMAT) == RECORD_SIZE
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+class AllocRecords:
+
+    """
+    path: the records file, which is created if it doesn't exist
+    """
+    def __init__(self, path):
+        if not isinstance(path, str):
+            raise TypeError("Path to allocation records file must be a string. Was {}".format(path))
+
+        self.path = path
+        if not os.path.isfile(path):
+            AllocRecords.write_file(path, [])
+
+        self.file = open(path, "r+b")
+        self.map = None
+        try:
+            self.map_file()
+            magic, version, record_size = struct.unpack_from(HEADER_FORMAT, self.map, 0)
+            if magic != MAGIC or version != VERSION or record_size != RECORD_SIZE:
+                raise ValueError("Allocation records file {} is not a version {} allocation records file".format(path, VERSION))
+            if len(self.map) % RECORD_SIZE != 0:
+                raise ValueError("Allocation records file {} is {} bytes long, which isn't a whole number of {}-byte records".format(path, len(self.map), RECORD_SIZE))
+        except (ValueError, struct.error):
+            self.close()
+            raise
+
+    """
+    Creates a records file holding the given allocations, replacing
+    any already at path, such that after a crash the file holds either
+    all of the old records or all of the new.
+    alloc_rows: the ALLOC_FIELDS of every account, as lists of strings
+    """
+    def write_file(path, alloc_rows):
+        data = bytearray(RECORD_SIZE * (len(alloc_rows) + 1))
+        struct.pack_into(HEADER_FORMAT, data, 0, MAGIC, VERSION, RECORD_SIZE)
+        for row, alloc_fields in enumerate(alloc_rows):
+            AllocRecords.pack_record(data, row, alloc_fields)
+
+        temp_path = path + SNAPSHOT_TEMP_SUFFIX
+        with open(temp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        fsync_dir(path)
+
+    def record_offset(row):
+        return RECORD_SIZE * (row + 1)
+
+    """
+    Writes the record for the account in the given row into buffer,
+    straight from its ALLOC_FIELDS.
+    """
+    def pack_record(buffer, row, alloc_fields):
+        offset = AllocRecords.record_offset(row)
+        if not all(alloc_fields):
+            struct.pack_into(RECORD_FORMAT, buffer, offset, 0, bytes(4), 0, 0)
+            return
+
+        client_ip, client_username, alloc_time = alloc_fields
+        if not validity.is_valid_ipaddr(client_ip):
+            raise ValueError("Client IP value is not a valid IP address: {}".format(client_ip))
+        try:
+            uid = pwd.getpwnam(client_username).pw_uid
+        except KeyError:
+            raise ValueError("Client username value is not a valid system username: {}".format(client_username))
+        seconds = int((datetime.datetime.strptime(alloc_time, TIME_FORMAT) - EPOCH).total_seconds())
+        struct.pack_into(RECORD_FORMAT, buffer, offset, 1, socket.inet_aton(client_ip), uid, seconds)
+
+    """
+    Returns the ALLOC_FIELDS of the account in the given row, as strings.
+    """
+    def unpack_record(self, row):
+        allocated, packed_ip, uid, seconds = struct.unpack_from(RECORD_FORMAT, self.map, AllocRecords.record_offset(row))
+        if not allocated:
+            return ["", "", ""]
+
+        try:
+            client_username = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            raise ValueError("Account {} in allocation records file {} is allocated to uid {}, which has no system user".format(row, self.path, uid))
+        alloc_time = (EPOCH + datetime.timedelta(seconds=seconds)).strftime(TIME_FORMAT)
+        return [socket.inet_ntoa(packed_ip), client_username, alloc_time]
+
+    def map_file(self):
+        if self.map != None:
+            self.map.close()
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    """
+    Returns the ALLOC_FIELDS of every account with a record, in row order.
+    """
+    def read(self):
+        return [self.unpack_record(row) for row in range(self.get_num_records())]
+
+    """
+    changes: a list of (row, alloc_fields) tuples. A row past the
+        last record adds records up to it, free unless changed.
+    Writes the records in place, and doesn't return until they're on disk.
+    """
+    def write(self, changes):
+        if not changes:
+            return
+
+        last_row = max(row for row, alloc_fields in changes)
+        if last_row >= self.get_num_records():
+            self.grow(last_row + 1)
+
+        pages = set()
+        for row, alloc_fields in changes:
+            AllocRecords.pack_record(self.map, row, alloc_fields)
+            pages.add(AllocRecords.record_offset(row) // mmap.PAGESIZE)
+
+        for page in sorted(pages):
+            offset = page * mmap.PAGESIZE
+            self.map.flush(offset, min(mmap.PAGESIZE, len(self.map) - offset))
+
+    """
+    Makes room for num_records records. Only happens
+    when accounts are added, so isn't expected to be quick.
+    """
+    def grow(self, num_records):
+        self.map.flush()
+        self.file.truncate(AllocRecords.record_offset(num_records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.map_file()
+
+    def get_num_records(self):
+        return len(self.map) // RECORD_SIZE - 1
+
+    def get_path(self):
+        return self.path
+
+    def close(self):
+        if self.map != None:
+            self.map.close()
+            self.map = None
+        self.file.close()
@@ -0,0 +1,645 @@
+import os
+import sqlite3
+from nydus.common.AllocJournal import AllocJournal, write_atomically
+from nydus.common.AllocRecords import AllocRecords
+
+# Where the AllocEngine keeps the account allocation database.
+# The engine works on the accounts in memory; a store loads them when
+# the engine starts and makes its changes durable when it commits.
+#
+# Each account's fields are in two parts, stored apart:
+# - its allocation state (the ALLOC_FIELDS), which changes whenever the
+#   account is allocated or released
+# - its tokens (the TOKEN_FIELDS), several kilobytes which only change
+#   when they're renewed
+# Each part is written without the other, so allocating an account
+# never writes out its tokens and renewing tokens never writes out
+# the allocation state.
+#
+# There are two kinds of store, chosen with the AllocBackend setting:
+# - csv: the allocation file holds the tokens, one line per account, and
+#   a state file beside it holds the allocation state. Each is a CSV
+#   snapshot with its own journal (see the AllocJournal module), and each
+#   commit appends to the journals
+# - mmap: the tokens are kept as for csv, and the allocation state in a
+#   binary file of fixed-size records beside the allocation file, which
+#   is changed in place (see the AllocRecords module)
+# - sqlite: the allocation file is an SQLite database, with a table for
+#   each part, and each commit is one transaction
+#
+# Stores deal in each account's fields as a list of strings, in
+# the order of FIELDS; turning them into AllocAccounts is up to the
+# allocater module. Accounts are numbered by row, from 0, in the order
+# they were added. An account keeps its row, because accounts are only
+# ever added to the end.
+
+ALLOC_DELIM = ","
+
+FIELDS = [
+    "client_ip",
+    "client_username",
+    "alloc_time",
+    "ms_username",
+    "msal_token",
+    "msal_expiry",
+    "xboxlive_token",
+    "xboxlive_expiry",
+    "xsts_token",
+    "xsts_expiry",
+    "xsts_hash",
+    "mc_token",
+    "mc_expiry",
+    "mc_username",
+    "mc_uuid",
+]
+
+# The fields which change when an account is allocated or released.
+# They're empty for an unallocated account.
+ALLOC_FIELDS = FIELDS[:3]
+
+# The rest, which come from authenticating the account
+TOKEN_FIELDS = FIELDS[3:]
+
+CSV_BACKEND = "csv"
+MMAP_BACKEND = "mmap"
+SQLITE_BACKEND = "sqlite"
+ALLOC_BACKENDS = [
+    CSV_BACKEND,
+    MMAP_BACKEND,
+    SQLITE_BACKEND,
+]
+
+"""
+The interface every kind of store provides.
+"""
+class AllocStore:
+
+    """
+    Returns the fields of every account, as lists in row order.
+    """
+    def load(self):
+        raise NotImplementedError
+
+    """
+    Gets the store ready for commits without loading the accounts, when
+    the engine already has exactly what load would return (see the
+    BinarySnapshot module).
+    """
+    def skip_load(self):
+        raise NotImplementedError
+
+    """
+    Returns the paths of the files the store keeps the accounts in, some
+    of which may not exist. Anything changing the accounts changes one
+    of these, so their sizes and modification times tell whether the
+    store has changed.
+    """
+    def get_paths(self):
+        raise NotImplementedError
+
+    """
+    Called before noting what the files from get_paths are like, so
+    that they stay that way until the next commit. Never called while
+    a commit is under way.
+    """
+    def checkpoint(self):
+        raise NotImplementedError
+
+    """
+    changes: a list of (row, fields) tuples, one for each account changed
+        since the last commit. fields holds the ALLOC_FIELDS, when only
+        the allocation has changed; the TOKEN_FIELDS, when only the tokens
+        have; or all the FIELDS. A row one past the last adds an account,
+        and has all the FIELDS.
+    Doesn't return until the changes are durable, and makes
+    either all of them durable or none.
+    """
+    def commit(self, changes):
+        raise NotImplementedError
+
+    """
+    Starts folding whatever the store has accumulated since the last
+    compaction into a fresh copy of the accounts. Never called while
+    a commit is under way.
+    rows: the fields of every account, as load returns them
+    min_size: only parts of the store whose journal has grown to at least
+        this many bytes are compacted. 0 compacts everything.
+    Returns something to pass to finish_compaction.
+    """
+    def start_compaction(self, rows, min_size=0):
+        raise NotImplementedError
+
+    """
+    Finishes what start_compaction started; may be called
+    without holding the allocation lock.
+    """
+    def finish_compaction(self, compaction):
+        raise NotImplementedError
+
+    """
+    How many bytes compaction would fold in, for
+    the part of the store with the most to fold in.
+    """
+    def get_journal_size(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+"""
+Creates the store of the given kind for the allocation file at path.
+"""
+def open_store(path, backend=CSV_BACKEND):
+    if backend == CSV_BACKEND:
+        return CsvAllocStore(path)
+    if backend == MMAP_BACKEND:
+        return MmapAllocStore(path)
+    if backend == SQLITE_BACKEND:
+        return SqliteAllocStore(path)
+    raise ValueError("Allocation database backend must be one of {}. Was {}".format(", ".join(ALLOC_BACKENDS), backend))
+
+# The csv store's state file is the allocation file's path with this added
+STATE_SUFFIX = ".state"
+
+# The csv store's journals have a line for each account changed in a
+# commit. The allocation file's journal has
+#
+# tokens, row, followed by the account's TOKEN_FIELDS
+#
+# and the state file's journal has
+#
+# allocate, row, client_ip, client_user, time_allocated
+# release, row
+#
+# Before the allocation state had a file of its own, the allocation file
+# held every field, and its journal had allocate and release lines, and
+#
+# account, row, followed by every field of the account
+#
+# Those are still understood, so an allocation file from then can be
+# loaded. It's then rewritten as two files straight away.
+ALLOCATE_EVENT = "allocate"
+RELEASE_EVENT = "release"
+TOKENS_EVENT = "tokens"
+ACCOUNT_EVENT = "account"
+
+"""
+One of the two files the csv store keeps: a snapshot of some of the
+fields of every account, one line per account in row order below a
+header, and the journal of changes since.
+"""
+class CsvSnapshot:
+
+    """
+    path: the snapshot file
+    fields: the names of the fields it holds, in order
+    """
+    def __init__(self, path, fields):
+        self.path = path
+        self.fields = fields
+        self.journal = AllocJournal(path)
+
+    def make_header(self):
+        return ALLOC_DELIM.join(self.fields)
+
+    """
+    Creates the text of the snapshot file, given the fields
+    of every account as load returns them.
+    """
+    def rows_to_string(self, rows):
+        start = FIELDS.index(self.fields[0])
+        lines = [self.make_header()]
+        lines += [ALLOC_DELIM.join(fields[start:start + len(self.fields)]) for fields in rows]
+        return "".join("{}\n".format(line) for line in lines)
+
+    """
+    Returns the snapshot file's header, and each line after it split
+    into its fields; or None and no lines if the file is empty.
+    Doesn't check the lines' lengths, since an allocation file from before
+    the allocation state had a file of its own has a different header.
+    missing_ok: whether a missing file counts as empty, or raises
+    """
+    def read(self, missing_ok):
+        if missing_ok and not os.path.isfile(self.path):
+            return None, []
+
+        header = None
+        lines = []
+        with open(self.path, "r") as f:
+            for line in f:
+                line = line.strip()
+                if header == None:
+                    header = line
+                elif line:
+                    lines.append(line.split(ALLOC_DELIM))
+        return header, lines
+
+    """
+    Raises if a line of the snapshot file has the wrong number of fields.
+    """
+    def check_line(self, parts, num_fields):
+        if len(parts) != num_fields:
+            raise ValueError("Line in account allocation database {} was invalid. It should have had {} {}-separated elements, but had {}. Line looked like: {}".format(self.path, num_fields, ALLOC_DELIM, len(parts), ALLOC_DELIM.join(parts)))
+
+    """
+    Step 1 of compacting this file. Returns what to
+    pass to finish_compaction.
+    """
+    def start_compaction(self, rows):
+        text = self.rows_to_string(rows)
+        self.journal.rotate()
+        return text
+
+    def finish_compaction(self, text):
+        write_atomically(self.path, text)
+        self.journal.discard_old()
+
+    def get_path(self):
+        return self.path
+
+    def get_journal(self):
+        return self.journal
+
+class CsvAllocStore(AllocStore):
+
+    def __init__(self, path):
+        self.path = path
+        self.tokens = CsvSnapshot(path, TOKEN_FIELDS)
+        self.state = CsvSnapshot(path + STATE_SUFFIX, ALLOC_FIELDS)
+
+    """
+    Creates the header line to go in the top of an allocation
+    database file holding every field.
+    Does not include a newline on the end
+    """
+    def make_header():
+        return ALLOC_DELIM.join(FIELDS)
+
+    def load(self):
+        rows, combined = self.load_tokens()
+        if not combined:
+            header, lines = self.state.read(True)
+            for parts in lines:
+                self.state.check_line(parts, len(ALLOC_FIELDS))
+            CsvAllocStore.set_alloc_fields(rows, lines, self.state.get_path())
+
+        # The tokens first, since they add accounts
+        for snapshot in [self.tokens, self.state]:
+            for line in snapshot.get_journal().read_lines():
+                self.apply_event(rows, line, snapshot.get_journal())
+
+        # Split it into the two files, which ignores whatever
+        # state file there was before
+        if combined:
+            self.finish_compaction(self.start_compaction(rows))
+        return rows
+
+    """
+    Reads the allocation file. Returns the fields of every account,
+    unallocated unless the file holds the allocation state too, and
+    whether it does (as it did before the state had a file of its own).
+    """
+    def load_tokens(self):
+        header, lines = self.tokens.read(False)
+        combined = header == CsvAllocStore.make_header()
+
+        if combined:
+            for parts in lines:
+                self.tokens.check_line(parts, len(FIELDS))
+            return lines, True
+
+        for parts in lines:
+            self.tokens.check_line(parts, len(TOKEN_FIELDS))
+        return [[""] * len(ALLOC_FIELDS) + parts for parts in lines], False
+
+    """
+    Sets the ALLOC_FIELDS of the first accounts in rows to those in
+    alloc_rows, which were read from the file at path.
+    """
+    def set_alloc_fields(rows, alloc_rows, path):
+        if len(alloc_rows) > len(rows):
+            raise ValueError("Allocation state file {} has {} accounts, but the allocation file only has {}".format(path, len(alloc_rows), len(rows)))
+        for row, alloc_fields in enumerate(alloc_rows):
+            rows[row][:len(ALLOC_FIELDS)] = alloc_fields
+
+    """
+    Replays one line of a journal over the rows loaded from the files.
+    Each line sets fields to values, rather than changing them relative
+    to what they were, so replaying a line which the file already
+    includes does no harm.
+    """
+    def apply_event(self, rows, line, journal):
+        parts = line.split(ALLOC_DELIM)
+        if len(parts) < 2 or not parts[1].isdigit() or int(parts[1]) > len(rows):
+            raise ValueError("Line in account allocation journal {} did not name an account in the allocation database, which has {}. Line looked like: {}".format(journal.get_path(), len(rows), line))
+
+        row = int(parts[1])
+        if parts[0] == TOKENS_EVENT and len(parts) == 2 + len(TOKEN_FIELDS):
+            if row == len(rows):
+                rows.append([""] * len(ALLOC_FIELDS) + parts[2:])
+            else:
+                rows[row][len(ALLOC_FIELDS):] = parts[2:]
+        elif parts[0] == ACCOUNT_EVENT and len(parts) == 2 + len(FIELDS):
+            if row == len(rows):
+                rows.append(parts[2:])
+            else:
+                rows[row] = parts[2:]
+        elif row == len(rows):
+            raise ValueError("Line in account allocation journal {} changed the allocation of an account which hasn't been added. Line looked like: {}".format(journal.get_path(), line))
+        elif parts[0] == ALLOCATE_EVENT and len(parts) == 2 + len(ALLOC_FIELDS):
+            rows[row][:len(ALLOC_FIELDS)] = parts[2:]
+        elif parts[0] == RELEASE_EVENT and len(parts) == 2:
+            rows[row][:len(ALLOC_FIELDS)] = [""] * len(ALLOC_FIELDS)
+        else:
+            raise ValueError("Line in account allocation journal {} was invalid. It should have been an {}, {} or {} event with the right number of {}-separated elements. Line looked like: {}".format(journal.get_path(), ALLOCATE_EVENT, RELEASE_EVENT, TOKENS_EVENT, ALLOC_DELIM, line))
+
+    def make_alloc_event(row, alloc_fields):
+        if all(alloc_fields):
+            return ALLOC_DELIM.join([ALLOCATE_EVENT, str(row)] + alloc_fields)
+        return ALLOC_DELIM.join([RELEASE_EVENT, str(row)])
+
+    def make_tokens_event(row, token_fields):
+        return ALLOC_DELIM.join([TOKENS_EVENT, str(row)] + token_fields)
+
+    """
+    Splits changes into the lines to append to the allocation file's
+    journal, and (row, alloc_fields) tuples for the allocation state.
+    """
+    def split_changes(changes):
+        token_lines = []
+        alloc_changes = []
+        for row, fields in changes:
+            if len(fields) == len(ALLOC_FIELDS):
+                alloc_changes.append((row, fields))
+            elif len(fields) == len(TOKEN_FIELDS):
+                token_lines.append(CsvAllocStore.make_tokens_event(row, fields))
+            else:
+                token_lines.append(CsvAllocStore.make_tokens_event(row, fields[len(ALLOC_FIELDS):]))
+                alloc_changes.append((row, fields[:len(ALLOC_FIELDS)]))
+        return token_lines, alloc_changes
+
+    """
+    The tokens are committed first, so that if nydus-server dies between
+    the two appends, a new account's tokens are there for the allocation
+    state to refer to. Either way the caller hasn't yet been told
+    the commit went through.
+    """
+    def commit(self, changes):
+        token_lines, alloc_changes = CsvAllocStore.split_changes(changes)
+        self.tokens.get_journal().append(token_lines)
+        self.state.get_journal().append([CsvAllocStore.make_alloc_event(row, alloc_fields)
+                for row, alloc_fields in alloc_changes])
+
+    """
+    The CsvSnapshots the store keeps. The state file comes before the
+    allocation file, because it's written first when compacting, which
+    matters when splitting an allocation file which holds every field.
+    """
+    def get_snapshots(self):
+        return [self.state, self.tokens]
+
+    """
+    Moves the journals which have grown big enough aside, and returns the
+    new text of their files; see the AllocJournal module for how
+    compaction goes.
+    """
+    def start_compaction(self, rows, min_size=0):
+        compaction = []
+        for snapshot in self.get_snapshots():
+            if snapshot.get_journal().get_size() >= min_size:
+                compaction.append((snapshot, snapshot.start_compaction(rows)))
+        return compaction
+
+    def finish_compaction(self, compaction):
+        for snapshot, text in compaction:
+            snapshot.finish_compaction(text)
+
+    def get_journal_size(self):
+        return max(snapshot.get_journal().get_size() for snapshot in self.get_snapshots())
+
+    def skip_load(self):
+        for snapshot in self.get_snapshots():
+            snapshot.get_journal().find_size()
+
+    def get_paths(self):
+        paths = []
+        for snapshot in self.get_snapshots():
+            journal = snapshot.get_journal()
+            paths += [snapshot.get_path(), journal.get_path(), journal.get_old_path()]
+        return paths
+
+    def checkpoint(self):
+        pass
+
+    def get_tokens_snapshot(self):
+        return self.tokens
+
+    def get_state_snapshot(self):
+        return self.state
+
+    def close(self):
+        for snapshot in self.get_snapshots():
+            snapshot.get_journal().close()
+
+# The mmap store's records file is the allocation file's path with this added
+RECORDS_SUFFIX = ".records"
+
+"""
+Keeps the tokens as the csv store does, and the allocation
+state in an AllocRecords file rather than a state file.
+"""
+class MmapAllocStore(CsvAllocStore):
+
+    def __init__(self, path):
+        self.path = path
+        self.tokens = CsvSnapshot(path, TOKEN_FIELDS)
+        self.state = None
+
+        # Opened by load, which may first have to create it
+        self.records = None
+
+    def load(self):
+        rows, combined = self.load_tokens()
+        for line in self.tokens.get_journal().read_lines():
+            self.apply_event(rows, line, self.tokens.get_journal())
+
+        # Split it into the two files: the records first,
+        # then the allocation file without the allocation state
+        if combined:
+            AllocRecords.write_file(self.path + RECORDS_SUFFIX, [fields[:len(ALLOC_FIELDS)] for fields in rows])
+            self.finish_compaction(self.start_compaction(rows))
+
+        self.records = AllocRecords(self.path + RECORDS_SUFFIX)
+        CsvAllocStore.set_alloc_fields(rows, self.records.read(), self.records.get_path())
+        return rows
+
+    """
+    Each allocation change is written to its record in place. Unlike
+    the other stores, should nydus-server die partway through, some of
+    the allocation changes may have been made and others not. None of
+    them has been reported to a client yet, and a client left with an
+    account it wasn't told about loses it when its lease runs out.
+    """
+    def commit(self, changes):
+        token_lines, alloc_changes = CsvAllocStore.split_changes(changes)
+        self.tokens.get_journal().append(token_lines)
+        self.records.write(alloc_changes)
+
+    def skip_load(self):
+        CsvAllocStore.skip_load(self)
+        self.records = AllocRecords(self.path + RECORDS_SUFFIX)
+
+    def get_snapshots(self):
+        return [self.tokens]
+
+    def get_paths(self):
+        return CsvAllocStore.get_paths(self) + [self.path + RECORDS_SUFFIX]
+
+    def get_records(self):
+        return self.records
+
+    def close(self):
+        CsvAllocStore.close(self)
+        if self.records != None:
+            self.records.close()
+
+# Each account's tokens are a row of the tokens table, and its
+# allocation state a row of the allocations table, with the account's
+# row as the id in both. Keeping them apart means allocating an account
+# rewrites a short row, rather than one with all its tokens (SQLite
+# writes a whole row out again to change any of it). The indexes let
+# anything reading the database, such as an administrator with the
+# sqlite3 tool, find an account by uuid or client IP, or find the free
+# accounts, without reading a whole table.
+SQLITE_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS tokens (id INTEGER PRIMARY KEY, {})".format(
+        ", ".join("{} TEXT NOT NULL".format(field) for field in TOKEN_FIELDS)),
+    "CREATE TABLE IF NOT EXISTS allocations (id INTEGER PRIMARY KEY, {})".format(
+        ", ".join("{} TEXT NOT NULL".format(field) for field in ALLOC_FIELDS)),
+    "CREATE INDEX IF NOT EXISTS tokens_mc_uuid ON tokens (mc_uuid)",
+    "CREATE INDEX IF NOT EXISTS allocations_client_ip ON allocations (client_ip)",
+    "CREATE INDEX IF NOT EXISTS allocations_free ON allocations (id) WHERE alloc_time = ''",
+]
+
+# Before the two were split, every field was in this table
+SQLITE_COMBINED_TABLE = "accounts"
+
+# SQLite's name for the write-ahead log beside a database
+SQLITE_WAL_SUFFIX = "-wal"
+
+class SqliteAllocStore(AllocStore):
+
+    """
+    path: an SQLite database, or an empty file to create one in
+    """
+    def __init__(self, path):
+        self.path = path
+
+        # Transactions are begun and committed explicitly, rather than
+        # by the sqlite3 module. Only used holding the allocation lock,
+        # but not always on the thread which opened it.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+        try:
+            # The write-ahead log makes a commit one append and one fsync,
+            # and lets readers carry on while a commit is happening
+            self.conn.execute("PRAGMA journal_mode = WAL")
+            self.conn.execute("PRAGMA synchronous = FULL")
+            self.transaction(self.create_schema)
+        except sqlite3.DatabaseError as e:
+            self.conn.close()
+            raise ValueError("Accounts database file {} could not be used as an SQLite database: {}".format(path, e))
+
+    """
+    Runs function(*args) as one transaction, committing it if function
+    returns and rolling it back if it raises.
+    BEGIN IMMEDIATE takes the write lock straight away, so another process
+    writing at the same time waits for this transaction rather than
+    failing partway through.
+    """
+    def transaction(self, function, *args):
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = function(*args)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return result
+
+    """
+    Creates the tables, splitting up a table holding every field
+    if the database has one.
+    """
+    def create_schema(self):
+        for statement in SQLITE_SCHEMA:
+            self.conn.execute(statement)
+
+        cursor = self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", [SQLITE_COMBINED_TABLE])
+        if cursor.fetchone() != None:
+            for table, fields in [("tokens", TOKEN_FIELDS), ("allocations", ALLOC_FIELDS)]:
+                self.conn.execute("INSERT OR REPLACE INTO {} (id, {}) SELECT id, {} FROM {}".format(
+                    table, ", ".join(fields), ", ".join(fields), SQLITE_COMBINED_TABLE))
+            self.conn.execute("DROP TABLE {}".format(SQLITE_COMBINED_TABLE))
+
+    def load(self):
+        cursor = self.conn.execute("SELECT {}, {} FROM tokens LEFT JOIN allocations USING (id) ORDER BY id".format(
+            ", ".join("IFNULL({}, '')".format(field) for field in ALLOC_FIELDS), ", ".join(TOKEN_FIELDS)))
+        return [list(fields) for fields in cursor]
+
+    def skip_load(self):
+        pass
+
+    """
+    A commit which SQLite hasn't yet copied into
+    the database is in its write-ahead log.
+    """
+    def get_paths(self):
+        return [self.path, self.path + SQLITE_WAL_SUFFIX]
+
+    """
+    SQLite copies its write-ahead log into the database when the last
+    connection closes, or whenever the log has grown long enough. Doing
+    that now, and emptying the log, leaves it nothing to copy later.
+    """
+    def checkpoint(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    """
+    Writes one part of an account's fields.
+    """
+    def write_part(self, table, row, part_fields, values):
+        self.conn.execute("INSERT OR REPLACE INTO {} (id, {}) VALUES (?{})".format(
+            table, ", ".join(part_fields), ", ?" * len(part_fields)), [row] + values)
+
+    def apply_changes(self, changes):
+        for row, fields in changes:
+            if len(fields) == len(ALLOC_FIELDS):
+                self.write_part("allocations", row, ALLOC_FIELDS, fields)
+            elif len(fields) == len(TOKEN_FIELDS):
+                self.write_part("tokens", row, TOKEN_FIELDS, fields)
+            elif len(fields) == len(FIELDS):
+                self.write_part("tokens", row, TOKEN_FIELDS, fields[len(ALLOC_FIELDS):])
+                self.write_part("allocations", row, ALLOC_FIELDS, fields[:len(ALLOC_FIELDS)])
+            else:
+                raise ValueError("Change to account {} had {} fields, which isn't the number of fields in any part of an account".format(row, len(fields)))
+
+    def commit(self, changes):
+        if changes:
+            self.transaction(self.apply_changes, changes)
+
+    """
+    SQLite folds its write-ahead log into the database by itself,
+    so there's nothing to do.
+    """
+    def start_compaction(self, rows, min_size=0):
+        return None
+
+    def finish_compaction(self, compaction):
+        pass
+
+    def get_journal_size(self):
+        return 0
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,199 @@
+import datetime
+import hashlib
+import os
+import struct
+import zlib
+from nydus.common.validity import TIME_FORMAT
+from nydus.common.AllocJournal import fsync_dir, SNAPSHOT_TEMP_SUFFIX
+from nydus.common.AllocRecords import EPOCH
+from nydus.common.AllocStore import FIELDS
+
+# A copy of every account's fields in one binary file beside the
+# allocation file, which the AllocEngine loads in place of its store
+# when it can. Loading the store means reading its text (or database),
+# replaying journals, and checking every field of every account as it's
+# turned into an AllocAccount: parsing timestamps, looking up system
+# users. Loading this is one read, a checksum and splitting the fields
+# apart; nothing in it is checked, because it was written from accounts
+# which already had been.
+#
+# The file is a header, then the accounts' fields as UTF-8 text, split
+# by FIELD_SEP between fields and ROW_SEP between accounts, neither of
+# which can appear in a field. Each alloc_time is kept as a number of
+# seconds from 1970, as in the AllocRecords module, because turning that
+# into a datetime is much quicker than parsing TIME_FORMAT.
+#
+# The snapshot is only used when it holds exactly what the store would
+# load. The engine takes it out of the way before every commit, so the
+# store can't change without it going; and the header holds a
+# fingerprint of the store's files as they were when it was written,
+# so it's ignored after anything else (an administrator editing the
+# csv files by hand) has changed them. A snapshot which is ignored, or
+# whose checksum doesn't match, is simply passed over for the store.
+
+MAGIC = b"NYDSNAPS"
+VERSION = 1
+
+# magic, version, number of accounts, fingerprint of
+# the store, length of the fields, CRC-32 of the fields
+HEADER_FORMAT = "<8sII32sQI"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+FIELD_SEP = "\x1f"
+ROW_SEP = "\x1e"
+
+ALLOC_TIME_INDEX = FIELDS.index("alloc_time")
+
+# The snapshot is the allocation file's path with this added
+BINARY_SNAPSHOT_SUFFIX = ".bin"
+
+class BinarySnapshot:
+
+    """
+    alloc_file: path to the account allocation database
+    file whose accounts the snapshot holds
+    """
+    def __init__(self, alloc_file):
+        if not isinstance(alloc_file, str):
+            raise TypeError("Path to accounts database file must be a string. Was {}".format(alloc_file))
+
+        self.path = alloc_file + BINARY_SNAPSHOT_SUFFIX
+
+        # Whether there might be a snapshot to remove
+        self.present = os.path.isfile(self.path)
+
+    """
+    Sums up the sizes and modification times of the files in paths, in
+    that order, and the store's backend, such that if any of them
+    changes so does the sum. An empty file counts the same as a missing
+    one, since some (SQLite's write-ahead log) come and go while empty.
+    """
+    def fingerprint(backend, paths):
+        digest = hashlib.sha256(backend.encode())
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat == None or stat.st_size == 0:
+                digest.update(b"\nempty")
+            else:
+                digest.update("\n{} {}".format(stat.st_size, stat.st_mtime_ns).encode())
+        return digest.digest()
+
+    """
+    Turns rows, the fields of every account as strings in the order of
+    FIELDS, into the body of a snapshot.
+    """
+    def encode(rows):
+        encoded = []
+        for fields in rows:
+            fields = list(fields)
+            if fields[ALLOC_TIME_INDEX]:
+                alloc_time = datetime.datetime.strptime(fields[ALLOC_TIME_INDEX], TIME_FORMAT)
+                fields[ALLOC_TIME_INDEX] = str(int((alloc_time - EPOCH).total_seconds()))
+            encoded.append(FIELD_SEP.join(fields))
+        text = ROW_SEP.join(encoded)
+
+        # A separator inside a field would have added one
+        if text.count(FIELD_SEP) != len(rows) * (len(FIELDS) - 1) or text.count(ROW_SEP) != max(len(rows) - 1, 0):
+            raise ValueError("An account's fields contained one of the characters which separate fields in a binary snapshot, so the accounts can't be written to one")
+        return text.encode()
+
+    """
+    The reverse of encode, given the number of accounts. Returns
+    None if the body doesn't hold that many accounts' fields.
+    body: bytes, or a memoryview of them
+    """
+    def decode(body, num_accounts):
+        if num_accounts == 0:
+            return [] if not body else None
+
+        rows = [row.split(FIELD_SEP) for row in str(body, "utf-8").split(ROW_SEP)]
+        if len(rows) != num_accounts or any(len(fields) != len(FIELDS) for fields in rows):
+            return None
+
+        for fields in rows:
+            if fields[ALLOC_TIME_INDEX]:
+                fields[ALLOC_TIME_INDEX] = EPOCH + datetime.timedelta(seconds=int(fields[ALLOC_TIME_INDEX]))
+            else:
+                fields[ALLOC_TIME_INDEX] = None
+        return rows
+
+    """
+    fingerprint: what fingerprint gives for the store as it is now
+    Returns the fields of every account, as strings in the order of
+    FIELDS except for alloc_time, which is a datetime or None. Returns
+    None if there's no snapshot, it was taken of the store as it was
+    before some change, or it's been damaged.
+    """
+    def read(self, fingerprint):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        if len(data) < HEADER_SIZE:
+            return None
+        magic, version, num_accounts, snapshot_fingerprint, body_size, checksum = struct.unpack_from(HEADER_FORMAT, data, 0)
+        if magic != MAGIC or version != VERSION or snapshot_fingerprint != fingerprint:
+            return None
+
+        # A view rather than a copy, since it's most of the file
+        body = memoryview(data)[HEADER_SIZE:]
+        if len(body) != body_size or zlib.crc32(body) != checksum:
+            return None
+        try:
+            return BinarySnapshot.decode(body, num_accounts)
+        except (UnicodeDecodeError, ValueError, OverflowError):
+            return None
+
+    """
+    Writes a snapshot of rows, the fields of every account as strings
+    in the order of FIELDS, to a temporary file, for install to put
+    in place.
+    fingerprint: what fingerprint gives for the store the rows are from
+    """
+    def prepare(self, rows, fingerprint):
+        body = BinarySnapshot.encode(rows)
+        header = struct.pack(HEADER_FORMAT, MAGIC, VERSION, len(rows), fingerprint, len(body), zlib.crc32(body))
+        with open(self.path + SNAPSHOT_TEMP_SUFFIX, "wb") as f:
+            f.write(header)
+            f.write(body)
+            f.flush()
+            os.fsync(f.fileno())
+
+    """
+    Replaces the snapshot with the one prepare wrote.
+    """
+    def install(self):
+        os.replace(self.path + SNAPSHOT_TEMP_SUFFIX, self.path)
+        fsync_dir(self.path)
+        self.present = True
+
+    """
+    Throws away the snapshot prepare wrote, when it's out of date.
+    """
+    def abandon(self):
+        try:
+            os.remove(self.path + SNAPSHOT_TEMP_SUFFIX)
+        except FileNotFoundError:
+            pass
+
+    """
+    Removes the snapshot, if there is one, and doesn't return
+    until it's gone for good. Called before the store is changed.
+    """
+    def discard(self):
+        if not self.present:
+            return
+        try:
+            os.remove(self.path)
+            fsync_dir(self.path)
+        except FileNotFoundError:
+            pass
+        self.present = False
+
+    def get_path(self):
+        return self.path
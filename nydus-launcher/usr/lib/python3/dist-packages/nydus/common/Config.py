@@ -14,7 +14,8 @@ class Config:
     varnames: a dictionary. The keys of the dictionary should be the elements
         of the parnames list, and the corresponding values are the attribute names
         of the config class under which that configuration parameter's value will
-        be stored.
+        be stored. Parameters left out of varnames are allowed in the file
+        but not stored.
     """
     def __init__(self, path, parnames, defconfig, varnames):
         
@@ -33,13 +34,13 @@ class Config:
         if set(parnames) != set(defconfig.keys()):
             raise ValueError("Keys of defconfig were not identical to contents of parnames. Parnames: {}. Defconfig keys: {}.".format(parnames, defconfig.keys()))
 
-        if set(parnames) != set(varnames.keys()):
-            raise ValueError("Keys of varnames were not identical to contents of parnames. Parnames: {}. Defconfig keys: {}.".format(parnames, varnames.keys()))
+        if not set(varnames.keys()).issubset(set(parnames)):
+            raise ValueError("Keys of varnames were not all in parnames. Parnames: {}. Varnames keys: {}.".format(parnames, varnames.keys()))
 
         self.parnames = parnames
         self.varnames = varnames
 
-        for parname in self.parnames:
+        for parname in self.varnames:
             setattr(self, self.varnames[parname], defconfig[parname])
 
         self.path = path
@@ -67,14 +68,15 @@ class Config:
                 # Look for the parameter name
 
                 found_param = False
-                for pname in self.parname:
+                for pname in self.parnames:
                     if line.startswith(pname):
                         rest = line[len(pname):]
                         rest = rest.strip()
                         if rest.startswith("="):
                             value = rest[1:]
                             value = value.strip()
-                            setattr(self, self.varnames[pname], value)
+                            if pname in self.varnames:
+                                setattr(self, self.varnames[pname], value)
                             found_param = True
                             break
                         else:
@@ -3,6 +3,8 @@ from nydus.common import validity
 
 class MCAccount:
 
+    __slots__ = ("username", "uuid", "token")
+
     def __init__(self, username, uuid, token):
         assert validity.is_valid_minecraft_username(username), "Minecraft username '{}' was invalid".format(username)
         assert validity.is_valid_minecraft_uuid(uuid), "Minecraft uuid '{}' was invalid".format(uuid)
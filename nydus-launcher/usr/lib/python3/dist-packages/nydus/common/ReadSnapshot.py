@@ -0,0 +1,157 @@
+from nydus.common.AllocStore import FIELDS, ALLOC_FIELDS, TOKEN_FIELDS, ALLOC_DELIM, CsvAllocStore
+
+# What readers see of an AllocEngine's accounts, such as nydus-cli's
+# view commands asking a running nydus-server.
+#
+# After each commit the engine publishes a new ReadSnapshot, made from
+# the one before by replacing the rows the commit changed. Once made, a
+# ReadSnapshot never changes, so a reader takes whichever is current
+# and reads it for as long as it likes, without taking any lock: it
+# never waits for an allocation, nor holds one up. What it sees is
+# always the accounts as some commit left them on disk, never an
+# allocation only half made or not yet durable.
+#
+# Each account is a tuple of its FIELDS as strings, as the allocation
+# file has them. They're kept in chunks of ROWS_PER_CHUNK, and a new
+# snapshot shares every chunk a commit didn't touch with the snapshot
+# before it; so publishing one costs a copy of the chunks changed and a
+# reference to each of the others, not a copy of every account.
+
+ROWS_PER_CHUNK = 256
+
+# Views are made a piece of this many accounts at a time, so that
+# however many accounts there are, each piece stays well within what
+# the control socket (see the ControlSocket module) carries in a message
+ROWS_PER_PART = 32
+
+CLIENT_IP_INDEX = FIELDS.index("client_ip")
+MC_UUID_INDEX = FIELDS.index("mc_uuid")
+
+"""
+The fields of an account with the changed fields from a commit,
+which are all the FIELDS, the ALLOC_FIELDS or the TOKEN_FIELDS.
+"""
+def merge_fields(row, fields):
+    if len(fields) == len(FIELDS):
+        return tuple(fields)
+    if len(fields) == len(ALLOC_FIELDS):
+        return tuple(fields) + row[len(ALLOC_FIELDS):]
+    if len(fields) == len(TOKEN_FIELDS):
+        return row[:len(ALLOC_FIELDS)] + tuple(fields)
+    raise ValueError("An account's changed fields must be all {} of them, the {} allocation fields or the {} token fields. Was given {}".format(len(FIELDS), len(ALLOC_FIELDS), len(TOKEN_FIELDS), len(fields)))
+
+"""
+As AllocAccount.is_allocated, for an account's fields.
+"""
+def is_allocated_row(row):
+    return all(row[:len(ALLOC_FIELDS)])
+
+"""
+rows: accounts' fields, from a ReadSnapshot
+Returns them as AllocEngine.list_to_string does the accounts
+themselves: the header line, then a line for each.
+"""
+def rows_to_string(rows):
+    return "".join(rows_to_parts(rows))
+
+"""
+rows: an iterable of accounts' fields, from a ReadSnapshot
+Yields rows_to_string's text a piece at a time: the header
+line, then the lines of ROWS_PER_PART accounts at a time.
+"""
+def rows_to_parts(rows):
+    yield "{}\n".format(CsvAllocStore.make_header())
+    part = []
+    for row in rows:
+        part.append("{}\n".format(ALLOC_DELIM.join(row)))
+        if len(part) == ROWS_PER_PART:
+            yield "".join(part)
+            part = []
+    if part:
+        yield "".join(part)
+
+
+class ReadSnapshot:
+
+    """
+    chunks: a tuple of chunks, each a tuple of up to ROWS_PER_CHUNK
+        accounts' fields; all but the last full
+    num_rows: the number of accounts in them
+    """
+    def __init__(self, chunks=(), num_rows=0):
+        self.chunks = chunks
+        self.num_rows = num_rows
+
+    """
+    rows: every account's fields, as strings, in row order
+    """
+    def from_rows(rows):
+        rows = [tuple(row) for row in rows]
+        chunks = tuple(tuple(rows[start:start + ROWS_PER_CHUNK]) for start in range(0, len(rows), ROWS_PER_CHUNK))
+        return ReadSnapshot(chunks, len(rows))
+
+    """
+    changes: (row, fields) tuples, from a commit of AllocEngine.take_changes
+    Returns a new snapshot with the changes made; this one is left as
+    it was. A row one past the last is a new account.
+    """
+    def apply(self, changes):
+        chunks = list(self.chunks)
+        copied = {}
+        num_rows = self.num_rows
+        for row, fields in changes:
+            if row > num_rows:
+                raise ValueError("Can't apply a change to account {} to a snapshot of {} accounts".format(row, num_rows))
+
+            n, offset = divmod(row, ROWS_PER_CHUNK)
+            if n not in copied:
+                copied[n] = list(chunks[n]) if n < len(chunks) else []
+            chunk = copied[n]
+
+            if offset == len(chunk):
+                if len(fields) != len(FIELDS):
+                    raise ValueError("A new account must have all {} fields. Account {} was given {}".format(len(FIELDS), row, len(fields)))
+                chunk.append(tuple(fields))
+                num_rows += 1
+            else:
+                chunk[offset] = merge_fields(chunk[offset], fields)
+
+        for n in sorted(copied):
+            if n == len(chunks):
+                chunks.append(None)
+            chunks[n] = tuple(copied[n])
+        return ReadSnapshot(tuple(chunks), num_rows)
+
+    def num_accounts(self):
+        return self.num_rows
+
+    """
+    Every account's fields, in row order, in a new list.
+    """
+    def get_rows(self):
+        return list(self.iter_rows())
+
+    """
+    Every account's fields, in row order, without
+    copying them into a list first.
+    """
+    def iter_rows(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def get_row(self, row):
+        if row < 0 or row >= self.num_rows:
+            raise IndexError("Snapshot has no account {}; it has {}".format(row, self.num_rows))
+        return self.chunks[row // ROWS_PER_CHUNK][row % ROWS_PER_CHUNK]
+
+    """
+    The fields of the accounts allocated to client_ip.
+    """
+    def find_ip(self, client_ip):
+        return [row for row in self.get_rows() if row[CLIENT_IP_INDEX] == client_ip and is_allocated_row(row)]
+
+    """
+    The fields of the accounts with Minecraft uuid uuid.
+    """
+    def find_uuid(self, uuid):
+        return [row for row in self.get_rows() if row[MC_UUID_INDEX] == uuid]
@@ -0,0 +1,28 @@
+import threading
+
+# A lock for each of any number of keys, such as one for each account,
+# without keeping a lock for every key.
+# Each key hashes to one of a fixed number of locks, its stripe. Keys
+# which share a stripe wait for each other when they needn't, but with
+# many more stripes than threads wanting them that seldom happens, and
+# the number of locks doesn't grow with the number of keys.
+
+DEFAULT_STRIPES = 64
+
+class StripedLock:
+
+    def __init__(self, num_stripes=DEFAULT_STRIPES):
+        if not isinstance(num_stripes, int) or num_stripes <= 0:
+            raise ValueError("Number of lock stripes must be a positive integer. Was {}".format(num_stripes))
+
+        self.locks = [threading.Lock() for i in range(num_stripes)]
+
+    """
+    Returns the threading.Lock for key, which must be hashable.
+    The same key always gets the same lock.
+    """
+    def get_lock(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
+    def get_num_stripes(self):
+        return len(self.locks)
@@ -2,9 +2,12 @@
 from nydus.common import netauth
 from nydus.common.Config import Config
 from nydus.common.allocater import AllocEngine
+from nydus.common.MCAccount import MCAccount
 from nydus.common.SSHLogins import SSHLogins
-from nyuds.common import validity
+from nydus.common.StripedLock import StripedLock
+from nydus.common import validity
 from msal import PublicClientApplication
+import datetime
 import threading
 
 # Tools used by both Nydus Server and Nydus Cli
@@ -21,11 +24,13 @@ app: the MSAL PublicClientApplication this server will use in authentication
 Gets Microsoft usernames out of the accounts file, attempts to authenticate them,
 (interactively; the user needs to manully log accounts in when the server starts)
 creates the allocation db file using the accounts which authd successfully.
-The Config instance passed must specificall have accounts_file and alloc_file,
-which are both stored by ServerConfig and by CliConfig.
+The Config instance passed must specificall have accounts_file, alloc_file
+and alloc_backend, which are all stored by ServerConfig and by CliConfig.
+pool: the AllocPool whose accounts file and allocation file to use in
+place of the Config's, when the accounts are split into pools
 Returns nothing
 """
-def initialise_accounts(cfg, app):
+def initialise_accounts(cfg, app, pool=None):
 
     if not isinstance(cfg, Config):
         raise TypeError("Must pass a Nydus Config instance to initialise_accounts. Got a {}".format(type(cfg)))
@@ -33,7 +38,10 @@ def initialise_accounts(cfg, app):
     if not isinstance(app, PublicClientApplication):
         raise TypeError("Must pass an MSAL PublicClientApplication to initialise_accounts. Got a {}".format(type(app)))
 
-    username_list = read_accounts_file(cfg.get_accounts_file())
+    if pool == None:
+        pool = cfg.get_alloc_pools().get_default_pool()
+
+    username_list = read_accounts_file(pool.get_accounts_file())
     auth_dict = netauth.auth_all(username_list, app, interactive_allowed=True)
     authed_aats = [aat for aat in auth_dict.values() if aat != None]
     failed_aats = [aat for aat in auth_dict.values() if aat == None]
@@ -48,7 +56,7 @@ def initialise_accounts(cfg, app):
     # This is the one instance where no locking is required
     # before running the AllocEngine, because no threads
     # will be spawned until the main server loop is reached.
-    alloc_engine = AllocEngine(cfg.get_alloc_file())
+    alloc_engine = AllocEngine(pool.get_alloc_file(), cfg.get_alloc_backend())
 
     # Create a whole new alloc db only if nothing is already
     # in the file.
@@ -87,8 +95,14 @@ allocation timeout.
 For accounts which are still allocated, it checks for whether those client
 IPs are still allocated and those system users are still logged in. If not,
 the relevant Minecraft account is released.
+release_expired: Nydus Server passes False, because it releases
+allocations as their leases run out and a live session may
+legitimately outlast the allocation timeout.
+thread_lock: the lock guarding the allocation file, if other threads
+use it. It's held only in short stretches; see cleanup_helper.
+Every pool of accounts is cleaned up, one after another.
 """
-def cleanup(cfg, app, thread_lock=None):
+def cleanup(cfg, app, thread_lock=None, release_expired=True):
 
     if not isinstance(cfg, Config):
         raise TypeError("Must pass a Nydus Config instance to initialise_accounts. Got a {}".format(type(cfg)))
@@ -99,89 +113,139 @@ def cleanup(cfg, app, thread_lock=None):
     if thread_lock != None and not isinstance(thread_lock, threading.Lock):
         raise TypeError("Must pass a threading.Lock or None to function cleanup. Got a {}".format(type(thread_lock)))
 
-    # TODO
-    # Does this lock up the allocations for too long?
-    # Do we need to split this into multiple
-    # separate operations with separate claim/release
-    # on the lock?
-
-    if thread_lock:
-        with thread_lock:
-            cleanup_helper(cfg, app)
-    else:
-        cleanup_helper(cfg, app)
+    for pool in cfg.get_alloc_pools().get_pools():
+        cleanup_helper(cfg, app, release_expired, lock=thread_lock, alloc_file=pool.get_alloc_file())
 
 """
-Only intended to be called from inside cleanup
-Used to simplify the code on whether to use a lock or not.
+Called from inside cleanup, and by Nydus Server through
+AllocService.maintain.
+alloc_engine: the engine to clean up. If None, one is loaded from
+the allocation file. Nydus Server passes its own, which holds the
+allocation state in memory.
+lock: the lock guarding alloc_engine, or None if no other thread
+uses it. It's taken only to read and change the engine, a little at a
+time, and never while talking to Microsoft or running who; so
+allocating accounts isn't held up while the cleanup runs.
+account_locks: see renew_tokens
+alloc_file: the allocation file to load when alloc_engine is None;
+AllocFile if this is None too
+Writes the results back to the allocation file, unless the engine
+leaves committing to its owner.
 """
-def cleanup_helper(cfg, app):
-    alloc_engine = AllocEngine(cfg.get_alloc_file())
+def cleanup_helper(cfg, app, release_expired=True, alloc_engine=None, lock=None, account_locks=None, alloc_file=None):
+    if lock == None:
+        lock = threading.Lock()
+
+    if alloc_file == None:
+        alloc_file = cfg.get_alloc_file()
+
+    if alloc_engine == None:
+        with lock:
+            alloc_engine = AllocEngine(alloc_file, cfg.get_alloc_backend())
 
-    renew_tokens(cfg, app, alloc_engine)
-    alloc_engine.release_expired()
-    release_unused_accounts(cfg)
+    renew_tokens(cfg, app, alloc_engine, lock, account_locks)
+
+    logins = SSHLogins()
+    with lock:
+        if release_expired:
+            alloc_engine.release_expired()
+        release_unused_accounts(cfg, alloc_engine, logins)
+        alloc_engine.autocommit_changes()
 
 """
 Looks for access tokens in the alloc db which are close to expiring,
 and renews them.
+lock: the lock guarding alloc_engine, or None if no other thread uses
+it. Each account is renewed on a copy taken holding the lock, and
+its renewed tokens are put back holding it again; the lock isn't held
+in between, while the new tokens are fetched.
+account_locks: a StripedLock keyed by Minecraft uuid, or None if no
+other thread renews tokens. An account's lock is held for the whole of
+its renewal, so two cleanups running at once don't both renew it.
 """
-def renew_tokens(cfg, app, alloc_engine):
-    all_accounts = alloc_engine.get_accounts()
-    for acc in all_accounts:
+def renew_tokens(cfg, app, alloc_engine, lock=None, account_locks=None):
+    if lock == None:
+        lock = threading.Lock()
+    if account_locks == None:
+        account_locks = StripedLock()
 
-        # We try/except everything here because if one
-        # authentication fails we still want to try renewing
-        # everything else
-
-        if acc.msal_needs_renewal(CLEANUP_DT):
-            ms_username = acc.get_ms_username()
-            try:
-                msal_tok = netauth.get_tok_msal(ms_username, app, interactive_allowed=False)
-                acc.update_msal_token(msal_tok)
-            except Exception:
-                pass
-
-        if acc.xboxlive_needs_renewal(CLEANUP_DT):
-            msal_tok = acc.get_msal_at()
-            try:
-                xboxlive_tok = netauth.get_tok_xboxlive(msal_tok)
-                acc.update_xboxlive_token(xboxlive_tok)
-            except Exception:
-                pass
-
-        if acc.xsts_needs_renewal(CLEANUP_DT):
-            xboxlive_tok = acc.get_xboxlive_at()
-            try:
-                xsts_tok = netauth.get_tok_xsts(xboxlive_tok)
-                acc.update_xsts_token(xsts_tok)
-            except Exception:
-                pass
-
-        if acc.minecraft_needs_renewal(CLEANUP_DT):
-            xsts_tok = acc.get_xsts_at()
-            try:
-                minecraft_tok = netauth.get_tok_minecraft(xsts_tok)
-                acc.update_minecraft_token(minecraft_tok)
-
-                # The minecraft access token is also in MCAccount
-                # so we need to update that too
-                mc_username = acc.get_mc_username()
-                mc_uuid = acc.get_mc_uuid()
-                mc_acc = MCAccount(mc_username, mc_uuid, minecraft_tok.get_token())
-                acc.update_minecraft_account(mc_acc)
-            except Exception:
-                pass
+    with lock:
+        all_accounts = [(acc, acc.get_mc_uuid()) for acc in alloc_engine.get_accounts()]
+
+    for acc, mc_uuid in all_accounts:
+        with account_locks.get_lock(mc_uuid):
+            with lock:
+                renewed = acc.copy()
+
+            if renew_account_tokens(app, renewed):
+                with lock:
+                    acc.update_account_auth_tokens(renewed.get_account_auth_tokens())
+
+"""
+Renews whichever of acc's tokens are close to expiring. Each token is
+fetched with the one before it, so a token renewed here is used to
+fetch the next.
+acc: an AllocAccount which belongs to no engine, and to no other thread
+Returns True if any token was renewed.
+"""
+def renew_account_tokens(app, acc):
+
+    # We try/except everything here because if one
+    # authentication fails we still want to try renewing
+    # everything else
+
+    if acc.msal_needs_renewal(CLEANUP_DT):
+        ms_username = acc.get_ms_username()
+        try:
+            msal_tok = netauth.get_tok_msal(ms_username, app, interactive_allowed=False)
+            acc.update_msal_token(msal_tok)
+        except Exception:
+            pass
+
+    if acc.xboxlive_needs_renewal(CLEANUP_DT):
+        msal_tok = acc.get_msal_at()
+        try:
+            xboxlive_tok = netauth.get_tok_xboxlive(msal_tok)
+            acc.update_xboxlive_token(xboxlive_tok)
+        except Exception:
+            pass
+
+    if acc.xsts_needs_renewal(CLEANUP_DT):
+        xboxlive_tok = acc.get_xboxlive_at()
+        try:
+            xsts_tok = netauth.get_tok_xsts(xboxlive_tok)
+            acc.update_xsts_token(xsts_tok)
+        except Exception:
+            pass
+
+    if acc.minecraft_needs_renewal(CLEANUP_DT):
+        xsts_tok = acc.get_xsts_at()
+        try:
+            minecraft_tok = netauth.get_tok_minecraft(xsts_tok)
+            acc.update_minecraft_token(minecraft_tok)
+
+            # The minecraft access token is also in MCAccount
+            # so we need to update that too
+            mc_username = acc.get_mc_username()
+            mc_uuid = acc.get_mc_uuid()
+            mc_acc = MCAccount(mc_username, mc_uuid, minecraft_tok.get_token())
+            acc.update_minecraft_account(mc_acc)
+        except Exception:
+            pass
+
+    return acc.changed_fields() != None
 
 
 """
 Looks for accounts which are allocated to IP addresses/system users
 which aren't in use right now (therefore the Minecraft account
 can't be in use) and releases them.
+logins: the SSHLogins to go by. If None, who is run to find them.
 """
-def release_unused_accounts(cfg):
-    logins = SSHLogins()
-    all_accounts = alloc_engine.get_accounts()
+def release_unused_accounts(cfg, alloc_engine, logins=None):
+    if logins == None:
+        logins = SSHLogins()
+    all_accounts = alloc_engine.get_allocated_accounts()
 
     for acc in all_accounts:
 
@@ -2,10 +2,16 @@
 
 import datetime
 import os
+import threading
+from nydus.common import validity
 from nydus.common.validity import TIME_FORMAT
 from nydus.common.MCAccount import MCAccount
 from nydus.common.AccessToken import AccessToken
 from nydus.common.AccountAuthTokens import AccountAuthTokens
+from nydus.common.AllocStore import open_store, ALLOC_DELIM, FIELDS, ALLOC_FIELDS, TOKEN_FIELDS, CSV_BACKEND, CsvAllocStore
+from nydus.common.BinarySnapshot import BinarySnapshot
+from nydus.common.AllocPolicy import make_policy, DEFAULT_ALLOC_POLICY
+from nydus.common.ReadSnapshot import ReadSnapshot
 
 # Decides which account to give to a client requesting an account.
 # Stores the currently allocated accounts in a file.
@@ -61,31 +67,45 @@ from nydus.common.AccountAuthTokens import AccountAuthTokens
 # with the new one.
 # This needs to happen periodically. How often?
 
-ALLOC_FILE = "nydus-alloc.csv"
+# The above describes the csv backend. Changes aren't written straight
+# into the file, but appended to a journal beside it, which is folded
+# into the file every so often. With the sqlite backend the file is an
+# SQLite database instead. See the AllocStore module for both.
+# Whichever it is, a binary copy of the accounts is kept beside it
+# while nothing's changing, which loads faster (see the BinarySnapshot
+# module).
 
-ALLOC_DELIM = ","
+ALLOC_FILE = "nydus-alloc.csv"
 
 # How long an account allocation lasts before
 # it will be deleted
 ALLOC_TIMEOUT = datetime.timedelta(hours=2)
 
-FIELDS = [
-    "client_ip",
-    "client_username",
-    "alloc_time",
-    "ms_username",
-    "msal_token",
-    "msal_expiry",
-    "xboxlive_token",
-    "xboxlive_expiry",
-    "xsts_token",
-    "xsts_expiry",
-    "xsts_hash",
-    "mc_token",
-    "mc_expiry",
-    "mc_username",
-    "mc_uuid",
-]
+"""
+Token expiries are written to the allocation file as TIME_FORMAT strings,
+but AccessToken keeps them as datetimes. Accepts either.
+"""
+def to_datetime(value):
+    if isinstance(value, datetime.datetime):
+        return value
+    return datetime.datetime.strptime(value, TIME_FORMAT)
+
+"""
+The reverse of to_datetime. None, for an unallocated
+account's alloc_time, becomes the empty string.
+"""
+def to_time_str(value):
+    if value == None:
+        return ""
+    return value.strftime(TIME_FORMAT)
+
+# An AllocAccount keeps the TOKEN_FIELDS as strings
+# until one of them is needed as something else
+MS_USERNAME_INDEX = TOKEN_FIELDS.index("ms_username")
+MC_TOKEN_INDEX = TOKEN_FIELDS.index("mc_token")
+MC_EXPIRY_INDEX = TOKEN_FIELDS.index("mc_expiry")
+MC_USERNAME_INDEX = TOKEN_FIELDS.index("mc_username")
+MC_UUID_INDEX = TOKEN_FIELDS.index("mc_uuid")
 
 """
 Represents one line of the account allocation
@@ -93,9 +113,19 @@ database file.
 The alloc_time and token_time attributes store
 datetime objects, but you should pass a string, not a datetime,
 to the constructor for those fields.
+The tokens aren't decoded into an AccountAuthTokens until something
+needs it, since most uses of most accounts (loading them, allocating
+them, listing them) only need the allocation fields and the Minecraft
+username, uuid and token, which are read from the strings as they are.
+A token field which isn't valid is only noticed when it's decoded.
 """
 class AllocAccount:
 
+    # The server holds one of these for every account, so they
+    # have slots rather than a __dict__ each
+    __slots__ = ("client_ip", "client_username", "alloc_time", "token_fields",
+            "aat", "alloc_changed", "tokens_changed", "engine")
+
     """
     Constructor accepts all the fields individually.
     It's intended to receive data direct from the allocation file.
@@ -114,19 +144,60 @@ class AllocAccount:
         self.set_client_username(client_username)
         self.set_alloc_time(alloc_time)
 
-        msal_at = AccessToken(msal_token, msal_expiry)
-        xbl_at = AccessToken(xboxlive_token, xboxlive_expiry)
-        xsts_at = AccessToken(xsts_token, xsts_expiry, xsts_hash)
-        mc_at = AccessToken(mc_token, mc_expiry)
-        mc_acc = MCAccount(mc_username, mc_uuid, mc_token)
-        aat = AccountAuthTokens(ms_username, msal_at, xbl_at, xsts_at, mc_at, mc_acc)
+        # The TOKEN_FIELDS as strings, until decoded
+        # into self.aat, and then None
+        self.token_fields = (ms_username, msal_token, msal_expiry,
+                xboxlive_token, xboxlive_expiry, xsts_token, xsts_expiry,
+                xsts_hash, mc_token, mc_expiry, mc_username, mc_uuid)
+        self.aat = None
 
-        self.set_account_auth_tokens(aat)
+        # Whether the allocation or the tokens have changed
+        # since the AllocEngine last wrote this account out
+        self.alloc_changed = False
+        self.tokens_changed = False
 
+        # The AllocEngine holding this account, which is told about
+        # every change so it can keep its indexes up to date.
+        # None until the account is added to one.
+        self.engine = None
 
     def num_fields():
         return len(FIELDS)
 
+    """
+    Builds an AccountAuthTokens from the TOKEN_FIELDS, as strings.
+    """
+    def decode_tokens(ms_username, msal_token, msal_expiry, xboxlive_token,
+            xboxlive_expiry, xsts_token, xsts_expiry, xsts_hash,
+            mc_token, mc_expiry, mc_username, mc_uuid):
+
+        msal_at = AccessToken(msal_token, to_datetime(msal_expiry))
+        xbl_at = AccessToken(xboxlive_token, to_datetime(xboxlive_expiry))
+        xsts_at = AccessToken(xsts_token, to_datetime(xsts_expiry), xsts_hash)
+        mc_at = AccessToken(mc_token, to_datetime(mc_expiry))
+        mc_acc = MCAccount(mc_username, mc_uuid, mc_token)
+        return AccountAuthTokens(ms_username, msal_at, xbl_at, xsts_at, mc_at, mc_acc)
+
+    """
+    The reverse of decode_tokens: returns the
+    TOKEN_FIELDS of an AccountAuthTokens, as strings.
+    """
+    def encode_tokens(aat):
+        return [
+            aat.get_microsoft_username(),
+            aat.get_msal_token().get_token(),
+            to_time_str(aat.get_msal_token().get_expiry()),
+            aat.get_xboxlive_token().get_token(),
+            to_time_str(aat.get_xboxlive_token().get_expiry()),
+            aat.get_xsts_token().get_token(),
+            to_time_str(aat.get_xsts_token().get_expiry()),
+            aat.get_xsts_token().get_hash(),
+            aat.get_minecraft_token().get_token(),
+            to_time_str(aat.get_minecraft_token().get_expiry()),
+            aat.get_minecraft_account().get_username(),
+            aat.get_minecraft_account().get_uuid(),
+        ]
+
     """
     Creates a new AllocAccount with the data you've passed it.
     In particular, it accepts a finished AccountAuthTokens instance
@@ -146,23 +217,26 @@ class AllocAccount:
         if not isinstance(aat, AccountAuthTokens):
             raise TypeError("To create an AllocAccount using AccountAuthTokens, an AccountAuthTokens instance must be provided. Instead, {} was given.".format(type(aat)))
 
-        return AllocAccount(
-            client_ip,
-            client_username,
-            alloc_time,
-            aat.get_microsoft_username(),
-            aat.get_msal_token().get_token(),
-            aat.get_msal_token().get_expiry(),
-            aat.get_xboxlive_token().get_token(),
-            aat.get_xboxlive_token().get_expiry(),
-            aat.get_xsts_token().get_token(),
-            aat.get_xsts_token().get_expiry(),
-            aat.get_xsts_token().get_hash(),
-            aat.get_minecraft_token().get_token(),
-            aat.get_minecraft_token().get_expiry(),
-            aat.get_minecraft_account().get_username(),
-            aat.get_minecraft_account().get_uuid(),
-        )
+        return AllocAccount(client_ip, client_username, alloc_time, *AllocAccount.encode_tokens(aat))
+
+    """
+    Creates an AllocAccount from fields read out of a binary snapshot,
+    which were written from accounts that had been through the
+    constructor. So none of them is checked again, which is what makes
+    loading a snapshot quick. The fields are those the constructor
+    takes, except that alloc_time is already a datetime (or None).
+    """
+    def from_snapshot(client_ip, client_username, alloc_time, *token_fields):
+        acc = AllocAccount.__new__(AllocAccount)
+        acc.client_ip = client_ip
+        acc.client_username = client_username
+        acc.alloc_time = alloc_time
+        acc.token_fields = token_fields
+        acc.aat = None
+        acc.alloc_changed = False
+        acc.tokens_changed = False
+        acc.engine = None
+        return acc
 
     """
     Creates the header line to go in the top of the allocation
@@ -170,15 +244,10 @@ class AllocAccount:
     Does not include a newline on the end
     """
     def make_header():
-        return ALLOC_DELIM.join(FIELDS)
+        return CsvAllocStore.make_header()
 
     def copy(self):
-        return AllocAccount(
-            self.get_client_ip(),
-            self.get_client_username(),
-            self.get_alloc_time(),
-            self.get_account_auth_tokens().copy(),
-        )
+        return AllocAccount(*self.to_fields())
 
     """
     There should not be accounts which have only some of the first
@@ -192,16 +261,71 @@ class AllocAccount:
         return False
 
     def allocate(self, client_ip, client_username):
+        old_client_ip = self.get_allocated_ip()
         now = datetime.datetime.now()
         now_str = now.strftime(TIME_FORMAT)
         self.set_client_ip(client_ip)
         self.set_client_username(client_username)
         self.set_alloc_time(now_str)
+        self.alloc_changed = True
+        if self.engine != None:
+            self.engine.allocation_changed(self, old_client_ip)
 
     def release(self):
+        old_client_ip = self.get_allocated_ip()
         self.set_client_ip("")
         self.set_client_username("")
         self.set_alloc_time("")
+        self.alloc_changed = True
+        if self.engine != None:
+            self.engine.allocation_changed(self, old_client_ip)
+
+    """
+    The client IP the account is allocated to, or ""
+    if it isn't (properly) allocated.
+    """
+    def get_allocated_ip(self):
+        if self.is_allocated():
+            return self.client_ip
+        return ""
+
+    def set_engine(self, engine):
+        self.engine = engine
+
+    def clear_changes(self):
+        self.alloc_changed = False
+        self.tokens_changed = False
+
+    """
+    Marks the whole account as needing to be written out,
+    as when it's new.
+    """
+    def mark_changed(self):
+        self.alloc_changed = True
+        self.mark_tokens_changed()
+
+    """
+    Marks the account's tokens as needing to be written out,
+    but not its allocation.
+    """
+    def mark_tokens_changed(self):
+        self.tokens_changed = True
+        if self.engine != None:
+            self.engine.account_tokens_changed(self)
+
+    """
+    Returns the fields to commit for this account: the ALLOC_FIELDS, the
+    TOKEN_FIELDS or all of them, depending on what's changed. None if
+    nothing has. See AllocStore.commit.
+    """
+    def changed_fields(self):
+        if self.alloc_changed and self.tokens_changed:
+            return self.to_fields()
+        if self.tokens_changed:
+            return self.token_field_values()
+        if self.alloc_changed:
+            return self.alloc_fields()
+        return None
 
     # Type checks for the 'update' methods
     # occur inside the AccountAuthTokens method where applicable
@@ -209,19 +333,70 @@ class AllocAccount:
     # has been renewed.
 
     def update_msal_token(self, new_msal_token):
-        self.aat.set_msal_token(new_msal_token)
+        self.get_account_auth_tokens().set_msal_token(new_msal_token)
+        self.mark_tokens_changed()
 
     def update_xboxlive_token(self, new_xbl_token):
-        self.aat.set_xboxlive_token(new_xbl_token)
+        self.get_account_auth_tokens().set_xboxlive_token(new_xbl_token)
+        self.mark_tokens_changed()
 
     def update_xsts_token(self, new_xsts_token):
-        self.aat.set_xsts_token(new_xsts_token)
+        self.get_account_auth_tokens().set_xsts_token(new_xsts_token)
+        self.mark_tokens_changed()
 
     def update_minecraft_token(self, new_mc_token):
-        self.aat.set_minecraft_token(new_mc_token)
+        self.get_account_auth_tokens().set_minecraft_token(new_mc_token)
+        self.mark_tokens_changed()
 
     def update_minecraft_account(self, new_mc_account):
-        self.aat.set_minecraft_account(new_mc_account)
+        self.get_account_auth_tokens().set_minecraft_account(new_mc_account)
+        self.mark_tokens_changed()
+
+    """
+    Replaces all the account's tokens at once, such as with
+    those of a copy of the account which have been renewed.
+    They're kept as strings, as if just loaded, so they aren't
+    turned into strings again each time the account is written out.
+    """
+    def update_account_auth_tokens(self, new_aat):
+        if not isinstance(new_aat, AccountAuthTokens):
+            raise TypeError("Tokens to update an AllocAccount with must be an AccountAuthTokens instance. Was given a {}".format(type(new_aat)))
+
+        self.token_fields = tuple(AllocAccount.encode_tokens(new_aat))
+        self.aat = None
+        self.mark_tokens_changed()
+
+    """
+    Sets the account's fields to fields, which are all the FIELDS, only
+    the ALLOC_FIELDS or only the TOKEN_FIELDS, as strings; as another
+    engine's take_changes gives them. Those which differ from the
+    account's are marked changed.
+    """
+    def set_fields(self, fields):
+        if len(fields) == len(FIELDS):
+            alloc_fields = fields[:len(ALLOC_FIELDS)]
+            token_fields = fields[len(ALLOC_FIELDS):]
+        elif len(fields) == len(ALLOC_FIELDS):
+            alloc_fields, token_fields = fields, None
+        elif len(fields) == len(TOKEN_FIELDS):
+            alloc_fields, token_fields = None, fields
+        else:
+            raise ValueError("An account's fields must be all {} of them, the {} allocation fields or the {} token fields. Was given {}".format(len(FIELDS), len(ALLOC_FIELDS), len(TOKEN_FIELDS), len(fields)))
+
+        if token_fields != None and list(token_fields) != self.token_field_values():
+            self.token_fields = tuple(token_fields)
+            self.aat = None
+            self.mark_tokens_changed()
+
+        if alloc_fields != None and list(alloc_fields) != self.alloc_fields():
+            old_client_ip = self.get_allocated_ip()
+            client_ip, client_username, alloc_time = alloc_fields
+            self.set_client_ip(client_ip)
+            self.set_client_username(client_username)
+            self.set_alloc_time(alloc_time)
+            self.alloc_changed = True
+            if self.engine != None:
+                self.engine.allocation_changed(self, old_client_ip)
 
     """
     Returns True if the account is allocated and has been allocated
@@ -236,45 +411,47 @@ class AllocAccount:
         return False
 
     def msal_expired(self):
-        return self.aat.get_msal_token().is_expired()
+        return self.get_account_auth_tokens().get_msal_token().is_expired()
 
     def xboxlive_expired(self):
-        return self.aat.get_xboxlive_token().is_expired()
+        return self.get_account_auth_tokens().get_xboxlive_token().is_expired()
 
     def xsts_expired(self):
-        return self.aat.get_xsts_token().is_expired()
+        return self.get_account_auth_tokens().get_xsts_token().is_expired()
 
     def minecraft_expired(self):
-        return self.aat.get_minecraft_token().is_expired()
+        return self.get_account_auth_tokens().get_minecraft_token().is_expired()
 
     def msal_needs_renewal(self, check_interval, num_intervals=2):
-        return self.aat.get_msal_token().needs_renewal(check_interval, num_intervals)
+        return self.get_account_auth_tokens().get_msal_token().needs_renewal(check_interval, num_intervals)
 
     def xboxlive_needs_renewal(self, check_interval, num_intervals=2):
-        return self.aat.get_msal_token().needs_renewal(check_interval, num_intervals)
+        return self.get_account_auth_tokens().get_xboxlive_token().needs_renewal(check_interval, num_intervals)
 
     def xsts_needs_renewal(self, check_interval, num_intervals=2):
-        return self.aat.get_msal_token().needs_renewal(check_interval, num_intervals)
+        return self.get_account_auth_tokens().get_xsts_token().needs_renewal(check_interval, num_intervals)
 
     def minecraft_needs_renewal(self, check_interval, num_intervals=2):
-        return self.aat.get_msal_token().needs_renewal(check_interval, num_intervals)
+        return self.get_account_auth_tokens().get_minecraft_token().needs_renewal(check_interval, num_intervals)
 
     # We must allow empty string for client_ip, client_username, and
     # alloc time as empty strings for them indicate an unallocated account
     def set_client_ip(self, client_ip):
-        if client_ip == "" or validator.is_valid_ipaddr(client_ip):
+        if client_ip == "" or validity.is_valid_ipaddr(client_ip):
             self.client_ip = client_ip
         else:
             raise ValueError("Client IP value is not a valid IP address: {}".format(client_ip))
 
     def set_client_username(self, client_username):
-        if client_username == "" or validator.is_valid_system_username(client_username):
+        if client_username == "" or validity.is_valid_system_username(client_username):
             self.client_username = client_username
         else:
             raise ValueError("Client username value is not a valid system username: {}".format(client_username))
 
     def set_alloc_time(self, alloc_time):
-        if alloc_time == "" or validator.is_valid_str_timestamp(alloc_time):
+        if alloc_time == "":
+            self.alloc_time = None
+        elif validity.is_valid_str_timestamp(alloc_time):
             self.alloc_time = datetime.datetime.strptime(alloc_time, TIME_FORMAT)
         else:
             raise ValueError("Alloc time value is not a valid timestamp: {}".format(alloc_time))
@@ -282,6 +459,7 @@ class AllocAccount:
     def set_account_auth_tokens(self, aat):
         if isinstance(aat, AccountAuthTokens):
             self.aat = aat
+            self.token_fields = None
         else:
             raise TypeError("Object given is not an AccountAuthTokens class: {}".format(aat))
 
@@ -294,104 +472,135 @@ class AllocAccount:
     def get_alloc_time(self):
         return self.alloc_time
 
+    """
+    Decodes the tokens the first time it's called.
+    """
     def get_account_auth_tokens(self):
+        if self.aat == None:
+            self.aat = AllocAccount.decode_tokens(*self.token_fields)
+            self.token_fields = None
         return self.aat
 
     def get_ms_username(self):
-        return self.aat.get_ms_username()
+        if self.aat == None:
+            return self.token_fields[MS_USERNAME_INDEX]
+        return self.aat.get_microsoft_username()
 
     """
     Specifically the token string, not the AccessToken object
     """
     def get_msal_token(self):
-        return self.aat.get_msal_token().get_token()
+        return self.get_account_auth_tokens().get_msal_token().get_token()
 
     def get_msal_expiry(self):
-        return self.aat.get_msal_token().get_expiry()
+        return self.get_account_auth_tokens().get_msal_token().get_expiry()
 
     """
     Specifically the token string, not the AccessToken object
     """
     def get_xboxlive_token(self):
-        return self.aat.get_xboxlive_token().get_token()
+        return self.get_account_auth_tokens().get_xboxlive_token().get_token()
 
     def get_xboxlive_expiry(self):
-        return self.aat.get_xboxlive_token().get_expiry()
+        return self.get_account_auth_tokens().get_xboxlive_token().get_expiry()
 
     """
     Specifically the token string, not the AccessToken object
     """
     def get_xsts_token(self):
-        return self.aat.get_xsts_token().get_token()
+        return self.get_account_auth_tokens().get_xsts_token().get_token()
 
     def get_xsts_expiry(self):
-        return self.aat.get_xsts_token().get_expiry()
+        return self.get_account_auth_tokens().get_xsts_token().get_expiry()
 
     def get_xsts_hash(self):
-        return self.aat.get_xsts_token().get_hash()
+        return self.get_account_auth_tokens().get_xsts_token().get_hash()
 
     """
     Specifically the token string, not the AccessToken object
     """
     def get_mc_token(self):
+        if self.aat == None:
+            return self.token_fields[MC_TOKEN_INDEX]
         return self.aat.get_minecraft_token().get_token()
 
     def get_mc_expiry(self):
-        return self.aat.get_minecraft_token().get_expiry()
+        if self.aat == None:
+            return to_datetime(self.token_fields[MC_EXPIRY_INDEX])
+        return self.get_account_auth_tokens().get_minecraft_token().get_expiry()
 
     """
     For these get functions, 'at' stands for 'AccessToken'
     """
     def get_msal_at(self):
-        return self.aat.get_msal_token()
+        return self.get_account_auth_tokens().get_msal_token()
 
     def get_xboxlive_at(self):
-        return self.aat.get_xboxlive_token()
+        return self.get_account_auth_tokens().get_xboxlive_token()
 
     def get_xsts_at(self):
-        return self.aat.get_xsts_token()
+        return self.get_account_auth_tokens().get_xsts_token()
 
     def get_mc_at(self):
-        return self.aat.get_minecraft_token()
+        return self.get_account_auth_tokens().get_minecraft_token()
 
     def get_mc_username(self):
+        if self.aat == None:
+            return self.token_fields[MC_USERNAME_INDEX]
         return self.aat.get_minecraft_account().get_username()
 
     def get_mc_uuid(self):
+        if self.aat == None:
+            return self.token_fields[MC_UUID_INDEX]
         return self.aat.get_minecraft_account().get_uuid()
 
     """
-    Creates a line of data, suitable for writing back into
-    the account allocation database file.
-    Does NOT include a newline on the end.
+    The values of the ALLOC_FIELDS, as strings.
     """
-    def __repr__(self):
-        fields = [
+    def alloc_fields(self):
+        return [
             self.get_client_ip(),
             self.get_client_username(),
-            self.get_alloc_time(),
-            self.get_ms_username(),
-            self.get_msal_token(),
-            self.get_msal_expiry(),
-            self.get_xboxlive_token(),
-            self.get_xboxlive_expiry(),
-            self.get_xsts_token(),
-            self.get_xsts_expiry(),
-            self.get_mc_token(),
-            self.get_mc_expiry(),
-            self.get_mc_username(),
-            self.get_mc_uuid(),
+            to_time_str(self.get_alloc_time()),
         ]
 
-        assert len(fields) == self.num_fields()
-        return ALLOC_DELIM.join(fields)
+    """
+    The values of the TOKEN_FIELDS, as strings.
+    """
+    def token_field_values(self):
+        if self.aat == None:
+            return list(self.token_fields)
+        return AllocAccount.encode_tokens(self.aat)
+
+    """
+    The values of all the FIELDS, as strings.
+    """
+    def to_fields(self):
+        fields = self.alloc_fields() + self.token_field_values()
+        assert len(fields) == AllocAccount.num_fields()
+        return fields
+
+    """
+    Creates a line of data, suitable for writing back into
+    the account allocation database file.
+    Does NOT include a newline on the end.
+    """
+    def __repr__(self):
+        return ALLOC_DELIM.join(self.to_fields())
 
 """
 Initiate the AllocEngine with the path to the csv containing all
 the Minecraft accounts
-This class is intended to be created again by each thread that
-needs to work with the account database, then call one
-of its methods to do one of the operations.
+Nydus Server keeps one AllocEngine for as long as it runs. Nydus Cli
+creates one for each command when the server isn't running.
+
+Besides the list of accounts, the engine keeps indexes which let
+allocation and release find what they need straight away, however many
+accounts there are: the unallocated accounts, in a queue, and the
+accounts allocated to each client IP and with each Minecraft uuid.
+Accounts tell the engine whenever they're allocated, released or
+have their tokens changed, so the indexes stay up to date even when
+something other than the engine (such as the cleanup) changes them.
 """
 class AllocEngine:
 
@@ -400,8 +609,11 @@ class AllocEngine:
     AllocEngine won't read any data out of it.
     Then call the create_db method to set up the accounts and write the data
     into the file.
+    backend: which kind of AllocStore the file is; one of ALLOC_BACKENDS
+    policy: which unallocated account to give out next; one of
+        AllocPolicy.ALLOC_POLICIES
     """
-    def __init__(self, path):
+    def __init__(self, path, backend=CSV_BACKEND, policy=DEFAULT_ALLOC_POLICY):
         if not isinstance(path, str):
             raise TypeError("Path to accounts database file must be a string. Was {}".format(path))
 
@@ -416,8 +628,48 @@ class AllocEngine:
         
         self.path = path
         self.accounts = []
+
+        # AllocAccount -> its row in self.accounts
+        self.rows = {}
+
+        # Unallocated accounts, in the order they're to be given out
+        self.free = make_policy(policy)
+
+        # client_ip -> list of accounts allocated to it
+        self.by_ip = {}
+
+        # mc_uuid -> list of accounts with that uuid
+        self.by_uuid = {}
+
+        # Rows changed since the changes were last taken
+        self.changed_rows = set()
+
+        # Commits started so far. The binary snapshot is removed at the
+        # start of each, and a new one is only put in place if there
+        # hasn't been a commit since the accounts in it were copied,
+        # holding snapshot_lock for both, so a snapshot is never
+        # missing a commit.
+        self.binary_snapshot = BinarySnapshot(path)
+        self.num_commits = 0
+        self.snapshot_lock = threading.Lock()
+
+        # Held while writing a binary snapshot, so two aren't
+        # written to the same temporary file at once
+        self.snapshot_write_lock = threading.Lock()
+
+        # Called with the changes after each commit; see
+        # add_commit_listener
+        self.commit_listeners = []
+
+        self.backend = backend
+        self.store = open_store(path, backend)
+        self.autocommit = True
         self.load_alloc_db()
 
+        # The accounts as of the last commit, replaced with a new
+        # ReadSnapshot by each; see get_read_snapshot
+        self.read_snapshot = ReadSnapshot.from_rows(acc.to_fields() for acc in self.accounts)
+
     def num_total_accounts(self):
         return len(self.accounts)
 
@@ -433,7 +685,78 @@ class AllocEngine:
         return self.accounts
 
     def get_allocated_accounts(self):
-        return [acc for acc in self.accounts if acc.is_allocated()]
+        allocated = [acc for accs in self.by_ip.values() for acc in accs]
+        allocated.sort(key=self.rows.get)
+        return allocated
+
+    """
+    Adds an account to the end of the list, and to the indexes.
+    """
+    def add_account(self, acc):
+        self.rows[acc] = len(self.accounts)
+        self.accounts.append(acc)
+        self.by_uuid.setdefault(acc.get_mc_uuid(), []).append(acc)
+        if acc.is_allocated():
+            self.by_ip.setdefault(acc.get_client_ip(), []).append(acc)
+        else:
+            self.free.add(acc, self.rows[acc])
+        acc.set_engine(self)
+        if acc.changed_fields() != None:
+            self.account_changed(acc)
+
+    """
+    Removes and returns the unallocated account the allocation
+    policy picks, or None if all are allocated.
+    """
+    def take_free(self):
+        return self.free.take()
+
+    def num_free_accounts(self):
+        return self.num_total_accounts() - sum(len(accs) for accs in self.by_ip.values())
+
+    """
+    Called by an account after it's been allocated or released.
+    old_client_ip: what it was allocated to before, or ""
+    """
+    def allocation_changed(self, acc, old_client_ip):
+        if old_client_ip:
+            accs = self.by_ip[old_client_ip]
+            accs.remove(acc)
+            if not accs:
+                del self.by_ip[old_client_ip]
+
+        if acc.is_allocated():
+            self.by_ip.setdefault(acc.get_client_ip(), []).append(acc)
+            self.free.remove(acc)
+        else:
+            self.free.add(acc, self.rows[acc])
+        self.account_changed(acc)
+
+    """
+    Called by an account when anything about it has changed.
+    """
+    def account_changed(self, acc):
+        self.changed_rows.add(self.rows[acc])
+
+    """
+    Called by an account after its tokens have changed,
+    which may change where it is in the free queue.
+    """
+    def account_tokens_changed(self, acc):
+        self.free.tokens_changed(acc, self.rows[acc])
+        self.account_changed(acc)
+
+    """
+    The accounts allocated to client_ip, in a new list
+    """
+    def get_accounts_ip(self, client_ip):
+        return sorted(self.by_ip.get(client_ip, []), key=self.rows.get)
+
+    """
+    The accounts with Minecraft uuid uuid, in a new list
+    """
+    def get_accounts_uuid(self, uuid):
+        return list(self.by_uuid.get(uuid, []))
 
     """
     Given a list of AllocAccount objects, creates a string
@@ -455,41 +778,227 @@ class AllocEngine:
         if not validity.is_valid_minecraft_uuid(uuid):
             raise ValueError("Not a valid Minecraft uuid: {}".format(uuid))
 
-        to_view = [acc for acc in self.accounts if acc.get_mc_uuid() == uuid]
-        return AllocEngine.list_to_string(to_view)
+        return AllocEngine.list_to_string(self.get_accounts_uuid(uuid))
 
     def view_ip(self, client_ip):
         if not validity.is_valid_ipaddr(client_ip):
             raise ValueError("Not a valid IP address: {}".format(client_ip))
 
-        to_view = [acc for acc in self.accounts if acc.get_client_ip() == client_ip]
-        return AllocEngine.list_to_string(to_view)
+        return AllocEngine.list_to_string(self.get_accounts_ip(client_ip))
 
+    """
+    Commits every change made to the accounts since the last commit.
+    Once this returns, they're on disk.
+    Writes nothing if nothing has changed.
+    """
     def write_changes(self):
-        with open(path, "w") as f:
-            f.write(str(self))
-            f.flush()
+        changes = self.take_changes()
+        try:
+            self.commit_changes(changes)
+        except Exception:
+            self.restore_changes(changes)
+            raise
+
+    """
+    Called at the end of every operation which changes accounts.
+    Commits the changes, unless autocommit has been turned off.
+    """
+    def autocommit_changes(self):
+        if self.autocommit:
+            self.write_changes()
+
+    """
+    autocommit: if False, operations only change the accounts in memory,
+    and whoever owns the engine commits them with take_changes and
+    commit_changes. nydus-server does this to commit changes in groups
+    (see the GroupCommit module).
+    """
+    def set_autocommit(self, autocommit):
+        self.autocommit = autocommit
+
+    """
+    Returns the changes made since they were last taken, for
+    commit_changes, and forgets them.
+    """
+    def take_changes(self):
+        changes = []
+        for row in sorted(self.changed_rows):
+            acc = self.accounts[row]
+            fields = acc.changed_fields()
+            if fields != None:
+                changes.append((row, fields))
+                acc.clear_changes()
+        self.changed_rows = set()
+        return changes
 
+    """
+    Makes changes from take_changes durable. Doesn't touch the accounts,
+    so may be called without holding the lock, but not from two
+    threads at once.
+    """
+    def commit_changes(self, changes):
+        if changes:
+            with self.snapshot_lock:
+                self.num_commits += 1
+                self.binary_snapshot.discard()
+        self.store.commit(changes)
+        if changes:
+            self.read_snapshot = self.read_snapshot.apply(changes)
+            for listener in list(self.commit_listeners):
+                listener(changes)
+
+    """
+    The accounts as the last commit left them, as a ReadSnapshot which
+    won't change. Needs no lock, so may be called from any thread
+    while others allocate.
+    """
+    def get_read_snapshot(self):
+        return self.read_snapshot
+
+    """
+    listener: called with the changes from each commit once they're
+    durable, from whichever thread committed them, and before the next
+    commit. The changes are as take_changes gave them, for replicate
+    to apply to another engine. A primary nydus-server sends them to
+    its standbys this way.
+    """
+    def add_commit_listener(self, listener):
+        self.commit_listeners.append(listener)
+
+    def remove_commit_listener(self, listener):
+        if listener in self.commit_listeners:
+            self.commit_listeners.remove(listener)
+
+    """
+    Applies changes which another engine committed to these accounts, as
+    a standby nydus-server does with its primary's. An account whose row
+    is one past the last is a new one; rows further on than that are
+    an error, since accounts are only ever added in order.
+    Commits them too, unless autocommit is off.
+    """
+    def replicate(self, changes):
+        for row, fields in changes:
+            if row == len(self.accounts):
+                acc = AllocAccount(*fields)
+                acc.mark_changed()
+                self.add_account(acc)
+            elif row > len(self.accounts):
+                raise ValueError("Can't replicate a change to account {} when there are only {} accounts. Changes must be replicated in the order they were made".format(row, len(self.accounts)))
+            else:
+                acc = self.accounts[row]
+                old_uuid = acc.get_mc_uuid() if len(fields) != len(ALLOC_FIELDS) else None
+                acc.set_fields(fields)
+                if old_uuid != None and acc.get_mc_uuid() != old_uuid:
+                    self.uuid_changed(acc, old_uuid)
+        self.autocommit_changes()
+
+    """
+    Moves acc in the uuid index, after its tokens have been
+    replaced with those of a different Minecraft account.
+    """
+    def uuid_changed(self, acc, old_uuid):
+        accs = self.by_uuid[old_uuid]
+        accs.remove(acc)
+        if not accs:
+            del self.by_uuid[old_uuid]
+        self.by_uuid.setdefault(acc.get_mc_uuid(), []).append(acc)
+
+    """
+    Marks the accounts in changes, which failed to commit,
+    as changed again, so the next commit has another go.
+    """
+    def restore_changes(self, changes):
+        for row, fields in changes:
+            acc = self.accounts[row]
+            if len(fields) != len(TOKEN_FIELDS):
+                acc.alloc_changed = True
+            if len(fields) != len(ALLOC_FIELDS):
+                acc.tokens_changed = True
+            self.changed_rows.add(row)
+
+    """
+    Loads the accounts from the binary snapshot if there's one which
+    matches the store, and otherwise from the store.
+    """
     def load_alloc_db(self):
-        with open(path, "r") as f:
+        rows = self.binary_snapshot.read(self.store_fingerprint())
+        if rows != None:
+            self.store.skip_load()
+            for fields in rows:
+                self.add_account(AllocAccount.from_snapshot(*fields))
+            return
+
+        # Note: this instantiation depends on the order of fields
+        # being the same in the store and in the Account class
+        # constructor
+        for fields in self.store.load():
+            self.add_account(AllocAccount(*fields))
+
+    def store_fingerprint(self):
+        return BinarySnapshot.fingerprint(self.backend, self.store.get_paths())
+
+    """
+    Writes rows, the fields of every account when num_commits commits
+    had been started, to the binary snapshot. Unless there's been a
+    commit since, which rows might not include; then no snapshot is
+    written, and the next startup loads from the store.
+    May be called without holding the lock.
+    """
+    def write_binary_snapshot(self, rows, num_commits):
+        with self.snapshot_write_lock:
+            # With the count unchanged, no commit is under
+            # way, nor can one start until this is let go
+            with self.snapshot_lock:
+                if self.num_commits != num_commits:
+                    return
+                self.store.checkpoint()
+                fingerprint = self.store_fingerprint()
+
+            self.binary_snapshot.prepare(rows, fingerprint)
+            with self.snapshot_lock:
+                if self.num_commits == num_commits:
+                    self.binary_snapshot.install()
+                    return
+            self.binary_snapshot.abandon()
+
+    """
+    Writes the binary snapshot of the accounts as they are now, which
+    is what nydus-server does when it stops. Call holding the lock,
+    once every change has been committed.
+    """
+    def save_binary_snapshot(self):
+        self.write_binary_snapshot([acc.to_fields() for acc in self.accounts], self.num_commits)
+
+    """
+    The first half of compacting the store, which must happen holding
+    the lock, and not while changes are being committed. Changes made
+    but not yet committed are included, and committed later as usual.
+    min_size: see AllocStore.start_compaction
+    Returns what to pass to finish_compaction, which may happen
+    outside the lock.
+    """
+    def start_compaction(self, min_size=0):
+        rows = [acc.to_fields() for acc in self.accounts]
+        return self.store.start_compaction(rows, min_size), rows, self.num_commits
 
-            first_line = True
-            for line in f:
+    """
+    Also writes a binary snapshot of the accounts
+    as they were when the compaction started.
+    """
+    def finish_compaction(self, compaction):
+        store_compaction, rows, num_commits = compaction
+        self.store.finish_compaction(store_compaction)
+        self.write_binary_snapshot(rows, num_commits)
 
-                # Skip first line, since it contains the header for each column
-                if first_line:
-                    continue
+    """
+    Commits any changes and compacts the store straight away.
+    """
+    def compact(self):
+        self.write_changes()
+        self.finish_compaction(self.start_compaction())
 
-                line = line.strip()
-                parts = line.split(ALLOC_DELIM)
-                if len(parts) != AllocAccount.num_fields():
-                    raise ValueError("Line in account allocation database was invalid. It should have had {} {}-separated elements, but had {}. Line looked like: {}".format(AllocAccount.num_fields(), ALLOC_DELIM, len(parts), line))
-                
-                # Note: this instantiation depends on the order of fields
-                # being the same in the db file and in the Account class
-                # constructor
-                acc = AllocAccount(*parts)
-                self.accounts.append(acc)
+    def get_store(self):
+        return self.store
 
     """
     If an unallocated account is found, marks it allocated and
@@ -499,24 +1008,56 @@ class AllocEngine:
     Always deallocates all accounts currently allocated to this client IP
     """
     def allocate_one_account(self, client_ip, client_username):
+        return self.allocate_batch([(client_ip, client_username)])[0]
 
-        if not validity.is_valid_ipaddr(client_ip):
-            raise ValueError("Client IP was not a valid IP address: {}".format(client_ip))
-
-        if not validity.is_valid_system_username(client_username):
-            raise ValueError("Client username was not a valid system username: {}".format(client_username))
-
-        # Release everything currently allocated to this client
-        for acc in self.accounts:
-            if acc.is_allocated() and acc.get_client_ip() == client_ip:
+    """
+    requests: a list of (client_ip, client_username) tuples
+    Does what allocate_one_account does for every client in the list,
+    with a single write of the allocation file at the end,
+    rather than one per client.
+    Returns a list the same length as requests, holding the account
+    allocated to each client, or None where no account was left.
+    Accounts are handed out in the order the clients are listed.
+    A client IP may appear in the list only once.
+    """
+    def allocate_batch(self, requests):
+        if not isinstance(requests, list):
+            raise TypeError("Must pass a list to allocate_batch. Instead, got a {}".format(type(requests)))
+
+        client_ips = set()
+        for request in requests:
+            if not isinstance(request, tuple) or len(request) != 2:
+                raise TypeError("Each request given to allocate_batch must be a (client_ip, client_username) tuple. Found {}".format(request))
+
+            client_ip, client_username = request
+            if not validity.is_valid_ipaddr(client_ip):
+                raise ValueError("Client IP was not a valid IP address: {}".format(client_ip))
+
+            if not validity.is_valid_system_username(client_username):
+                raise ValueError("Client username was not a valid system username: {}".format(client_username))
+
+            if client_ip in client_ips:
+                raise ValueError("Client IP {} appears more than once in the batch. Each client can only have one account".format(client_ip))
+            client_ips.add(client_ip)
+
+        # Release everything currently allocated to these clients
+        changed = False
+        for client_ip in client_ips:
+            for acc in self.get_accounts_ip(client_ip):
                 acc.release()
+                changed = True
 
-        for acc in self.accounts:
-            if not acc.is_allocated():
+        allocated = []
+        for client_ip, client_username in requests:
+            acc = self.take_free()
+            if acc != None:
                 acc.allocate(client_ip, client_username)
-                self.write_changes()
-                return acc
-        return None
+                changed = True
+            allocated.append(acc)
+
+        if changed:
+            self.autocommit_changes()
+        return allocated
 
     """
     Finds account by uuid
@@ -528,12 +1069,11 @@ class AllocEngine:
         if not validity.is_valid_minecraft_uuid(uuid):
             raise ValueError("Not a valid Minecraft uuid: {}".format(uuid))
 
-        to_release = [acc for acc in self.accounts\
-                if acc.is_allocated() and acc.get_mc_uuid() == uuid]
+        to_release = [acc for acc in self.get_accounts_uuid(uuid) if acc.is_allocated()]
 
         for acc in to_release:
             acc.release()
-        self.write_changes()
+        self.autocommit_changes()
 
     """
     Finds all accounts allocated to the given client IP
@@ -543,12 +1083,11 @@ class AllocEngine:
         if not validity.is_valid_ipaddr(client_ip):
             raise ValueError("Not a valid IP address: {}".format(client_ip))
 
-        to_release = [acc for acc in self.accounts \
-                if acc.is_allocated() and acc.get_client_ip() == client_ip]
+        to_release = self.get_accounts_ip(client_ip)
 
         for acc in to_release:
             acc.release()
-        self.write_changes()
+        self.autocommit_changes()
     
     """
     Finds an account (or all accounts if there are more than one) of a specific
@@ -565,13 +1104,10 @@ class AllocEngine:
         if not validity.is_valid_minecraft_uuid(uuid):
             raise ValueError("Not a valid Minecraft uuid: {}".format(uuid))
 
-        to_allocate = [acc for acc in self.accounts\
-                if acc.get_mc_uuid() == uuid]
-
-        for acc in to_allocate:
+        for acc in self.get_accounts_uuid(uuid):
             acc.allocate(client_ip, client_username)
 
-        self.write_changes()
+        self.autocommit_changes()
 
     """
     aat_list: a list of AccountAuthTokens instances.
@@ -593,9 +1129,11 @@ class AllocEngine:
             raise ValueError("create_db is intended to be called when no accounts were found in the allocation db file, but AllocEngine found {} accounts".format(len(self.accounts)))
 
         for aat in aat_list:
-            self.accounts.append(AllocAccount.create_from_aat("", "", "", aat))
+            acc = AllocAccount.create_from_aat("", "", "", aat)
+            acc.mark_changed()
+            self.add_account(acc)
 
-        self.write_changes()
+        self.compact()
 
 
     """
@@ -620,15 +1158,17 @@ class AllocEngine:
                 raise TypeError("The aat list given to extend_db must contain only AccountAuthTokens, but found a {}".format(type(elem)))
 
         for aat in aat_list:
-            self.accounts.append(AllocAccount.create_from_aat("", "", "", aat))
+            acc = AllocAccount.create_from_aat("", "", "", aat)
+            acc.mark_changed()
+            self.add_account(acc)
 
-        self.write_changes()
+        self.compact()
 
     """
     Releases all the accounts which are past their allocation timeout.
     """
     def release_expired(self):
-        for acc in self.accounts:
+        for acc in self.get_allocated_accounts():
             if acc.alloc_expired():
                 acc.release()
 
@@ -0,0 +1,220 @@
+import json
+import struct
+import asyncio
+
+# The framed protocol spoken between nydus-client and nydus-server.
+#
+# Every message, in either direction, is one frame:
+#   2 bytes   magic, always FRAME_MAGIC
+#   1 byte    protocol version of the sender
+#   4 bytes   length of the payload, big-endian
+#   payload   a JSON object, UTF-8 encoded
+#
+# Framing by length means the receiver knows exactly how much to read,
+# so it can read straight into one preallocated buffer rather than
+# gluing chunks of text together and searching them for a terminator.
+#
+# Version negotiation: a client sends its frames with the highest
+# version it speaks; the server answers with the lower of that and
+# its own, and both sides use that version from then on.
+# New fields can be added to payloads without a version bump, since
+# both sides ignore keys they don't recognise; the version only needs
+# to change if the meaning of an existing field does.
+#
+# The magic can't be mistaken for the start of an older plain text
+# message (REQUEST, SESSION, RELEASE, HEARTBEAT), so the server can
+# tell from the first two bytes which protocol a client is using.
+
+FRAME_MAGIC = b"NY"
+FRAME_HEADER = struct.Struct(">2sBI")
+
+PROTOCOL_VERSION = 1
+MIN_PROTOCOL_VERSION = 1
+
+# No legitimate message comes anywhere near this. It stops a
+# client from making us allocate memory by claiming a huge payload.
+MAX_PAYLOAD = 64 * 1024
+
+# A batch allocation reply carries a whole room's worth of accounts
+# and tokens, so it may be bigger. Only whoever sent the batch
+# request reads with this limit.
+BATCH_MAX_PAYLOAD = 1024 * 1024
+
+PAYLOAD_ENC = "utf-8"
+
+# Payload keys
+COMMAND_KEY = "cmd"
+USERNAME_KEY = "username"
+STATUS_KEY = "status"
+ERROR_KEY = "error"
+MC_VERSION_KEY = "mc_version"
+MC_USERNAME_KEY = "mc_username"
+MC_UUID_KEY = "mc_uuid"
+MC_TOKEN_KEY = "mc_token"
+CLIENT_IP_KEY = "client_ip"
+ALLOCATIONS_KEY = "allocations"
+RETRY_AFTER_KEY = "retry_after_ms"
+
+# Values for the status key of replies
+STATUS_OK = "ok"
+STATUS_ERROR = "error"
+# The server is too busy to take the request on; try again
+# after the number of milliseconds given under RETRY_AFTER_KEY
+STATUS_BUSY = "busy"
+
+
+class ProtocolError(Exception):
+    pass
+
+"""
+Raised by a client when the server answers with STATUS_BUSY.
+"""
+class ServerBusy(ProtocolError):
+
+    def __init__(self, message, retry_after_ms):
+        super().__init__(message)
+        self.retry_after_ms = retry_after_ms
+
+    def get_retry_after_ms(self):
+        return self.retry_after_ms
+
+
+"""
+Returns the version both ends should use, given the
+version the other end sent.
+Raises ProtocolError if the other end is too old to talk to.
+"""
+def negotiate_version(peer_version):
+    if peer_version < MIN_PROTOCOL_VERSION:
+        raise ProtocolError("Peer speaks protocol version {}, but the oldest supported is {}".format(peer_version, MIN_PROTOCOL_VERSION))
+    return min(peer_version, PROTOCOL_VERSION)
+
+"""
+message: a dictionary which can be encoded as JSON
+version: the protocol version to mark the frame with
+max_payload: the most payload bytes the receiver will accept
+Returns the complete frame as bytes, ready to send.
+"""
+def encode_frame(message, version=PROTOCOL_VERSION, max_payload=MAX_PAYLOAD):
+    if not isinstance(message, dict):
+        raise TypeError("Message to encode must be a dictionary. Was a {}".format(type(message)))
+
+    payload = json.dumps(message, separators=(",", ":")).encode(encoding=PAYLOAD_ENC)
+    if len(payload) > max_payload:
+        raise ProtocolError("Message payload is {} bytes, more than the maximum of {}".format(len(payload), max_payload))
+
+    return FRAME_HEADER.pack(FRAME_MAGIC, version, len(payload)) + payload
+
+"""
+header: exactly FRAME_HEADER.size bytes
+max_payload: the most payload bytes we're prepared to accept
+Returns (version, payload_length).
+Raises ProtocolError if it isn't a valid header.
+"""
+def decode_header(header, max_payload=MAX_PAYLOAD):
+    magic, version, length = FRAME_HEADER.unpack(header)
+
+    if magic != FRAME_MAGIC:
+        raise ProtocolError("Frame did not start with the expected magic bytes. Started with {}".format(bytes(magic)))
+
+    if length > max_payload:
+        raise ProtocolError("Frame claims a payload of {} bytes, more than the maximum of {}".format(length, max_payload))
+
+    return (version, length)
+
+"""
+payload: bytes-like object holding a whole payload
+Returns the message as a dictionary.
+Raises ProtocolError if it isn't a JSON object.
+"""
+def decode_payload(payload):
+    try:
+        message = json.loads(str(payload, encoding=PAYLOAD_ENC))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise ProtocolError("Frame payload was not valid JSON: {}".format(e))
+
+    if not isinstance(message, dict):
+        raise ProtocolError("Frame payload must be a JSON object. Was {}".format(type(message)))
+    return message
+
+
+"""
+Reads frames from a connection into one buffer which is allocated
+once and reused for every frame.
+"""
+class FrameReader:
+
+    """
+    recv_into: a function which, like socket.recv_into or
+        BufferedReader.readinto, fills as much of the memoryview it's
+        given as it can, returns how many bytes that was, and returns 0
+        when the connection has closed.
+    max_payload: the largest payload to accept, which is also how
+        big the buffer is made
+    """
+    def __init__(self, recv_into, max_payload=MAX_PAYLOAD):
+        self.recv_into = recv_into
+        self.max_payload = max_payload
+        self.buffer = bytearray(FRAME_HEADER.size + max_payload)
+        self.view = memoryview(self.buffer)
+
+    """
+    Fills view completely.
+    Returns False if the connection closed before anything was read,
+    raises ProtocolError if it closed part way through.
+    """
+    def fill(self, view):
+        filled = 0
+        while filled < len(view):
+            count = self.recv_into(view[filled:])
+            if count == 0:
+                if filled == 0:
+                    return False
+                raise ProtocolError("Connection closed part way through a frame")
+            filled += count
+        return True
+
+    """
+    prefix: bytes of this frame which the caller has already read
+        (for instance to find out whether the peer speaks this protocol)
+    Returns (version, message), or None if the connection was closed
+    cleanly before a new frame started.
+    """
+    def read_frame(self, prefix=b""):
+        header_size = FRAME_HEADER.size
+        if len(prefix) > header_size:
+            raise ValueError("Prefix given to read_frame must be no longer than the frame header")
+        self.view[:len(prefix)] = prefix
+
+        if not self.fill(self.view[len(prefix):header_size]):
+            if len(prefix) == 0:
+                return None
+            raise ProtocolError("Connection closed part way through a frame")
+        version, length = decode_header(self.view[:header_size], self.max_payload)
+
+        payload = self.view[header_size:header_size + length]
+        if not self.fill(payload):
+            raise ProtocolError("Connection closed part way through a frame")
+        return (version, decode_payload(payload))
+
+
+"""
+The asyncio equivalent of FrameReader.read_frame.
+reader: an asyncio.StreamReader
+Returns (version, message), or None if the connection was
+closed cleanly before a new frame started.
+"""
+async def async_read_frame(reader, prefix=b""):
+    try:
+        header = prefix + await reader.readexactly(FRAME_HEADER.size - len(prefix))
+    except asyncio.IncompleteReadError as e:
+        if len(e.partial) == 0 and len(prefix) == 0:
+            return None
+        raise ProtocolError("Connection closed part way through a frame")
+    version, length = decode_header(header)
+
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError("Connection closed part way through a frame")
+    return (version, decode_payload(payload))
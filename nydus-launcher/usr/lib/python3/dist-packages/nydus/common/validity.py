@@ -27,7 +27,7 @@ def is_valid_file(filename):
 
     if os.path.isfile(filename):
         try:
-            with open(fname, "r") as f:
+            with open(filename, "r") as f:
                 pass
         except PermissionError:
             return False
@@ -349,7 +349,7 @@ and the values are default values for those parameters.
 def is_valid_defconfig(defconfig):
     if not isinstance(defconfig, dict):
         return False
-    if not is_valid_parnames(defconfig.keys()):
+    if not is_valid_parnames(list(defconfig.keys())):
         return False
     for k in defconfig:
         if not isinstance(defconfig[k], str):
@@ -365,7 +365,7 @@ It must be
 3) not overlap with any existing Nydus Config class attributes
 """
 def is_valid_varname(varname):
-    if not isinstance(varrname, str):
+    if not isinstance(varname, str):
         return False
     if not varname.isidentifier():
         return False
@@ -384,7 +384,7 @@ That is, the value must be a valid python identifier.
 def is_valid_varnames(varnames):
     if not isinstance(varnames, dict):
         return False
-    if not is_valid_parnames(varnames.keys()):
+    if not is_valid_parnames(list(varnames.keys())):
         return False
     for k in varnames:
         attrname = varnames[k]
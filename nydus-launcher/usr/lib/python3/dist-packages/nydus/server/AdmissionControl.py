@@ -0,0 +1,128 @@
+import math
+import time
+import threading
+
+# Decides whether nydus-server takes on a client's request right now,
+# or turns it away at once with a "busy, try again in N ms" reply.
+# Turning requests away quickly is much cheaper for everyone than
+# letting them pile up waiting for the allocation database lock.
+#
+# Two limits apply:
+# - Each client IP has a token bucket. It holds up to burst tokens and
+#   refills at rate tokens per second; every request takes one. A client
+#   stuck in a retry loop soon empties its bucket and is then held to
+#   the refill rate, without affecting anyone else.
+# - Across all clients, at most max_in_flight requests are worked on
+#   at once. Beyond that, requests are shed rather than queued.
+#
+# In pre-fork mode each worker process has its own AdmissionControl,
+# so the limits apply per worker.
+
+# How long a request shed by the global ceiling is told to wait.
+# Not derived from anything: long enough for a few requests to finish,
+# short enough that a retrying client isn't noticeably held up.
+CEILING_RETRY_MS = 200
+
+# How often to forget clients whose buckets have refilled completely.
+# A full bucket is the same as no bucket, so nothing is lost.
+PRUNE_PERIOD = 60
+
+class AdmissionControl:
+
+    """
+    rate: tokens added to each client's bucket per second
+    burst: the most tokens a bucket holds; how many requests a
+        client can make in quick succession after being idle
+    max_in_flight: the most requests worked on at once
+    """
+    def __init__(self, rate, burst, max_in_flight):
+        if not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError("Token bucket rate must be a positive number. Was {}".format(rate))
+
+        if not isinstance(burst, int) or burst < 1:
+            raise ValueError("Token bucket burst must be a positive integer. Was {}".format(burst))
+
+        if not isinstance(max_in_flight, int) or max_in_flight < 1:
+            raise ValueError("Maximum requests in flight must be a positive integer. Was {}".format(max_in_flight))
+
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+
+        # client_ip -> (tokens, time tokens was last brought up to date)
+        self.buckets = {}
+        self.in_flight = 0
+        self.last_prune = self.now()
+        self.lock = threading.Lock()
+
+    def now(self):
+        return time.monotonic()
+
+    """
+    Must be called holding self.lock.
+    Returns how many tokens client_ip's bucket holds at time now.
+    """
+    def tokens(self, client_ip, now):
+        bucket = self.buckets.get(client_ip)
+        if bucket == None:
+            return self.burst
+        tokens, then = bucket
+        return min(self.burst, tokens + (now - then) * self.rate)
+
+    """
+    Must be called holding self.lock.
+    """
+    def prune(self, now):
+        full = [client_ip for client_ip in self.buckets
+                if self.tokens(client_ip, now) >= self.burst]
+        for client_ip in full:
+            del self.buckets[client_ip]
+        self.last_prune = now
+
+    """
+    Asks to start work on a request from client_ip.
+    Returns None if it may go ahead, in which case done must be
+    called when the work is finished.
+    Otherwise returns how many milliseconds the client should wait
+    before trying again.
+    """
+    def admit(self, client_ip):
+        with self.lock:
+            now = self.now()
+            if now - self.last_prune > PRUNE_PERIOD:
+                self.prune(now)
+
+            tokens = self.tokens(client_ip, now)
+            if tokens < 1:
+                # Time until the bucket has a whole token again
+                return math.ceil((1 - tokens) / self.rate * 1000)
+
+            if self.in_flight >= self.max_in_flight:
+                # Shed without charging the client a token;
+                # it's not the one misbehaving
+                return CEILING_RETRY_MS
+
+            self.buckets[client_ip] = (tokens - 1, now)
+            self.in_flight += 1
+            return None
+
+    """
+    Call once for each admit which returned None,
+    when that request has been dealt with.
+    """
+    def done(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def num_in_flight(self):
+        with self.lock:
+            return self.in_flight
+
+    def get_rate(self):
+        return self.rate
+
+    def get_burst(self):
+        return self.burst
+
+    def get_max_in_flight(self):
+        return self.max_in_flight
@@ -0,0 +1,317 @@
+import threading
+import ipaddress
+from nydus.common import validity
+from nydus.common.ReadSnapshot import rows_to_parts
+
+# Splits the Minecraft accounts into pools, each serving the clients in
+# one subnet (a lab, say), so that one lab's burst of logins doesn't
+# queue behind another's. Each pool has its own allocation file and its
+# own AllocService, with its own lock, group commits and journals; so
+# allocations in different pools never wait for each other, and each
+# commit only writes the accounts of one pool.
+#
+# The pools are listed in the file given by the PoolsFile setting, one
+# per line, each line being whitespace-separated:
+#   <subnet> <allocation file> <accounts file> [Minecraft version]
+# for instance
+#   10.1.0.0/16 /var/lib/nydus/lab1-alloc.csv /etc/nydus/lab1-usernames.txt 1.20.6
+# Blank lines and lines starting with # are ignored. A client is served
+# by the pool with the most specific subnet containing its IP address;
+# clients in none of them by the default pool, which is the AllocFile
+# and AccountsFile settings, as when there are no pools.
+# A pool without a Minecraft version launches McVersion.
+
+POOL_COMMENT = "#"
+
+"""
+One pool of accounts.
+"""
+class AllocPool:
+
+    """
+    subnet: the clients it serves, as a string such as "10.1.0.0/16",
+        or None for the default pool
+    alloc_file: its allocation file
+    accounts_file: the Microsoft usernames of its accounts
+    mc_version: the Minecraft version its clients launch, or None
+        for the default pool's
+    """
+    def __init__(self, subnet, alloc_file, accounts_file, mc_version=None):
+        if subnet == None:
+            self.subnet = None
+        else:
+            try:
+                self.subnet = ipaddress.IPv4Network(subnet)
+            except ValueError as e:
+                raise ValueError("Account pool's subnet must be an IPv4 network address and prefix length, such as 10.1.0.0/16. Was {}: {}".format(subnet, e))
+
+        if not isinstance(alloc_file, str) or not isinstance(accounts_file, str):
+            raise TypeError("Account pool's allocation file and accounts file must be paths, as strings. Were {} and {}".format(alloc_file, accounts_file))
+
+        if mc_version != None and not validity.is_valid_minecraft_version(mc_version):
+            raise ValueError("Account pool's Minecraft version was not a valid Minecraft version: {}".format(mc_version))
+
+        self.alloc_file = alloc_file
+        self.accounts_file = accounts_file
+        self.mc_version = mc_version
+
+    """
+    Whether the pool serves client_ip, an ipaddress.IPv4Address.
+    The default pool serves nobody in particular.
+    """
+    def contains(self, client_ip):
+        return self.subnet != None and client_ip in self.subnet
+
+    def get_subnet(self):
+        return self.subnet
+
+    def get_alloc_file(self):
+        return self.alloc_file
+
+    def get_accounts_file(self):
+        return self.accounts_file
+
+    def get_mc_version(self):
+        return self.mc_version
+
+    def __repr__(self):
+        if self.subnet == None:
+            return "default pool ({})".format(self.alloc_file)
+        return "pool {} ({})".format(self.subnet, self.alloc_file)
+
+
+"""
+Reads the pools listed in the file at path, in the format described
+at the top of this module.
+Returns a list of AllocPools, in the order they're listed.
+Raises ValueError if a line isn't in that format.
+"""
+def read_pools_file(path):
+    pools = []
+    with open(path, "r") as f:
+        for nline, line in enumerate(f, 1):
+            line = line.strip()
+            if line == "" or line.startswith(POOL_COMMENT):
+                continue
+
+            parts = line.split()
+            if len(parts) not in (3, 4):
+                raise ValueError("Line {} of account pools file {} should be a subnet, an allocation file, an accounts file and optionally a Minecraft version, separated by whitespace. Was '{}'".format(nline, path, line))
+            try:
+                pools.append(AllocPool(*parts))
+            except ValueError as e:
+                raise ValueError("Line {} of account pools file {}: {}".format(nline, path, e))
+    return pools
+
+
+"""
+Every pool, and which of them serves each client.
+"""
+class AllocPools:
+
+    """
+    default_pool: the AllocPool for clients in none of the others' subnets
+    pools: a list of AllocPools, each with a subnet
+    """
+    def __init__(self, default_pool, pools=[]):
+        alloc_files = set([default_pool.get_alloc_file()])
+        subnets = set()
+        for pool in pools:
+            if pool.get_subnet() == None:
+                raise ValueError("Only the default account pool may be without a subnet")
+            if pool.get_subnet() in subnets:
+                raise ValueError("Two account pools were given the same subnet, {}".format(pool.get_subnet()))
+            if pool.get_alloc_file() in alloc_files:
+                raise ValueError("Two account pools were given the same allocation file, {}. Each pool must have its own".format(pool.get_alloc_file()))
+            subnets.add(pool.get_subnet())
+            alloc_files.add(pool.get_alloc_file())
+
+        self.default_pool = default_pool
+
+        # The most specific subnets first, so the
+        # first which contains a client is the one
+        self.pools = sorted(pools, key=lambda pool: pool.get_subnet().prefixlen, reverse=True)
+
+    """
+    The default pool is made of alloc_file, accounts_file and mc_version.
+    pools_file: the file listing the other pools, or "" if there are none
+    """
+    def read(alloc_file, accounts_file, mc_version, pools_file):
+        pools = []
+        if pools_file != "":
+            pools = read_pools_file(pools_file)
+        return AllocPools(AllocPool(None, alloc_file, accounts_file, mc_version), pools)
+
+    """
+    The pool serving client_ip, given as a string.
+    Raises ValueError if it isn't an IPv4 address.
+    """
+    def find(self, client_ip):
+        try:
+            address = ipaddress.IPv4Address(client_ip)
+        except ValueError:
+            raise ValueError("Client IP was not a valid IP address: {}".format(client_ip))
+
+        for pool in self.pools:
+            if pool.contains(address):
+                return pool
+        return self.default_pool
+
+    """
+    The Minecraft version the client at client_ip should launch.
+    """
+    def get_mc_version(self, client_ip):
+        mc_version = self.find(client_ip).get_mc_version()
+        if mc_version == None:
+            return self.default_pool.get_mc_version()
+        return mc_version
+
+    """
+    Whether there are any pools besides the default.
+    """
+    def is_pooled(self):
+        return len(self.pools) > 0
+
+    """
+    Every pool, the default first.
+    """
+    def get_pools(self):
+        return [self.default_pool] + self.pools
+
+    def get_default_pool(self):
+        return self.default_pool
+
+
+"""
+Stands in for one AllocService when the accounts are split into pools,
+with the same methods, passing each request on to the AllocService of
+the pool serving the client it's for.
+"""
+class PooledAllocService:
+
+    """
+    pools: the AllocPools
+    services: dictionary from each of the AllocPools' pools to the
+        AllocService of its accounts
+    """
+    def __init__(self, pools, services):
+        if set(services.keys()) != set(pools.get_pools()):
+            raise ValueError("Every account pool must have an AllocService, and nothing else. Pools were {}; services were given for {}".format(pools.get_pools(), list(services.keys())))
+
+        self.pools = pools
+        self.services = services
+
+    def service_for(self, client_ip):
+        return self.services[self.pools.find(client_ip)]
+
+    def allocate(self, client_ip, client_username, lease_time=None):
+        return self.service_for(client_ip).allocate(client_ip, client_username, lease_time)
+
+    """
+    Each pool allocates to its own clients in one go; the
+    results are put back in the order of requests.
+    """
+    def allocate_batch(self, requests, lease_time=None):
+        by_service = {}
+        for n, (client_ip, client_username) in enumerate(requests):
+            by_service.setdefault(self.service_for(client_ip), []).append(n)
+
+        mc_accounts = [None] * len(requests)
+        for service, positions in by_service.items():
+            results = service.allocate_batch([requests[n] for n in positions], lease_time)
+            for n, mc_account in zip(positions, results):
+                mc_accounts[n] = mc_account
+        return mc_accounts
+
+    def release(self, client_ip):
+        self.service_for(client_ip).release(client_ip)
+
+    def renew(self, client_ip):
+        return self.service_for(client_ip).renew(client_ip)
+
+    """
+    The account must be in the client's own pool, or
+    releasing the client later wouldn't find it.
+    """
+    def allocate_uuid(self, uuid, client_ip, client_username):
+        pool = self.pools.find(client_ip)
+        service = self.services[pool]
+        if not service.has_account(uuid):
+            raise ValueError("Minecraft account {} isn't in the {} which serves {}".format(uuid, pool, client_ip))
+        service.allocate_uuid(uuid, client_ip, client_username)
+
+    def release_uuid(self, uuid):
+        for service in self.get_services():
+            if service.has_account(uuid):
+                service.release_uuid(uuid)
+
+    """
+    Each pool's accounts, under a line naming the pool,
+    a piece at a time as AllocService.view gives them.
+    """
+    def view(self):
+        for n, pool in enumerate(self.pools.get_pools()):
+            yield "{}# {}\n".format("\n" if n > 0 else "", pool)
+            yield from self.services[pool].view()
+
+    def view_uuid(self, uuid):
+        return rows_to_parts([row for service in self.get_services()
+                for row in service.get_read_snapshot().find_uuid(uuid)])
+
+    def view_ip(self, client_ip):
+        return self.service_for(client_ip).view_ip(client_ip)
+
+    """
+    Maintains each pool in turn.
+    Returns a list of what function returned for each.
+    """
+    def maintain(self, function, *args):
+        return [service.maintain(function, *args) for service in self.get_services()]
+
+    """
+    Like AllocService.reap_leases, for every pool, each
+    on a thread of its own. Never returns.
+    """
+    def reap_leases(self):
+        self.run_for_each(lambda service: service.reap_leases)
+
+    """
+    Like AllocService.compact_journals, for every pool, each
+    on a thread of its own. Never returns.
+    """
+    def compact_journals(self):
+        self.run_for_each(lambda service: service.compact_journals)
+
+    """
+    Runs method(service)() for every service but the first on a new
+    thread, and for the first on this one.
+    """
+    def run_for_each(self, method):
+        services = self.get_services()
+        for service in services[1:]:
+            pt = threading.Thread(target=method(service))
+            pt.start()
+        method(services[0])()
+
+    def shutdown(self):
+        for service in self.get_services():
+            service.shutdown()
+
+    def promote(self):
+        return any([service.promote() for service in self.get_services()])
+
+    def wait_promoted(self):
+        for service in self.get_services():
+            service.wait_promoted()
+
+    def is_standby(self):
+        return any(service.is_standby() for service in self.get_services())
+
+    """
+    Every pool's AllocService, the default pool's first.
+    """
+    def get_services(self):
+        return [self.services[pool] for pool in self.pools.get_pools()]
+
+    def get_pools(self):
+        return self.pools
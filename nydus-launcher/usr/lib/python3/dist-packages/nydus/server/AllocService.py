@@ -0,0 +1,524 @@
+import time
+import datetime
+import threading
+from nydus.common.allocater import AllocEngine, ALLOC_TIMEOUT
+from nydus.common.AllocStore import CSV_BACKEND
+from nydus.common.AllocPolicy import DEFAULT_ALLOC_POLICY
+from nydus.common.ReadSnapshot import rows_to_parts
+from nydus.common.MCAccount import MCAccount
+from nydus.common.StripedLock import StripedLock
+from nydus.server.LeaseTable import LeaseTable
+from nydus.server.SingleFlight import SingleFlight
+from nydus.server.GroupCommit import GroupCommit
+
+# How long allocations made by hand through nydus-cli last
+MANUAL_LEASE_TIME = ALLOC_TIMEOUT.total_seconds()
+
+# Fold an allocation journal into the file it follows once it's grown
+# this big. Each compaction rewrites that file for every account, so it
+# shouldn't happen often; but the journal is replayed in full at
+# startup, so it shouldn't grow too long either.
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+# Seconds between checks of the journal's size
+JOURNAL_CHECK_PERIOD = 60
+
+# The allocation operations nydus-server performs on behalf of clients,
+# gathered behind one object so that the code talking to clients
+# doesn't need to know where the allocation state actually lives.
+# AllocService does the work itself in this process. ControlClient
+# (see the ControlSocket module) has the same methods and forwards
+# them to the process which owns the AllocService.
+#
+# The AllocService keeps one AllocEngine for as long as it lives, and
+# that engine's accounts are the allocation state. The allocation files
+# and their journals are only written, so the state survives a restart;
+# they're read once, at startup. So nothing else may change them while
+# nydus-server runs.
+# nydus-cli sends its changes here over the control socket instead,
+# and the periodic cleanup works on this engine through maintain.
+#
+# Each allocation is held on a lease (see the LeaseTable module).
+# Run reap_leases on its own thread and accounts are released as soon
+# as their leases run out, rather than at the next periodic cleanup.
+# Run compact_journals on another and the journals are kept short.
+# Call shutdown when stopping and the next start is quicker.
+#
+# A standby AllocService (see the Replication module) makes no changes
+# of its own. It only applies those a primary's service sends it, given
+# to replicate, until it's promoted; then it works like any other. The
+# primary's service hands each of its commits to subscribe's listeners.
+#
+# Changes are made in memory holding the lock, then committed after
+# letting go of it, in groups (see the GroupCommit module). Every method
+# which changes anything waits for its change to be committed before
+# returning, so a client is only ever told about an allocation once
+# it's on disk.
+#
+# The lock is only ever held briefly. The periodic cleanup, which renews
+# tokens over the network and can take minutes, takes it a little at a
+# time rather than for the whole cleanup, so clients can be allocated
+# accounts while it runs; see maintain.
+#
+# A client asking for an account twice over (a double click, or a retry
+# after a timeout) gets the same account both times. Requests from the
+# same client IP and username that arrive while the first is still being
+# dealt with wait for it and share its result. Requests arriving within
+# retry_window seconds of it get the account it was given, without the
+# allocation file being loaded or written.
+
+class AllocService:
+
+    """
+    alloc_file: path to the account allocation database file
+    lock: the threading.Lock guarding that file. It's passed in rather
+        than created here because the periodic cleanup needs the same lock.
+    lease_time: seconds an allocation lasts unless renewed,
+        when allocate isn't told otherwise
+    retry_window: seconds after an allocation during which the same
+        client asking again is given the same account
+    alloc_backend: which kind of AllocStore the file is
+    commit_window: seconds to hold each group commit open for more
+        changes to join it
+    standby: whether this service copies a primary's until promoted
+    alloc_policy: which free account each allocation is given; one
+        of AllocPolicy.ALLOC_POLICIES
+    Accounts already allocated in the file are given leases which
+    end when their allocation would have timed out.
+    """
+    def __init__(self, alloc_file, lock, lease_time, retry_window, alloc_backend=CSV_BACKEND, commit_window=0, standby=False, alloc_policy=DEFAULT_ALLOC_POLICY):
+        if not isinstance(alloc_file, str):
+            raise TypeError("Path to accounts database file must be a string. Was {}".format(alloc_file))
+
+        if not isinstance(lock, type(threading.Lock())):
+            raise TypeError("AllocService must be given a threading.Lock. Was given a {}".format(type(lock)))
+
+        if not isinstance(retry_window, (int, float)) or retry_window < 0:
+            raise ValueError("Retry window must be a non-negative number of seconds. Was {}".format(retry_window))
+
+        self.alloc_file = alloc_file
+        self.lock = lock
+        self.leases = LeaseTable(lease_time)
+        self.retry_window = retry_window
+        self.single_flight = SingleFlight()
+
+        # Held while an account's tokens are being renewed,
+        # keyed by the account's Minecraft uuid
+        self.account_locks = StripedLock()
+
+        # Whether a compaction is under way. Guarded by self.lock.
+        self.compacting = False
+
+        # client_ip -> (client_username, MCAccount, time.monotonic() when allocated)
+        # for every client allocated an account since this service started.
+        # Guarded by self.lock.
+        self.recent = {}
+
+        # Whether this is a standby which hasn't been promoted yet.
+        # Guarded by self.lock. promoted is set once it's not.
+        self.standby = standby
+        self.promoted = threading.Event()
+        if not standby:
+            self.promoted.set()
+
+        # The StandbyReplica feeding a standby its primary's changes
+        self.replica = None
+
+        with self.lock:
+            self.engine = AllocEngine(self.alloc_file, alloc_backend, alloc_policy)
+            self.engine.set_autocommit(False)
+            if not standby:
+                self.grant_leases()
+
+        self.group_commit = GroupCommit(self.engine, self.lock, commit_window)
+
+    """
+    Must be called holding self.lock.
+    Gives every allocated account a lease which ends when its
+    allocation would have timed out.
+    """
+    def grant_leases(self):
+        now = datetime.datetime.now()
+        for acc in self.engine.get_allocated_accounts():
+            remaining = acc.get_alloc_time() + ALLOC_TIMEOUT - now
+            self.leases.grant(acc.get_client_ip(), max(remaining.total_seconds(), 0))
+
+    """
+    Allocates a Minecraft account to the given client IP and system username.
+    lease_time: seconds until the allocation is released unless renewed.
+        Defaults to the service's lease time.
+    Returns an MCAccount holding the details the client needs,
+    or None if no account was free.
+    """
+    def allocate(self, client_ip, client_username, lease_time=None):
+        return self.single_flight.do((client_ip, client_username),
+                self.allocate_once, client_ip, client_username, lease_time)
+
+    """
+    Does the work of allocate, for one of any number
+    of identical requests arriving together.
+    """
+    def allocate_once(self, client_ip, client_username, lease_time):
+        with self.lock:
+            mc_account = self.recent_allocation(client_ip, client_username)
+            if mc_account != None:
+                # The first request's allocation may still be
+                # waiting to be committed, so this waits too
+                self.leases.grant(client_ip, lease_time)
+            else:
+                acc = self.engine.allocate_one_account(client_ip, client_username)
+                mc_account = self.record_allocation(client_ip, client_username, acc, lease_time)
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+        return mc_account
+
+    """
+    Must be called holding self.lock.
+    Returns the MCAccount allocated to this client IP and username
+    within the retry window, if it still holds it. Otherwise None.
+    """
+    def recent_allocation(self, client_ip, client_username):
+        recent = self.recent.get(client_ip)
+        if recent == None:
+            return None
+
+        recent_username, mc_account, allocated_at = recent
+        if recent_username != client_username:
+            return None
+        if time.monotonic() - allocated_at > self.retry_window:
+            return None
+        if not self.leases.has_lease(client_ip):
+            return None
+        return mc_account
+
+    """
+    requests: a list of (client_ip, client_username) tuples
+    Allocates an account to every client in the list under one hold
+    of the lock, writing the allocation file once.
+    Returns a list of MCAccounts in the same order as requests,
+    with None for any client left without an account.
+    """
+    def allocate_batch(self, requests, lease_time=None):
+        with self.lock:
+            accs = self.engine.allocate_batch(requests)
+            mc_accounts = [self.record_allocation(client_ip, client_username, acc, lease_time)
+                    for (client_ip, client_username), acc in zip(requests, accs)]
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+        return mc_accounts
+
+    """
+    Releases all accounts allocated to the given client IP.
+    """
+    def release(self, client_ip):
+        with self.lock:
+            self.engine.release_account_ip(client_ip)
+            self.leases.revoke(client_ip)
+            self.recent.pop(client_ip, None)
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+
+    """
+    Allocates the account with the given Minecraft uuid to the client,
+    whatever it was doing before. For nydus-cli.
+    """
+    def allocate_uuid(self, uuid, client_ip, client_username):
+        with self.lock:
+            self.engine.allocate_uuid(uuid, client_ip, client_username)
+            self.leases.grant(client_ip, MANUAL_LEASE_TIME)
+            self.sync_leases()
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+
+    """
+    Releases the account with the given Minecraft uuid. For nydus-cli.
+    """
+    def release_uuid(self, uuid):
+        with self.lock:
+            self.engine.release_account_uuid(uuid)
+            self.sync_leases()
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+
+    """
+    Runs function(*args, engine, lock, account_locks), for work such as
+    the periodic cleanup which goes over every account and may take a
+    long time. It's called without holding the lock; it must take the
+    lock itself whenever it reads or changes the engine, and should let
+    go of it while doing anything slow. An account's lock, from
+    account_locks, should be held while renewing the account's tokens.
+    Whatever it releases loses its lease. Returns what function returns.
+    """
+    def maintain(self, function, *args):
+        try:
+            result = function(*args, self.engine, self.lock, self.account_locks)
+        finally:
+            with self.lock:
+                self.sync_leases()
+                commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+        return result
+
+    """
+    Must be called holding self.lock.
+    Drops the lease and the remembered allocation of every client IP
+    which no longer has an account, after something other than
+    release or expiry has released accounts.
+    """
+    def sync_leases(self):
+        allocated_ips = set(acc.get_client_ip() for acc in self.engine.get_allocated_accounts())
+        for client_ip in list(self.recent.keys()):
+            if client_ip not in allocated_ips:
+                del self.recent[client_ip]
+        for client_ip in self.leases.get_client_ips():
+            if client_ip not in allocated_ips:
+                self.leases.revoke(client_ip)
+
+    """
+    Must be called holding self.lock.
+    Allocating to a client releases whatever it had before, so its
+    old lease goes too; it gets a new one only if it got an account.
+    acc: the AllocAccount the engine allocated, or None
+    Returns the MCAccount to give the client, or None.
+    """
+    def record_allocation(self, client_ip, client_username, acc, lease_time):
+        if acc == None:
+            self.leases.revoke(client_ip)
+            self.recent.pop(client_ip, None)
+            return None
+
+        mc_account = AllocService.to_mc_account(acc)
+        self.leases.grant(client_ip, lease_time)
+        self.recent[client_ip] = (client_username, mc_account, time.monotonic())
+        return mc_account
+
+    """
+    Extends the lease on whatever the client IP has been allocated.
+    Returns False if it has no lease, meaning its lease already ran
+    out and its account has been (or is about to be) released.
+    """
+    def renew(self, client_ip):
+        return self.leases.renew(client_ip)
+
+    """
+    Releases the client IP's accounts because its lease ran out.
+    Does nothing if it's been given a new lease since; that happens if
+    it asked for an account again just as the old lease expired.
+    """
+    def expire(self, client_ip):
+        with self.lock:
+            if self.leases.has_lease(client_ip):
+                return
+            self.engine.release_account_ip(client_ip)
+            self.recent.pop(client_ip, None)
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+
+    """
+    Releases accounts as their leases run out. Never returns,
+    so run it on its own thread.
+    """
+    def reap_leases(self):
+        while True:
+            for client_ip in self.leases.wait_expired():
+                try:
+                    self.expire(client_ip)
+                except Exception as e:
+                    print("Failed to release expired allocation for client {}: {}".format(client_ip, e))
+
+    """
+    Folds the allocation journals into the files they follow.
+    Only the journals' rotation happens under the lock (and waits for
+    any commit being written to finish); the slow part,
+    writing out every account, doesn't hold up allocations.
+    min_size: only journals at least this many bytes long are folded in
+    Does nothing if another compaction is already under way.
+    """
+    def compact_journal(self, min_size=0):
+        with self.lock:
+            if self.compacting:
+                return
+            self.compacting = True
+            try:
+                with self.group_commit.get_write_lock():
+                    snapshot = self.engine.start_compaction(min_size)
+            except Exception:
+                self.compacting = False
+                raise
+
+        try:
+            self.engine.finish_compaction(snapshot)
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    """
+    Compacts each journal whenever it grows past JOURNAL_COMPACT_SIZE.
+    Never returns, so run it on its own thread.
+    """
+    def compact_journals(self):
+        while True:
+            if self.engine.get_store().get_journal_size() >= JOURNAL_COMPACT_SIZE:
+                try:
+                    self.compact_journal(JOURNAL_COMPACT_SIZE)
+                except Exception as e:
+                    print("Failed to compact allocation journal: {}".format(e))
+            time.sleep(JOURNAL_CHECK_PERIOD)
+
+    """
+    Commits whatever hasn't been committed, and writes a binary snapshot
+    of the accounts so the next startup can load that rather than the
+    store. Called when nydus-server is stopping, so it holds the lock
+    throughout rather than keeping allocations waiting as little as
+    it can.
+    """
+    def shutdown(self):
+        with self.lock:
+            with self.group_commit.get_write_lock():
+                self.engine.write_changes()
+                self.engine.save_binary_snapshot()
+
+    """
+    listener: called with the changes from every commit from now on
+        (see AllocEngine.add_commit_listener). It mustn't block.
+    Returns the fields of every account as they are now, which with
+    those changes make up everything a standby needs. Changes which
+    haven't been committed yet are in both, and applying them
+    twice does no harm.
+    """
+    def subscribe(self, listener):
+        with self.lock:
+            with self.group_commit.get_write_lock():
+                self.engine.add_commit_listener(listener)
+                return [acc.to_fields() for acc in self.engine.get_accounts()]
+
+    """
+    Closes the allocation store's files. The service
+    mustn't be used afterwards.
+    """
+    def close(self):
+        with self.lock:
+            with self.group_commit.get_write_lock():
+                self.engine.get_store().close()
+
+    def unsubscribe(self, listener):
+        with self.group_commit.get_write_lock():
+            self.engine.remove_commit_listener(listener)
+
+    """
+    Applies changes a primary committed, or the fields of its accounts
+    from subscribe given as changes, and commits them here.
+    Raises ValueError once this service has been promoted, since its
+    own allocations would then be overwritten.
+    """
+    def replicate(self, changes):
+        with self.lock:
+            if not self.standby:
+                raise ValueError("Can't apply replicated changes to the allocation state once it's been promoted from a standby")
+            self.engine.replicate(changes)
+            commit = self.group_commit.changed()
+
+        self.group_commit.wait_durable(commit)
+
+    """
+    Makes a standby a primary, straight away: every account is already
+    in memory, so all that's left is to stop following the old primary
+    and give the allocated accounts their leases. Clients are served
+    from then on. Returns False if it was already a primary.
+    """
+    def promote(self):
+        if self.replica != None:
+            self.replica.stop()
+
+        with self.lock:
+            if not self.standby:
+                return False
+            self.standby = False
+            self.grant_leases()
+        self.promoted.set()
+        return True
+
+    """
+    Returns once this service is a primary, so
+    straight away unless it's an unpromoted standby.
+    """
+    def wait_promoted(self):
+        self.promoted.wait()
+
+    def is_standby(self):
+        return not self.promoted.is_set()
+
+    def set_replica(self, replica):
+        self.replica = replica
+
+    def get_replica(self):
+        return self.replica
+
+    """
+    Whether there's an account with Minecraft uuid uuid.
+    """
+    def has_account(self, uuid):
+        with self.lock:
+            return len(self.engine.get_accounts_uuid(uuid)) > 0
+
+    def num_accounts(self):
+        with self.lock:
+            return self.engine.num_total_accounts()
+
+    """
+    The accounts as of the last commit, as a ReadSnapshot. Doesn't
+    take the lock: the views below never wait for an allocation to
+    finish, nor make one wait for them.
+    """
+    def get_read_snapshot(self):
+        return self.engine.get_read_snapshot()
+
+    """
+    Every account, as nydus-cli's view command prints them. Like
+    the other views, returns an iterator of the text a piece at a
+    time (see ReadSnapshot.rows_to_parts), read from the snapshot
+    current when it's called; so a view of a great many accounts is
+    never held as one string, here or on its way to nydus-cli.
+    """
+    def view(self):
+        return rows_to_parts(self.get_read_snapshot().iter_rows())
+
+    def view_uuid(self, uuid):
+        return rows_to_parts(self.get_read_snapshot().find_uuid(uuid))
+
+    def view_ip(self, client_ip):
+        return rows_to_parts(self.get_read_snapshot().find_ip(client_ip))
+
+    """
+    Copies out the details a client needs from an AllocAccount,
+    so nothing outside the lock holds on to the engine's objects.
+    """
+    def to_mc_account(acc):
+        if acc == None:
+            return None
+        return MCAccount(acc.get_mc_username(), acc.get_mc_uuid(), acc.get_mc_token())
+
+    def get_alloc_file(self):
+        return self.alloc_file
+
+    def get_lock(self):
+        return self.lock
+
+    def get_account_locks(self):
+        return self.account_locks
+
+    def get_leases(self):
+        return self.leases
+
+    def get_retry_window(self):
+        return self.retry_window
+
+    def get_group_commit(self):
+        return self.group_commit
@@ -0,0 +1,313 @@
+import os
+import json
+import socket
+import threading
+from nydus.common.MCAccount import MCAccount
+
+# A local Unix socket through which other processes on the server
+# machine can ask the process owning the allocation state to do
+# allocation operations for them.
+# When nydus-server runs several worker processes, the workers handle
+# the clients' connections but all allocation decisions go through
+# here, to the one process which owns the AllocService. That keeps
+# allocation serialized no matter how many workers there are.
+# nydus-cli also makes its changes through here while the server is
+# running, since the server holds the allocation state in memory.
+
+# Each message, in either direction, is one line of JSON.
+# Requests look like {"op": "allocate", "args": ["192.168.1.20", "someuser"]}
+# Replies look like {"result": ...} or {"error": "description"}
+# The views, which can hold every account, are sent as a line
+# {"part": "text"} for each piece of their text, then {"result": null}.
+
+CONTROL_ENC = "utf-8"
+MSG_END = b"\n"
+
+# Replies can carry several accounts' worth of tokens,
+# so allow a lot more than client messages get.
+MAXMSG = 1024 * 1024
+
+ALLOCATE_OP = "allocate"
+RELEASE_OP = "release"
+ALLOCATE_BATCH_OP = "allocate_batch"
+RENEW_OP = "renew"
+ALLOCATE_UUID_OP = "allocate_uuid"
+RELEASE_UUID_OP = "release_uuid"
+PROMOTE_OP = "promote"
+WAIT_PROMOTED_OP = "wait_promoted"
+VIEW_OP = "view"
+VIEW_UUID_OP = "view_uuid"
+VIEW_IP_OP = "view_ip"
+
+# All a standby server (see the Replication module) will do until it's
+# promoted; anything else would change accounts its primary owns.
+# Looking at them is harmless.
+STANDBY_OPS = [
+    PROMOTE_OP,
+    WAIT_PROMOTED_OP,
+    VIEW_OP,
+    VIEW_UUID_OP,
+    VIEW_IP_OP,
+]
+
+# Ops whose methods return an iterator of text, sent a part at a time
+STREAMED_OPS = [
+    VIEW_OP,
+    VIEW_UUID_OP,
+    VIEW_IP_OP,
+]
+
+RESULT_KEY = "result"
+ERROR_KEY = "error"
+PART_KEY = "part"
+
+# Only the owner of the socket file (the user running
+# nydus-server) may connect.
+SOCKET_MODE = 0o600
+
+"""
+Turns the MCAccount returned by an allocation into something
+which can be sent as JSON. None stays None.
+"""
+def mc_account_to_dict(mc_account):
+    if mc_account == None:
+        return None
+    return {
+        "mc_username": mc_account.get_username(),
+        "mc_uuid": mc_account.get_uuid(),
+        "mc_token": mc_account.get_token(),
+    }
+
+def dict_to_mc_account(accdict):
+    if accdict == None:
+        return None
+    return MCAccount(accdict["mc_username"], accdict["mc_uuid"], accdict["mc_token"])
+
+def mc_account_list_to_dicts(mc_accounts):
+    return [mc_account_to_dict(mc_account) for mc_account in mc_accounts]
+
+
+"""
+Runs in the process which owns the AllocService.
+Create it, then call serve_forever (usually on its own thread).
+"""
+class ControlServer:
+
+    """
+    service: the AllocService which will do the requested operations
+    path: where to create the socket file. A stale file left there by
+        a previous run is removed.
+    The socket is bound and listening as soon as this returns, so
+    processes forked afterwards can connect straight away.
+    """
+    def __init__(self, service, path):
+        if not isinstance(path, str):
+            raise TypeError("Path to control socket must be a string. Was {}".format(path))
+
+        self.service = service
+        self.path = path
+
+        # Maps each op to the service method which performs it
+        # and how to turn that method's result into JSON
+        self.ops = {
+            ALLOCATE_OP: (self.service.allocate, mc_account_to_dict),
+            RELEASE_OP: (self.service.release, None),
+            ALLOCATE_BATCH_OP: (self.allocate_batch, mc_account_list_to_dicts),
+            RENEW_OP: (self.service.renew, None),
+            ALLOCATE_UUID_OP: (self.service.allocate_uuid, None),
+            RELEASE_UUID_OP: (self.service.release_uuid, None),
+            PROMOTE_OP: (self.service.promote, None),
+            WAIT_PROMOTED_OP: (self.service.wait_promoted, None),
+            VIEW_OP: (self.service.view, None),
+            VIEW_UUID_OP: (self.service.view_uuid, None),
+            VIEW_IP_OP: (self.service.view_ip, None),
+        }
+
+        if os.path.exists(path):
+            os.remove(path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, SOCKET_MODE)
+        self.sock.listen()
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            ct = threading.Thread(target=self.handle_connection, args=(conn,))
+            ct.start()
+
+    """
+    A connection may carry any number of requests, one after the other,
+    until the other end closes it.
+    """
+    def handle_connection(self, conn):
+        with conn:
+            stream = conn.makefile("rb")
+            while True:
+                line = stream.readline(MAXMSG)
+                if not line.endswith(MSG_END):
+                    # Connection closed, or a message too long to be legitimate
+                    break
+                for reply in self.dispatch(line):
+                    conn.sendall(json.dumps(reply).encode(encoding=CONTROL_ENC) + MSG_END)
+
+    """
+    line: one request as received, still encoded.
+    Yields the replies to send, as dictionaries: the result or error,
+    after a part reply for each piece of text if it's one of the
+    STREAMED_OPS.
+    """
+    def dispatch(self, line):
+        try:
+            request = json.loads(line.decode(encoding=CONTROL_ENC))
+            method, encoder = self.ops[request["op"]]
+            if self.service.is_standby() and request["op"] not in STANDBY_OPS:
+                raise ValueError("This nydus-server is a standby, which can't {} until it's promoted".format(request["op"]))
+            result = method(*request["args"])
+
+            if request["op"] in STREAMED_OPS:
+                for part in result:
+                    yield {PART_KEY: part}
+                result = None
+        except Exception as e:
+            yield {ERROR_KEY: "{}: {}".format(type(e).__name__, e)}
+            return
+
+        if encoder != None:
+            result = encoder(result)
+        yield {RESULT_KEY: result}
+
+    """
+    JSON has no tuples, so the (client_ip, client_username)
+    pairs arrive as lists and are turned back into tuples here.
+    """
+    def allocate_batch(self, requests, lease_time=None):
+        return self.service.allocate_batch([tuple(request) for request in requests], lease_time)
+
+    """
+    Worker processes forked from the owner inherit the listening socket;
+    they should close their copy so only the owner accepts on it.
+    """
+    def close_listener(self):
+        self.sock.close()
+
+    def get_path(self):
+        return self.path
+
+
+"""
+Stands in for an AllocService in processes which don't own one.
+Has the same allocation methods; each is forwarded over the
+control socket to the owner and its result returned.
+Errors raised by the owner come back as ControlError.
+"""
+class ControlClient:
+
+    def __init__(self, path):
+        if not isinstance(path, str):
+            raise TypeError("Path to control socket must be a string. Was {}".format(path))
+        self.path = path
+
+    """
+    Sends one request and waits for its reply.
+    A new connection is made for each call; these are local
+    sockets, so that's cheap, and it means any number of threads
+    can use the same ControlClient at once.
+    """
+    def call(self, op, *args):
+        with self.connect(op, args) as sock:
+            return self.read_reply(sock.makefile("rb"))[RESULT_KEY]
+
+    """
+    call, for the STREAMED_OPS. Yields each piece of the
+    reply's text as it arrives.
+    """
+    def call_streamed(self, op, *args):
+        with self.connect(op, args) as sock:
+            stream = sock.makefile("rb")
+            while True:
+                reply = self.read_reply(stream)
+                if PART_KEY not in reply:
+                    return
+                yield reply[PART_KEY]
+
+    """
+    Returns a new connection to the server, with the request sent.
+    """
+    def connect(self, op, args):
+        request = json.dumps({"op": op, "args": list(args)}).encode(encoding=CONTROL_ENC) + MSG_END
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            sock.sendall(request)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+
+    """
+    Returns the next reply on stream, as a dictionary.
+    Raises ControlError if it's an error.
+    """
+    def read_reply(self, stream):
+        line = stream.readline(MAXMSG)
+        if not line.endswith(MSG_END):
+            raise ControlError("Incomplete reply on control socket {}".format(self.path))
+
+        reply = json.loads(line.decode(encoding=CONTROL_ENC))
+        if ERROR_KEY in reply:
+            raise ControlError(reply[ERROR_KEY])
+        return reply
+
+    def allocate(self, client_ip, client_username, lease_time=None):
+        return dict_to_mc_account(self.call(ALLOCATE_OP, client_ip, client_username, lease_time))
+
+    def release(self, client_ip):
+        self.call(RELEASE_OP, client_ip)
+
+    def allocate_batch(self, requests, lease_time=None):
+        return [dict_to_mc_account(accdict) for accdict in self.call(ALLOCATE_BATCH_OP, requests, lease_time)]
+
+    def renew(self, client_ip):
+        return self.call(RENEW_OP, client_ip)
+
+    def allocate_uuid(self, uuid, client_ip, client_username):
+        self.call(ALLOCATE_UUID_OP, uuid, client_ip, client_username)
+
+    def release_uuid(self, uuid):
+        self.call(RELEASE_UUID_OP, uuid)
+
+    def promote(self):
+        return self.call(PROMOTE_OP)
+
+    """
+    Blocks until the server is a primary. The
+    workers of a standby wait on this.
+    """
+    def wait_promoted(self):
+        self.call(WAIT_PROMOTED_OP)
+
+    """
+    The views yield the accounts as text, as nydus-cli prints them,
+    a piece at a time as they arrive. The server answers from its
+    last commit without taking its lock, so they don't hold up
+    allocations.
+    """
+    def view(self):
+        return self.call_streamed(VIEW_OP)
+
+    def view_uuid(self, uuid):
+        return self.call_streamed(VIEW_UUID_OP, uuid)
+
+    def view_ip(self, client_ip):
+        return self.call_streamed(VIEW_IP_OP, client_ip)
+
+    def get_path(self):
+        return self.path
+
+
+class ControlError(Exception):
+    pass
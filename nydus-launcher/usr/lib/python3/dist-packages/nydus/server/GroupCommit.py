@@ -0,0 +1,114 @@
+import time
+import threading
+
+# Lets many changes to the allocation state share one durable write.
+#
+# Without this, each allocation writes and fsyncs the allocation journal
+# while holding the allocation lock, so during a burst every client waits
+# for every fsync ahead of it. Instead, changes are made in memory under
+# the lock, and the lock is released before they're written. Each caller
+# then waits until a write covering its change has finished; whichever
+# caller finds no write under way does the next one, taking every change
+# made so far. While it's writing, more changes pile up behind it and go
+# in the next write together. So a burst costs about one fsync for each
+# group rather than one for each client, and no client is told its
+# allocation went through before it's on disk.
+#
+# Changes are numbered in the order they're made. A write covers every
+# change up to the number which was current when it took them.
+
+class GroupCommit:
+
+    """
+    engine: the AllocEngine whose changes are committed. Its autocommit
+        should be off, so its operations leave committing to this.
+    lock: the allocation lock, guarding the engine
+    window: seconds the caller doing a write waits before taking the
+        changes, to let more of them join it. 0 doesn't wait; changes
+        made while a write is under way still go in the next one together.
+    """
+    def __init__(self, engine, lock, window=0):
+        if not isinstance(window, (int, float)) or window < 0:
+            raise ValueError("Group commit window must be a non-negative number of seconds. Was {}".format(window))
+
+        self.engine = engine
+        self.lock = lock
+        self.window = window
+
+        # Number of the last change made. Guarded by self.lock.
+        self.last_changed = 0
+
+        # Number of the last change known to be on disk, and whether
+        # a write is under way. Guarded by self.written.
+        self.last_durable = 0
+        self.writing = False
+        self.written = threading.Condition()
+
+        # Held while writing, so anything else which writes to
+        # the engine's store (compaction) doesn't write at the same time
+        self.write_lock = threading.Lock()
+
+    """
+    Must be called holding self.lock, after changing the engine.
+    Returns the change's number, to pass to wait_durable.
+    Also called after reading state which might not be durable yet,
+    so the caller doesn't hand it out before it is.
+    """
+    def changed(self):
+        self.last_changed += 1
+        return self.last_changed
+
+    """
+    Call without holding self.lock.
+    Doesn't return until change number number is on disk. May do the
+    write itself, in which case it raises if the write fails; the changes
+    are then left to be written by the next caller.
+    """
+    def wait_durable(self, number):
+        with self.written:
+            while self.last_durable < number:
+                if not self.writing:
+                    self.writing = True
+                    break
+                self.written.wait()
+            else:
+                return
+
+        durable = None
+        try:
+            if self.window > 0:
+                time.sleep(self.window)
+            durable = self.write()
+        finally:
+            with self.written:
+                if durable != None:
+                    self.last_durable = max(self.last_durable, durable)
+                self.writing = False
+                self.written.notify_all()
+
+    """
+    Writes every change made so far.
+    Returns the number of the last change written.
+    """
+    def write(self):
+        with self.lock:
+            number = self.last_changed
+            changes = self.engine.take_changes()
+
+        try:
+            with self.write_lock:
+                self.engine.commit_changes(changes)
+        except Exception:
+            # Not until write_lock is let go: compaction and the like take
+            # self.lock first and then write_lock, so taking them the other
+            # way round here could leave each waiting on the other
+            with self.lock:
+                self.engine.restore_changes(changes)
+            raise
+        return number
+
+    def get_write_lock(self):
+        return self.write_lock
+
+    def get_window(self):
+        return self.window
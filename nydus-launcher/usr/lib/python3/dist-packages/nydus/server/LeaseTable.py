@@ -0,0 +1,154 @@
+import time
+import heapq
+import threading
+
+# Every allocation the server hands out comes with a lease: a deadline
+# after which, unless the client has renewed it, the account is taken
+# back. Clients in a session renew theirs with each heartbeat.
+#
+# Deadlines are kept in a min-heap so the soonest is always on top.
+# Finding what has expired only ever looks at the top of the heap,
+# rather than every account, and granting or renewing a lease is
+# one push. A renewal doesn't remove the client's old deadline from
+# the heap (that would mean searching for it); the old entry is simply
+# skipped when it reaches the top, because it no longer matches the
+# deadline held for that client.
+#
+# Times are from time.monotonic, so changes to the system clock
+# don't expire or extend anyone's lease.
+
+# Rebuild the heap without its stale entries once they outnumber
+# the live ones by this much. Keeps memory bounded when there are
+# many heartbeats per lease period.
+COMPACT_THRESHOLD = 1024
+
+class LeaseTable:
+
+    """
+    lease_time: how many seconds a lease lasts, and how far each
+        renewal extends it, unless told otherwise.
+    """
+    def __init__(self, lease_time):
+        if not isinstance(lease_time, (int, float)) or lease_time <= 0:
+            raise ValueError("Lease time must be a positive number of seconds. Was {}".format(lease_time))
+
+        self.lease_time = lease_time
+
+        # client_ip -> deadline
+        self.deadlines = {}
+
+        # (deadline, client_ip) entries, some of them stale
+        self.heap = []
+
+        # Guards deadlines and heap, and wakes wait_expired
+        # when a lease is granted which ends sooner than any other
+        self.changed = threading.Condition()
+
+    def now(self):
+        return time.monotonic()
+
+    """
+    Must be called holding self.changed.
+    """
+    def push(self, client_ip, deadline):
+        self.deadlines[client_ip] = deadline
+        heapq.heappush(self.heap, (deadline, client_ip))
+
+        if len(self.heap) > 2 * len(self.deadlines) + COMPACT_THRESHOLD:
+            self.heap = [(d, ip) for ip, d in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+        if self.heap[0] == (deadline, client_ip):
+            self.changed.notify_all()
+
+    """
+    Gives client_ip a lease of lease_time seconds from now,
+    replacing any lease it already had.
+    lease_time: defaults to the table's lease time
+    """
+    def grant(self, client_ip, lease_time=None):
+        if lease_time == None:
+            lease_time = self.lease_time
+
+        with self.changed:
+            self.push(client_ip, self.now() + lease_time)
+
+    """
+    Extends client_ip's lease to the table's lease time from now.
+    Never shortens a lease which already runs longer than that.
+    Returns False if client_ip has no lease to renew, which means
+    its lease ran out (or it was never allocated anything).
+    """
+    def renew(self, client_ip):
+        with self.changed:
+            deadline = self.deadlines.get(client_ip)
+            if deadline == None:
+                return False
+
+            new_deadline = self.now() + self.lease_time
+            if new_deadline > deadline:
+                self.push(client_ip, new_deadline)
+            return True
+
+    """
+    Removes client_ip's lease, if it has one.
+    Its entry stays in the heap until it's skipped over.
+    """
+    def revoke(self, client_ip):
+        with self.changed:
+            self.deadlines.pop(client_ip, None)
+
+    def has_lease(self, client_ip):
+        with self.changed:
+            return client_ip in self.deadlines
+
+    """
+    Must be called holding self.changed.
+    Removes and returns every client whose lease ended before now.
+    """
+    def pop_expired(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, client_ip = heapq.heappop(self.heap)
+            if self.deadlines.get(client_ip) == deadline:
+                del self.deadlines[client_ip]
+                expired.append(client_ip)
+        return expired
+
+    """
+    Removes and returns the clients whose leases have ended.
+    Doesn't wait; the list may be empty.
+    """
+    def take_expired(self):
+        with self.changed:
+            return self.pop_expired(self.now())
+
+    """
+    Blocks until at least one lease has ended, then removes and
+    returns the clients whose leases have.
+    Sleeps until the soonest deadline rather than polling, and is
+    woken early if a lease is granted which ends sooner than that.
+    """
+    def wait_expired(self):
+        with self.changed:
+            while True:
+                now = self.now()
+                expired = self.pop_expired(now)
+                if expired:
+                    return expired
+
+                if self.heap:
+                    self.changed.wait(self.heap[0][0] - now)
+                else:
+                    self.changed.wait()
+
+    def get_client_ips(self):
+        with self.changed:
+            return list(self.deadlines.keys())
+
+    def num_leases(self):
+        with self.changed:
+            return len(self.deadlines)
+
+    def get_lease_time(self):
+        return self.lease_time
@@ -0,0 +1,307 @@
+import socket
+import ssl
+import threading
+from collections import deque
+from nydus.common.protocol import encode_frame, negotiate_version, FrameReader, ProtocolError, COMMAND_KEY, PROTOCOL_VERSION
+
+# Keeps a standby nydus-server's allocation state a copy of its
+# primary's, so that if the primary fails the standby can take over
+# without loading anything or authenticating any account again.
+#
+# The primary runs a ReplicationPublisher, listening on its own port.
+# A standby's StandbyReplica connects to it over TLS, and each checks
+# the other's certificate against a CA chain they share, since what
+# passes between them includes every account's tokens. The standby
+# sends SUBSCRIBE. The primary answers with the fields of every account,
+# over as many SYNC frames as that takes and then SYNCED, and from then
+# on sends the changes from each commit it makes, in CHANGES frames, as
+# soon as they're durable. The standby applies everything to its own
+# AllocService, which commits it to its own allocation file; so the
+# standby's accounts are in memory and on disk, ready to be promoted.
+#
+# Frames are those of the client protocol (see the protocol module),
+# with bigger payloads allowed. When nothing has changed for a while the
+# primary sends KEEPALIVE, so each end notices if the other has gone.
+#
+# Replication is asynchronous: a client is told about its allocation
+# once the primary has committed it, which may be just before the
+# standby has it. A standby which falls far behind, or loses its
+# connection, is sent everything again when it reconnects; accounts
+# which already match aren't written again.
+
+SUBSCRIBE_COMMAND = "SUBSCRIBE"
+SYNC_COMMAND = "SYNC"
+SYNCED_COMMAND = "SYNCED"
+CHANGES_COMMAND = "CHANGES"
+KEEPALIVE_COMMAND = "KEEPALIVE"
+
+ROWS_KEY = "rows"
+START_KEY = "start"
+COUNT_KEY = "count"
+CHANGES_KEY = "changes"
+
+# Each account's tokens are several kilobytes, and
+# a frame carries up to ROWS_PER_FRAME accounts
+REPLICATION_MAX_PAYLOAD = 16 * 1024 * 1024
+ROWS_PER_FRAME = 256
+
+# Commits waiting to be sent to one standby. A standby so far behind
+# that there are more is disconnected, and starts again from SYNC.
+MAX_QUEUED_COMMITS = 10000
+
+# Seconds of quiet before the primary sends KEEPALIVE, and
+# after which a standby gives up on the connection
+KEEPALIVE_PERIOD = 2
+PRIMARY_TIMEOUT = 10
+
+# Seconds a standby has to complete the TLS handshake
+HANDSHAKE_TIMEOUT = 5
+
+# Seconds a standby waits before connecting again
+RECONNECT_DELAY = 1
+
+"""
+The TLS context a primary accepts standbys with. They must
+present a certificate signed by ca_chain.
+"""
+def make_publisher_context(cert_file, cert_privkey, ca_chain):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, cert_privkey)
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.load_verify_locations(cafile=ca_chain)
+    return context
+
+"""
+The TLS context a standby connects to its primary with, showing
+its own certificate, and checking the primary's against ca_chain.
+"""
+def make_standby_context(cert_file, cert_privkey, ca_chain):
+    context = ssl.create_default_context(cafile=ca_chain)
+    context.load_cert_chain(cert_file, cert_privkey)
+    return context
+
+"""
+changes: (row, fields) tuples
+Splits changes into lists short enough for one frame each.
+"""
+def split_changes(changes):
+    return [changes[start:start + ROWS_PER_FRAME] for start in range(0, len(changes), ROWS_PER_FRAME)]
+
+def send_message(sock, message, version=PROTOCOL_VERSION):
+    sock.sendall(encode_frame(message, version, REPLICATION_MAX_PAYLOAD))
+
+
+"""
+The commits waiting to be sent to one standby. add is the commit
+listener, called on whichever thread committed; take is called on
+the thread sending to the standby.
+"""
+class ChangeFeed:
+
+    def __init__(self):
+        self.pending = deque()
+        self.overflowed = False
+        self.ready = threading.Condition()
+
+    def add(self, changes):
+        with self.ready:
+            if len(self.pending) >= MAX_QUEUED_COMMITS:
+                self.overflowed = True
+                self.pending.clear()
+            else:
+                self.pending.append(changes)
+            self.ready.notify()
+
+    """
+    Waits up to timeout seconds for commits, and returns the changes
+    from all of them, oldest first; [] if there were none.
+    Raises ProtocolError if the standby has fallen too far behind.
+    """
+    def take(self, timeout):
+        with self.ready:
+            if not self.pending and not self.overflowed:
+                self.ready.wait(timeout)
+            if self.overflowed:
+                raise ProtocolError("Standby fell more than {} commits behind".format(MAX_QUEUED_COMMITS))
+            changes = [change for commit in self.pending for change in commit]
+            self.pending.clear()
+        return changes
+
+
+"""
+Runs on the primary. Create it, then call serve_forever
+(usually on its own thread).
+"""
+class ReplicationPublisher:
+
+    """
+    service: the primary's AllocService
+    context: from make_publisher_context
+    ip_addr, port: where to listen for standbys. The socket is
+        listening as soon as this returns.
+    """
+    def __init__(self, service, context, ip_addr, port):
+        self.service = service
+        self.context = context
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((ip_addr, port))
+        self.sock.listen()
+
+    def serve_forever(self):
+        while True:
+            conn, addr = self.sock.accept()
+            st = threading.Thread(target=self.handle_standby, args=(conn, addr))
+            st.start()
+
+    def handle_standby(self, conn, addr):
+        try:
+            conn.settimeout(HANDSHAKE_TIMEOUT)
+            conn = self.context.wrap_socket(conn, server_side=True)
+            conn.settimeout(None)
+        except (ssl.SSLError, OSError) as e:
+            print("Standby {} failed the TLS handshake: {}".format(addr[0], e))
+            conn.close()
+            return
+
+        with conn:
+            try:
+                self.publish(conn)
+            except (ProtocolError, OSError) as e:
+                print("Stopped replicating to standby {}: {}".format(addr[0], e))
+
+    """
+    Sends a subscribed standby every account, and
+    then every commit, until the connection fails.
+    """
+    def publish(self, conn):
+        frame = FrameReader(conn.recv_into).read_frame()
+        if frame == None:
+            return
+        version, message = frame
+        if message.get(COMMAND_KEY) != SUBSCRIBE_COMMAND:
+            raise ProtocolError("Standby sent {} rather than {}".format(message.get(COMMAND_KEY), SUBSCRIBE_COMMAND))
+        version = negotiate_version(version)
+
+        feed = ChangeFeed()
+        rows = self.service.subscribe(feed.add)
+        try:
+            for start in range(0, len(rows), ROWS_PER_FRAME):
+                send_message(conn, {COMMAND_KEY: SYNC_COMMAND, START_KEY: start,
+                        ROWS_KEY: rows[start:start + ROWS_PER_FRAME]}, version)
+            send_message(conn, {COMMAND_KEY: SYNCED_COMMAND, COUNT_KEY: len(rows)}, version)
+            del rows
+
+            while True:
+                changes = feed.take(KEEPALIVE_PERIOD)
+                if not changes:
+                    send_message(conn, {COMMAND_KEY: KEEPALIVE_COMMAND}, version)
+                for part in split_changes(changes):
+                    send_message(conn, {COMMAND_KEY: CHANGES_COMMAND, CHANGES_KEY: part}, version)
+        finally:
+            self.service.unsubscribe(feed.add)
+
+    def get_address(self):
+        return self.sock.getsockname()
+
+
+"""
+Runs on a standby, feeding its AllocService the primary's
+changes until it's promoted. Call run on its own thread.
+"""
+class StandbyReplica:
+
+    """
+    service: the standby's AllocService
+    context: from make_standby_context
+    primary_ip, port: where the primary's ReplicationPublisher listens
+    """
+    def __init__(self, service, context, primary_ip, port):
+        self.service = service
+        self.context = context
+        self.primary = (primary_ip, port)
+
+        # Whether every account has been copied from the primary
+        # over the current connection
+        self.synced = threading.Event()
+
+        self.stopped = threading.Event()
+
+        # The connection to the primary, for stop to close.
+        # Guarded by conn_lock.
+        self.conn = None
+        self.conn_lock = threading.Lock()
+
+    """
+    Follows the primary, connecting again whenever the connection
+    fails, until stop is called.
+    """
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.follow()
+            except (ProtocolError, ValueError, OSError) as e:
+                if not self.stopped.is_set():
+                    print("Lost replication from primary {}: {}".format(self.primary[0], e))
+            self.synced.clear()
+            self.stopped.wait(RECONNECT_DELAY)
+
+    def follow(self):
+        conn = socket.create_connection(self.primary, timeout=PRIMARY_TIMEOUT)
+        try:
+            conn = self.context.wrap_socket(conn, server_hostname=self.primary[0])
+        except (ssl.SSLError, OSError):
+            conn.close()
+            raise
+
+        with self.conn_lock:
+            if self.stopped.is_set():
+                conn.close()
+                return
+            self.conn = conn
+
+        with conn:
+            send_message(conn, {COMMAND_KEY: SUBSCRIBE_COMMAND})
+            reader = FrameReader(conn.recv_into, REPLICATION_MAX_PAYLOAD)
+            while True:
+                frame = reader.read_frame()
+                if frame == None:
+                    raise ProtocolError("Primary closed the connection")
+                self.apply(frame[1])
+
+    def apply(self, message):
+        command = message.get(COMMAND_KEY)
+        if command == SYNC_COMMAND:
+            self.service.replicate(list(enumerate(message[ROWS_KEY], message[START_KEY])))
+        elif command == SYNCED_COMMAND:
+            num_accounts = self.service.num_accounts()
+            if num_accounts != message[COUNT_KEY]:
+                raise ValueError("Standby has {} accounts but its primary only {}. Was it set up with another primary's accounts?".format(num_accounts, message[COUNT_KEY]))
+            self.synced.set()
+        elif command == CHANGES_COMMAND:
+            self.service.replicate([(row, fields) for row, fields in message[CHANGES_KEY]])
+        elif command != KEEPALIVE_COMMAND:
+            raise ProtocolError("Primary sent an unknown command: {}".format(command))
+
+    """
+    Stops following the primary, and closes the connection to it so
+    nothing more is read. Changes already being applied are finished.
+    """
+    def stop(self):
+        with self.conn_lock:
+            self.stopped.set()
+            if self.conn != None:
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def is_synced(self):
+        return self.synced.is_set()
+
+    """
+    Waits up to timeout seconds for every account
+    to be copied. Returns whether they have been.
+    """
+    def wait_synced(self, timeout=None):
+        return self.synced.wait(timeout)
@@ -1,7 +1,10 @@
 
 import os
 from nydus.common import validity
-from nydus.common import Config
+from nydus.common.Config import Config
+from nydus.common.AllocStore import ALLOC_BACKENDS
+from nydus.common.AllocPolicy import ALLOC_POLICIES, DEFAULT_ALLOC_POLICY
+from nydus.server.AllocPools import AllocPools
 
 SERVER_CONFIG_FILE = "/etc/nydus-launcher/server.conf"
 
@@ -13,6 +16,26 @@ MCVERSION = "McVersion"
 MSALCID = "MSALClientId"
 ALLOCFILE = "AllocFile"
 ACCOUNTSFILE = "AccountsFile"
+SERVERMODE = "ServerMode"
+MAXEXCHANGES = "MaxExchanges"
+LISTENBACKLOG = "ListenBacklog"
+HANDSHAKETIMEOUT = "HandshakeTimeout"
+WORKERS = "Workers"
+CONTROLSOCKET = "ControlSocket"
+SESSIONTIMEOUT = "SessionTimeout"
+LEASETIME = "LeaseTime"
+CLIENTRATE = "ClientRate"
+CLIENTBURST = "ClientBurst"
+MAXINFLIGHT = "MaxInFlight"
+RETRYWINDOW = "RetryWindow"
+ALLOCBACKEND = "AllocBackend"
+ALLOCPOLICY = "AllocPolicy"
+COMMITWINDOW = "CommitWindow"
+REPLICATIONROLE = "ReplicationRole"
+REPLICATIONPORT = "ReplicationPort"
+PRIMARYIPADDR = "PrimaryIpAddr"
+REPLICATIONCACHAIN = "ReplicationCaChain"
+POOLSFILE = "PoolsFile"
 SERVER_PARNAMES = [
     IPADDR, 
     PORT,
@@ -22,6 +45,46 @@ SERVER_PARNAMES = [
     MSALCID,
     ALLOCFILE,
     ACCOUNTSFILE,
+    SERVERMODE,
+    MAXEXCHANGES,
+    LISTENBACKLOG,
+    HANDSHAKETIMEOUT,
+    WORKERS,
+    CONTROLSOCKET,
+    SESSIONTIMEOUT,
+    LEASETIME,
+    CLIENTRATE,
+    CLIENTBURST,
+    MAXINFLIGHT,
+    RETRYWINDOW,
+    ALLOCBACKEND,
+    ALLOCPOLICY,
+    COMMITWINDOW,
+    REPLICATIONROLE,
+    REPLICATIONPORT,
+    PRIMARYIPADDR,
+    REPLICATIONCACHAIN,
+    POOLSFILE,
+]
+
+# Ways nydus-server can handle client connections.
+# threaded: one thread per accepted connection
+# asyncio: one event loop, each exchange a coroutine
+THREADED_MODE = "threaded"
+ASYNCIO_MODE = "asyncio"
+SERVER_MODES = [
+    THREADED_MODE,
+    ASYNCIO_MODE,
+]
+
+# Parts a nydus-server can play in replication.
+# primary: serves clients, and sends its changes to any standbys
+# standby: copies a primary, until it's promoted to take over
+PRIMARY_ROLE = "primary"
+STANDBY_ROLE = "standby"
+REPLICATION_ROLES = [
+    PRIMARY_ROLE,
+    STANDBY_ROLE,
 ]
 
 SERVER_DEFCONFIG = {
@@ -33,6 +96,26 @@ SERVER_DEFCONFIG = {
     MSALCID: "1ab23456-7890-1c2d-e3fg-45h6789ijk01",
     ALLOCFILE: "nydus-alloc.csv",
     ACCOUNTSFILE: "ms-usernames.txt",
+    SERVERMODE: THREADED_MODE,
+    MAXEXCHANGES: "32",
+    LISTENBACKLOG: "128",
+    HANDSHAKETIMEOUT: "5",
+    WORKERS: "1",
+    CONTROLSOCKET: "/run/nydus/nydus-server.sock",
+    SESSIONTIMEOUT: "90",
+    LEASETIME: "120",
+    CLIENTRATE: "30",
+    CLIENTBURST: "5",
+    MAXINFLIGHT: "64",
+    RETRYWINDOW: "10",
+    ALLOCBACKEND: "csv",
+    ALLOCPOLICY: DEFAULT_ALLOC_POLICY,
+    COMMITWINDOW: "0",
+    REPLICATIONROLE: PRIMARY_ROLE,
+    REPLICATIONPORT: "0",
+    PRIMARYIPADDR: "192.168.1.1",
+    REPLICATIONCACHAIN: "nydus-ca.crt",
+    POOLSFILE: "",
 }
 
 # Maps between the parameter name used in the config file
@@ -41,11 +124,31 @@ SERVER_VARNAMES = {
     IPADDR: "ip_addr",
     PORT: "port",
     CERTFILE: "cert_file",
-    CERT_PRIVKEY: "cert_privkey",
+    CERTPRIVKEY: "cert_privkey",
     MCVERSION: "mc_version",
     MSALCID: "msal_cid",
     ALLOCFILE: "alloc_file",
     ACCOUNTSFILE: "accounts_file",
+    SERVERMODE: "server_mode",
+    MAXEXCHANGES: "max_exchanges",
+    LISTENBACKLOG: "listen_backlog",
+    HANDSHAKETIMEOUT: "handshake_timeout",
+    WORKERS: "workers",
+    CONTROLSOCKET: "control_socket",
+    SESSIONTIMEOUT: "session_timeout",
+    LEASETIME: "lease_time",
+    CLIENTRATE: "client_rate",
+    CLIENTBURST: "client_burst",
+    MAXINFLIGHT: "max_in_flight",
+    RETRYWINDOW: "retry_window",
+    ALLOCBACKEND: "alloc_backend",
+    ALLOCPOLICY: "alloc_policy",
+    COMMITWINDOW: "commit_window",
+    REPLICATIONROLE: "replication_role",
+    REPLICATIONPORT: "replication_port",
+    PRIMARYIPADDR: "primary_ip_addr",
+    REPLICATIONCACHAIN: "replication_ca_chain",
+    POOLSFILE: "pools_file",
 }
 
 class ServerConfig(Config):
@@ -78,11 +181,79 @@ class ServerConfig(Config):
         if not validity.is_valid_file(self.accounts_file):
             raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(ACCOUNTSFILE, self.accounts_file))
 
+        if not self.server_mode in SERVER_MODES:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(SERVERMODE, ", ".join(SERVER_MODES), self.server_mode))
+
+        if not validity.is_positive_integer(self.max_exchanges):
+            raise ValueError("Value for {} is not a positive integer: {}".format(MAXEXCHANGES, self.max_exchanges))
+
+        if not validity.is_positive_integer(self.listen_backlog):
+            raise ValueError("Value for {} is not a positive integer: {}".format(LISTENBACKLOG, self.listen_backlog))
+
+        if not validity.is_positive_integer(self.handshake_timeout):
+            raise ValueError("Value for {} is not a positive integer: {}".format(HANDSHAKETIMEOUT, self.handshake_timeout))
+
+        if not validity.is_positive_integer(self.workers):
+            raise ValueError("Value for {} is not a positive integer: {}".format(WORKERS, self.workers))
+
+        if not validity.is_nonempty_str(self.control_socket):
+            raise ValueError("Value for {} must be the path the control socket will be created at. Was {}".format(CONTROLSOCKET, self.control_socket))
+
+        if not validity.is_positive_integer(self.session_timeout):
+            raise ValueError("Value for {} is not a positive integer: {}".format(SESSIONTIMEOUT, self.session_timeout))
+
+        if not validity.is_positive_integer(self.lease_time):
+            raise ValueError("Value for {} is not a positive integer: {}".format(LEASETIME, self.lease_time))
+
+        if not validity.is_positive_integer(self.client_rate):
+            raise ValueError("Value for {} is not a positive integer: {}".format(CLIENTRATE, self.client_rate))
+
+        if not validity.is_positive_integer(self.client_burst):
+            raise ValueError("Value for {} is not a positive integer: {}".format(CLIENTBURST, self.client_burst))
+
+        if not validity.is_positive_integer(self.max_in_flight):
+            raise ValueError("Value for {} is not a positive integer: {}".format(MAXINFLIGHT, self.max_in_flight))
+
+        if not validity.is_nonnegative_integer(self.retry_window):
+            raise ValueError("Value for {} is not a non-negative integer: {}".format(RETRYWINDOW, self.retry_window))
+
+        if not self.alloc_backend in ALLOC_BACKENDS:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(ALLOCBACKEND, ", ".join(ALLOC_BACKENDS), self.alloc_backend))
+
+        if not self.alloc_policy in ALLOC_POLICIES:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(ALLOCPOLICY, ", ".join(ALLOC_POLICIES), self.alloc_policy))
+
+        if not validity.is_nonnegative_integer(self.commit_window):
+            raise ValueError("Value for {} is not a non-negative integer: {}".format(COMMITWINDOW, self.commit_window))
+
+        if not self.replication_role in REPLICATION_ROLES:
+            raise ValueError("Value for {} must be one of {}. Was {}".format(REPLICATIONROLE, ", ".join(REPLICATION_ROLES), self.replication_role))
+
+        if not (self.replication_port == "0" or validity.is_valid_port(self.replication_port)):
+            raise ValueError("Value for {} is not a valid port, or 0: {}".format(REPLICATIONPORT, self.replication_port))
+
+        if self.replication_role == STANDBY_ROLE and self.replication_port == "0":
+            raise ValueError("Value for {} must be the port the primary accepts standbys on, since {} is {}".format(REPLICATIONPORT, REPLICATIONROLE, STANDBY_ROLE))
+
+        if not validity.is_valid_ipaddr(self.primary_ip_addr):
+            raise ValueError("Value for {} is not a valid IP address: {}".format(PRIMARYIPADDR, self.primary_ip_addr))
+
+        if self.replication_port != "0" and not validity.is_valid_file(self.replication_ca_chain):
+            raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(REPLICATIONCACHAIN, self.replication_ca_chain))
+
+        if self.pools_file != "" and not os.path.isfile(self.pools_file):
+            raise ValueError("Value for {} is not a file, cannot be found, or cannot be read: {}".format(POOLSFILE, self.pools_file))
+
+        if self.pools_file != "" and self.replication_port != "0":
+            raise ValueError("{} and {} can't be used together: only a single pool of accounts can be replicated to a standby".format(POOLSFILE, REPLICATIONPORT))
+
+        self.alloc_pools = AllocPools.read(self.alloc_file, self.accounts_file, self.mc_version, self.pools_file)
+
     def get_ip_addr(self):
         return self.ip_addr
 
     def get_port(self):
-        return self.port
+        return int(self.port)
 
     def get_cert_file(self):
         return self.cert_file
@@ -101,3 +272,94 @@ class ServerConfig(Config):
 
     def get_accounts_file(self):
         return self.accounts_file
+
+    def get_server_mode(self):
+        return self.server_mode
+
+    def get_max_exchanges(self):
+        return int(self.max_exchanges)
+
+    def get_listen_backlog(self):
+        return int(self.listen_backlog)
+
+    """
+    In seconds
+    """
+    def get_handshake_timeout(self):
+        return int(self.handshake_timeout)
+
+    def get_workers(self):
+        return int(self.workers)
+
+    def get_control_socket(self):
+        return self.control_socket
+
+    """
+    In seconds
+    """
+    def get_session_timeout(self):
+        return int(self.session_timeout)
+
+    """
+    In seconds
+    """
+    def get_lease_time(self):
+        return int(self.lease_time)
+
+    """
+    Requests per minute
+    """
+    def get_client_rate(self):
+        return int(self.client_rate)
+
+    def get_client_burst(self):
+        return int(self.client_burst)
+
+    def get_max_in_flight(self):
+        return int(self.max_in_flight)
+
+    """
+    In seconds
+    """
+    def get_retry_window(self):
+        return int(self.retry_window)
+
+    def get_alloc_backend(self):
+        return self.alloc_backend
+
+    def get_alloc_policy(self):
+        return self.alloc_policy
+
+    """
+    In milliseconds
+    """
+    def get_commit_window(self):
+        return int(self.commit_window)
+
+    def is_standby(self):
+        return self.replication_role == STANDBY_ROLE
+
+    def get_replication_role(self):
+        return self.replication_role
+
+    """
+    0 when this server is a primary which doesn't accept standbys.
+    """
+    def get_replication_port(self):
+        return int(self.replication_port)
+
+    def get_primary_ip_addr(self):
+        return self.primary_ip_addr
+
+    def get_replication_ca_chain(self):
+        return self.replication_ca_chain
+
+    def get_pools_file(self):
+        return self.pools_file
+
+    """
+    The AllocPools read from the pools file, with the
+    default pool made of AllocFile, AccountsFile and McVersion.
+    """
+    def get_alloc_pools(self):
+        return self.alloc_pools
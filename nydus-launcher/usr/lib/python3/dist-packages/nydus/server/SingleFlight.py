@@ -0,0 +1,65 @@
+import threading
+
+# Makes sure only one call for a given key runs at a time, and that
+# callers who ask for the same key while it's running share its result
+# rather than running it again.
+# nydus-server uses this so that a client which sends the same request
+# twice in quick succession (a double click on the launcher, or a retry
+# after a timeout) gets one allocation, not two.
+
+"""
+One call in progress, which later callers for
+the same key wait on.
+"""
+class InFlightCall:
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+
+    def __init__(self):
+        # key -> InFlightCall
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    """
+    Calls function(*args) and returns what it returns, unless a call
+    with the same key is already running; then waits for that one to
+    finish and returns its result instead.
+    If the call raises an exception, it's raised to every caller
+    which was waiting on it.
+    key: anything hashable
+    """
+    def do(self, key, function, *args):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call == None
+            if leader:
+                call = InFlightCall()
+                self.calls[key] = call
+
+        if not leader:
+            call.finished.wait()
+            if call.error != None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = function(*args)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.finished.set()
+
+        return call.result
+
+    def num_in_flight(self):
+        with self.lock:
+            return len(self.calls)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+from nydus.common.AllocJournal import *
+from nydus.common.AllocStore import TOKEN_FIELDS, STATE_SUFFIX
+from nydus.common.allocater import AllocEngine, AllocAccount
+
+# Must exist on the machine running the tests
+TEST_USERNAME = "root"
+
+TEST_TIME = "01-01-2030 00:00:00"
+
+"""
+Writes an allocation file holding num_accounts unallocated accounts.
+combined: whether to write every field in the allocation file,
+as it was before the allocation state had a file of its own
+"""
+def make_alloc_file(path, num_accounts, combined=False):
+    with open(path, "w") as f:
+        if combined:
+            f.write("{}\n".format(AllocAccount.make_header()))
+        else:
+            f.write("{}\n".format(",".join(TOKEN_FIELDS)))
+
+        for i in range(num_accounts):
+            fields = ["ms{}@example.com".format(i),
+                "msal", TEST_TIME, "xbl", TEST_TIME, "xsts", TEST_TIME, "hash",
+                "mc{}".format(i), TEST_TIME, "Player{}".format(i), "uuid{}".format(i)]
+            if combined:
+                fields = ["", "", ""] + fields
+            f.write(",".join(fields) + "\n")
+
+class TestAllocJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        self.journal = AllocJournal(self.alloc_file)
+
+    def tearDown(self):
+        self.journal.close()
+        self.dir.cleanup()
+
+    def test_empty(self):
+        self.assertEqual(self.journal.read_lines(), [])
+        self.assertFalse(os.path.exists(self.journal.get_path()))
+
+    def test_append(self):
+        self.journal.append(["release,0"])
+        self.journal.append(["release,1", "release,2"])
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), ["release,0", "release,1", "release,2"])
+        self.assertEqual(self.journal.get_size(), os.path.getsize(self.journal.get_path()))
+
+    def test_torn_line(self):
+        self.journal.append(["release,0"])
+        self.journal.close()
+        with open(self.journal.get_path(), "a") as f:
+            f.write("release,")
+
+        journal = AllocJournal(self.alloc_file)
+        self.assertEqual(journal.read_lines(), ["release,0"])
+        journal.append(["release,1"])
+        journal.close()
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), ["release,0", "release,1"])
+
+    def test_rotate(self):
+        self.journal.append(["release,0"])
+        self.journal.rotate()
+        self.journal.append(["release,1"])
+        self.assertEqual(self.journal.get_size(), len("release,1\n"))
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), ["release,0", "release,1"])
+
+        self.journal.discard_old()
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), ["release,1"])
+
+    def test_rotate_unfinished(self):
+        # Compaction which never got as far as discard_old
+        self.journal.append(["release,0"])
+        self.journal.rotate()
+        self.journal.append(["release,1"])
+        self.journal.rotate()
+        self.assertFalse(os.path.exists(self.journal.get_path()))
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), ["release,0", "release,1"])
+
+class TestEngineJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(self.alloc_file, 3)
+        with open(self.alloc_file) as f:
+            self.original = f.read()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the allocation file,
+    whose store is closed when the test ends.
+    """
+    def reload(self):
+        engine = AllocEngine(self.alloc_file)
+        self.engines.append(engine)
+        return engine
+
+    def state_journal(self):
+        return AllocJournal(self.alloc_file + STATE_SUFFIX)
+
+    def test_allocate_appends(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        with open(self.alloc_file) as f:
+            self.assertEqual(f.read(), self.original)
+
+        self.assertFalse(os.path.exists(AllocJournal(self.alloc_file).get_path()))
+        lines = self.state_journal().read_lines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("allocate,0,10.0.0.1,{},".format(TEST_USERNAME)))
+
+    def test_replay(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        engine.release_account_ip("10.0.0.1")
+
+        accounts = self.reload().get_accounts()
+        self.assertFalse(accounts[0].is_allocated())
+        self.assertEqual(accounts[1].get_client_ip(), "10.0.0.2")
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_nothing_changed(self):
+        self.reload().release_account_ip("10.0.0.1")
+        self.assertFalse(os.path.exists(AllocJournal(self.alloc_file).get_path()))
+        self.assertFalse(os.path.exists(self.state_journal().get_path()))
+
+    def test_tokens(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        acc = engine.get_accounts()[2]
+        acc.update_minecraft_account(acc.get_account_auth_tokens().get_minecraft_account().copy())
+        engine.write_changes()
+        lines = AllocJournal(self.alloc_file).read_lines()
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].startswith("tokens,2,ms2@example.com,"))
+        self.assertEqual(len(self.state_journal().read_lines()), 1)
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_compact(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.compact()
+        self.assertEqual(self.state_journal().read_lines(), [])
+        self.assertEqual(self.reload().get_accounts()[0].get_client_ip(), "10.0.0.1")
+
+    def test_compact_state_only(self):
+        engine = self.reload()
+        acc = engine.get_accounts()[2]
+        acc.update_minecraft_account(acc.get_account_auth_tokens().get_minecraft_account().copy())
+        for i in range(10):
+            engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+            engine.release_account_ip("10.0.0.1")
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+
+        tokens_size = engine.get_store().get_tokens_snapshot().get_journal().get_size()
+        engine.finish_compaction(engine.start_compaction(tokens_size + 1))
+        with open(self.alloc_file) as f:
+            self.assertEqual(f.read(), self.original)
+        self.assertEqual(self.state_journal().read_lines(), [])
+        self.assertEqual(len(AllocJournal(self.alloc_file).read_lines()), 1)
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_combined_file(self):
+        make_alloc_file(self.alloc_file, 3, True)
+        journal = AllocJournal(self.alloc_file)
+        journal.append(["allocate,1,10.0.0.1,{},{}".format(TEST_USERNAME, TEST_TIME)])
+        journal.close()
+        engine = self.reload()
+        self.assertEqual(engine.get_accounts()[1].get_client_ip(), "10.0.0.1")
+
+        # Split in two, and the journal folded in
+        with open(self.alloc_file) as f:
+            self.assertEqual(f.read(), self.original)
+        self.assertEqual(AllocJournal(self.alloc_file).read_lines(), [])
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_compact_in_halves(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        snapshot = engine.start_compaction()
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+
+        # A crash here loses nothing
+        self.assertEqual(str(self.reload()), str(engine))
+
+        engine.finish_compaction(snapshot)
+        self.assertEqual(len(self.state_journal().read_lines()), 1)
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_replay_over_snapshot(self):
+        # A crash between writing the snapshot and discarding the old journal
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.release_account_ip("10.0.0.1")
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        store_compaction, rows, num_commits = engine.start_compaction()
+        for snapshot, text in store_compaction:
+            write_atomically(snapshot.get_path(), text)
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_bad_row(self):
+        journal = AllocJournal(self.alloc_file)
+        journal.append(["release,3"])
+        journal.close()
+        with self.assertRaises(ValueError):
+            self.reload()
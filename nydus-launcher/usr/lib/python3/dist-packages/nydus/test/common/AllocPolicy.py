@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+
+import os
+import datetime
+import tempfile
+import unittest
+
+from nydus.common.AllocPolicy import *
+from nydus.common.AllocStore import TOKEN_FIELDS
+from nydus.common.allocater import AllocEngine, to_time_str
+from nydus.test.common.AllocJournal import TEST_USERNAME, TEST_TIME
+
+"""
+The token fields of account number i, with
+a Minecraft token expiring at mc_expiry.
+"""
+def token_fields(i, mc_expiry):
+    return ["ms{}@example.com".format(i),
+        "msal", TEST_TIME, "xbl", TEST_TIME, "xsts", TEST_TIME, "hash",
+        "mc{}".format(i), to_time_str(mc_expiry), "Player{}".format(i), "uuid{}".format(i)]
+
+"""
+Writes an allocation file of unallocated accounts, whose
+Minecraft tokens expire the given numbers of hours from now.
+"""
+def make_expiring_file(path, hours):
+    now = datetime.datetime.now().replace(microsecond=0)
+    with open(path, "w") as f:
+        f.write("{}\n".format(",".join(TOKEN_FIELDS)))
+        for i, h in enumerate(hours):
+            f.write(",".join(token_fields(i, now + datetime.timedelta(hours=h))) + "\n")
+    return now
+
+class TestAllocPolicy(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        self.now = make_expiring_file(self.alloc_file, [1, 3, 2, 0.1])
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the allocation file at path, giving accounts
+    out by policy; its store is closed when the test ends.
+    """
+    def open_engine(self, path, policy=DEFAULT_ALLOC_POLICY):
+        engine = AllocEngine(path, policy=policy)
+        self.engines.append(engine)
+        return engine
+
+    """
+    The uuids of the accounts given to num clients.
+    """
+    def allocate(self, engine, num, first=1):
+        uuids = []
+        for n in range(first, first + num):
+            acc = engine.allocate_one_account("10.0.0.{}".format(n), TEST_USERNAME)
+            uuids.append(None if acc == None else acc.get_mc_uuid())
+        return uuids
+
+    def test_lru(self):
+        engine = self.open_engine(self.alloc_file, policy=LRU_POLICY)
+        self.assertEqual(self.allocate(engine, 2), ["uuid0", "uuid1"])
+        engine.release_account_ip("10.0.0.1")
+        self.assertEqual(self.allocate(engine, 3, 3), ["uuid2", "uuid3", "uuid0"])
+        self.assertEqual(self.allocate(engine, 1, 6), [None])
+
+    def test_freshest_token(self):
+        engine = self.open_engine(self.alloc_file, policy=FRESHEST_TOKEN_POLICY)
+        self.assertEqual(self.allocate(engine, 2), ["uuid1", "uuid2"])
+        engine.release_account_ip("10.0.0.1")
+        self.assertEqual(self.allocate(engine, 3, 3), ["uuid1", "uuid0", "uuid3"])
+
+    def test_default(self):
+        self.assertEqual(self.allocate(self.open_engine(self.alloc_file), 1), ["uuid1"])
+
+    def test_renewed_token(self):
+        engine = self.open_engine(self.alloc_file, policy=FRESHEST_TOKEN_POLICY)
+        acc = engine.get_accounts_uuid("uuid3")[0]
+        acc.set_fields(token_fields(3, self.now + datetime.timedelta(hours=4)))
+        self.assertEqual(self.allocate(engine, 2), ["uuid3", "uuid1"])
+
+    def test_round_robin(self):
+        engine = self.open_engine(self.alloc_file, policy=ROUND_ROBIN_POLICY)
+        self.assertEqual(self.allocate(engine, 2), ["uuid0", "uuid1"])
+
+        # Released after uuid1 was given out, but it's next in line
+        # neither for that nor for having gone unused longest
+        engine.release_account_ip("10.0.0.2")
+        engine.release_account_ip("10.0.0.1")
+        self.assertEqual(self.allocate(engine, 4, 3), ["uuid2", "uuid3", "uuid0", "uuid1"])
+
+    def test_allocated_by_uuid(self):
+        for policy in ALLOC_POLICIES:
+            with self.subTest(policy=policy):
+                alloc_file = os.path.join(self.dir.name, "{}.csv".format(policy))
+                make_expiring_file(alloc_file, [1, 3, 2, 0.1])
+                engine = self.open_engine(alloc_file, policy=policy)
+                engine.allocate_uuid("uuid1", "10.0.0.9", TEST_USERNAME)
+                uuids = self.allocate(engine, 4)
+                self.assertEqual(sorted(uuids[:3]), ["uuid0", "uuid2", "uuid3"])
+                self.assertIsNone(uuids[3])
+
+    def test_dead_entries_cleared(self):
+        engine = self.open_engine(self.alloc_file, policy=FRESHEST_TOKEN_POLICY)
+        acc = engine.get_accounts_uuid("uuid0")[0]
+        for n in range(10 * REBUILD_SLACK):
+            acc.set_fields(token_fields(0, self.now + datetime.timedelta(minutes=n)))
+        self.assertLessEqual(len(engine.free.heap), 2 * engine.free.num_queued() + REBUILD_SLACK)
+        self.assertEqual(self.allocate(engine, 1), ["uuid0"])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            make_policy("newest")
+        with self.assertRaises(ValueError):
+            AllocEngine(self.alloc_file, policy="newest")
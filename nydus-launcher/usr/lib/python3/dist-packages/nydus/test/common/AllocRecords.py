@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+from nydus.common.AllocRecords import *
+
+# Must exist on the machine running the tests
+TEST_USERNAME = "root"
+
+TEST_TIME = "01-01-2030 00:00:00"
+
+FREE = ["", "", ""]
+
+class TestAllocRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "alloc.csv.records")
+        self.records = AllocRecords(self.path)
+
+    def tearDown(self):
+        self.records.close()
+        self.dir.cleanup()
+
+    def reopen(self):
+        self.records.close()
+        self.records = AllocRecords(self.path)
+        return self.records.read()
+
+    def test_empty(self):
+        self.assertEqual(self.records.read(), [])
+        self.assertEqual(os.path.getsize(self.path), RECORD_SIZE)
+
+    def test_write(self):
+        self.records.write([(2, ["10.0.0.1", TEST_USERNAME, TEST_TIME])])
+        self.assertEqual(self.reopen(), [FREE, FREE, ["10.0.0.1", TEST_USERNAME, TEST_TIME]])
+
+    def test_in_place(self):
+        self.records.write([(i, FREE) for i in range(1000)])
+        size = os.path.getsize(self.path)
+        self.records.write([(500, ["10.0.0.1", TEST_USERNAME, TEST_TIME])])
+        self.records.write([(500, FREE), (999, ["10.0.0.2", TEST_USERNAME, TEST_TIME])])
+        self.assertEqual(os.path.getsize(self.path), size)
+
+        records = self.reopen()
+        self.assertEqual(records[500], FREE)
+        self.assertEqual(records[999], ["10.0.0.2", TEST_USERNAME, TEST_TIME])
+
+    def test_write_file(self):
+        self.records.close()
+        alloc_rows = [FREE, ["10.0.0.1", TEST_USERNAME, TEST_TIME]]
+        AllocRecords.write_file(self.path, alloc_rows)
+        self.assertEqual(self.reopen(), alloc_rows)
+
+    def test_bad_change(self):
+        with self.assertRaises(ValueError):
+            self.records.write([(0, ["10.0.0.256", TEST_USERNAME, TEST_TIME])])
+        with self.assertRaises(ValueError):
+            self.records.write([(0, ["10.0.0.1", "no such user", TEST_TIME])])
+
+    def test_not_records(self):
+        path = os.path.join(self.dir.name, "alloc.csv")
+        with open(path, "w") as f:
+            f.write("ms_username,msal_token\n" * 100)
+        with self.assertRaises(ValueError):
+            AllocRecords(path)
+
+    def test_cut_short(self):
+        self.records.write([(0, ["10.0.0.1", TEST_USERNAME, TEST_TIME])])
+        self.records.close()
+        with open(self.path, "r+b") as f:
+            f.truncate(RECORD_SIZE + 10)
+        with self.assertRaises(ValueError):
+            self.records = AllocRecords(self.path)
+        self.records = AllocRecords(os.path.join(self.dir.name, "other.records"))
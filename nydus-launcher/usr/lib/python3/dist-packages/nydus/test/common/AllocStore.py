@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from nydus.common.AllocStore import *
+from nydus.common.AllocJournal import AllocJournal
+from nydus.common.allocater import AllocEngine
+from nydus.test.common.AllocJournal import make_alloc_file
+
+# Must exist on the machine running the tests
+TEST_USERNAME = "root"
+
+TEST_TIME = "01-01-2030 00:00:00"
+
+def make_fields(i):
+    return ["", "", "", "ms{}@example.com".format(i), "msal", TEST_TIME,
+        "xbl", TEST_TIME, "xsts", TEST_TIME, "hash", "mc{}".format(i), TEST_TIME,
+        "Player{}".format(i), "uuid{}".format(i)]
+
+class TestOpenStore(unittest.TestCase):
+
+    def test_bad_backend(self):
+        with self.assertRaises(ValueError):
+            open_store("nydus-alloc.csv", "xml")
+
+class TestSqliteAllocStore(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "alloc.db")
+        open(self.path, "w").close()
+        self.store = SqliteAllocStore(self.path)
+        self.store.commit([(i, make_fields(i)) for i in range(3)])
+
+    def tearDown(self):
+        self.store.close()
+        self.dir.cleanup()
+
+    def reload(self):
+        store = SqliteAllocStore(self.path)
+        rows = store.load()
+        store.close()
+        return rows
+
+    def test_empty_file(self):
+        path = os.path.join(self.dir.name, "empty.db")
+        open(path, "w").close()
+        store = SqliteAllocStore(path)
+        self.assertEqual(store.load(), [])
+        store.close()
+
+    def test_not_a_database(self):
+        path = os.path.join(self.dir.name, "alloc.csv")
+        with open(path, "w") as f:
+            f.write("client_ip,client_username\n" * 100)
+        with self.assertRaises(ValueError):
+            SqliteAllocStore(path)
+
+    def test_load(self):
+        self.assertEqual(self.reload(), [make_fields(i) for i in range(3)])
+
+    def test_allocate(self):
+        self.store.commit([(1, ["10.0.0.1", TEST_USERNAME, TEST_TIME])])
+        rows = self.reload()
+        self.assertEqual(rows[1][:3], ["10.0.0.1", TEST_USERNAME, TEST_TIME])
+        self.assertEqual(rows[1][3:], make_fields(1)[3:])
+
+    def test_rolled_back(self):
+        with self.assertRaises(ValueError):
+            self.store.commit([(0, ["10.0.0.1", TEST_USERNAME, TEST_TIME]), (1, ["too", "few"])])
+        self.assertEqual(self.reload(), [make_fields(i) for i in range(3)])
+
+    def test_indexes(self):
+        conn = sqlite3.connect(self.path)
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT id FROM tokens WHERE mc_uuid = ?", ["uuid1"]).fetchall()
+        conn.close()
+        self.assertIn("tokens_mc_uuid", str(plan))
+
+    def test_parts_apart(self):
+        self.store.commit([(1, ["10.0.0.1", TEST_USERNAME, TEST_TIME]), (2, make_fields(5)[3:])])
+        rows = self.reload()
+        self.assertEqual(rows[1][:3], ["10.0.0.1", TEST_USERNAME, TEST_TIME])
+        self.assertEqual(rows[1][3:], make_fields(1)[3:])
+        self.assertEqual(rows[2], make_fields(5))
+
+    def test_combined_table(self):
+        # As the database was before the allocation state had a table of its own
+        path = os.path.join(self.dir.name, "combined.db")
+        conn = sqlite3.connect(path)
+        conn.execute("CREATE TABLE accounts (id INTEGER PRIMARY KEY, {})".format(", ".join(FIELDS)))
+        conn.execute("INSERT INTO accounts VALUES (0, {})".format(", ".join(["?"] * len(FIELDS))),
+            ["10.0.0.1", TEST_USERNAME, TEST_TIME] + make_fields(0)[3:])
+        conn.commit()
+        conn.close()
+
+        store = SqliteAllocStore(path)
+        self.assertEqual(store.load(), [["10.0.0.1", TEST_USERNAME, TEST_TIME] + make_fields(0)[3:]])
+        store.close()
+
+        conn = sqlite3.connect(path)
+        tables = [name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        conn.close()
+        self.assertEqual(sorted(tables), ["allocations", "tokens"])
+
+class TestSqliteEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "alloc.db")
+        open(self.path, "w").close()
+        store = SqliteAllocStore(self.path)
+        store.commit([(i, make_fields(i)) for i in range(3)])
+        store.close()
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the database,
+    whose store is closed when the test ends.
+    """
+    def reload(self):
+        engine = AllocEngine(self.path, SQLITE_BACKEND)
+        self.engines.append(engine)
+        return engine
+
+    def test_replay(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        engine.release_account_ip("10.0.0.1")
+        engine.allocate_uuid("uuid2", "10.0.0.3", TEST_USERNAME)
+
+        reloaded = self.reload()
+        self.assertEqual(str(reloaded), str(engine))
+        self.assertEqual(reloaded.get_accounts()[2].get_client_ip(), "10.0.0.3")
+
+    def test_compact(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.compact()
+        self.assertEqual(str(self.reload()), str(engine))
+
+class TestMmapEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(self.path, 3)
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the allocation file,
+    whose store is closed when the test ends.
+    """
+    def reload(self):
+        engine = AllocEngine(self.path, MMAP_BACKEND)
+        self.engines.append(engine)
+        return engine
+
+    def read_records(self):
+        with open(self.path + RECORDS_SUFFIX, "rb") as f:
+            return f.read()
+
+    def test_replay(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        engine.release_account_ip("10.0.0.1")
+        engine.allocate_uuid("uuid2", "10.0.0.3", TEST_USERNAME)
+
+        reloaded = self.reload()
+        self.assertEqual(str(reloaded), str(engine))
+        self.assertEqual(reloaded.get_accounts()[2].get_client_ip(), "10.0.0.3")
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["alloc.csv", "alloc.csv.records"])
+
+    def test_tokens(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        records = self.read_records()
+
+        acc = engine.get_accounts()[0]
+        acc.update_minecraft_account(acc.get_account_auth_tokens().get_minecraft_account().copy())
+        engine.write_changes()
+        self.assertEqual(self.read_records(), records)
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_compact(self):
+        engine = self.reload()
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.compact()
+        self.assertEqual(str(self.reload()), str(engine))
+
+    def test_combined_file(self):
+        make_alloc_file(self.path, 3, True)
+        journal = AllocJournal(self.path)
+        journal.append(["allocate,1,10.0.0.1,{},{}".format(TEST_USERNAME, TEST_TIME)])
+        journal.close()
+        engine = self.reload()
+        self.assertEqual(engine.get_accounts()[1].get_client_ip(), "10.0.0.1")
+        self.assertEqual(sorted(os.listdir(self.dir.name)), ["alloc.csv", "alloc.csv.records"])
+        self.assertEqual(str(self.reload()), str(engine))
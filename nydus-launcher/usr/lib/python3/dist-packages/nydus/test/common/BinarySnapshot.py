@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+from nydus.common.BinarySnapshot import *
+from nydus.common.AllocStore import ALLOC_BACKENDS, CSV_BACKEND, STATE_SUFFIX
+from nydus.common.allocater import AllocEngine
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME, TEST_TIME
+
+class TestBinarySnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        self.snapshot_path = self.alloc_file + BINARY_SNAPSHOT_SUFFIX
+        self.engines = []
+
+    def tearDown(self):
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the allocation file at path,
+    whose store is closed when the test ends.
+    """
+    def open_engine(self, path, backend=CSV_BACKEND):
+        engine = AllocEngine(path, backend)
+        self.engines.append(engine)
+        return engine
+
+    """
+    An engine for an allocation file of three accounts, the
+    first two allocated, with a snapshot written.
+    """
+    def make_engine(self, backend=CSV_BACKEND):
+        if backend == CSV_BACKEND:
+            make_alloc_file(self.alloc_file, 3)
+            engine = self.open_engine(self.alloc_file)
+        else:
+            # The csv accounts, moved into the other backend's files
+            csv_file = os.path.join(self.dir.name, "accounts.csv")
+            make_alloc_file(csv_file, 3)
+            open(self.alloc_file, "w").close()
+            engine = self.open_engine(self.alloc_file, backend)
+            for acc in self.open_engine(csv_file).get_accounts():
+                acc = acc.copy()
+                acc.mark_changed()
+                engine.add_account(acc)
+
+        engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        engine.compact()
+        return engine
+
+    def test_round_trip(self):
+        for backend in ALLOC_BACKENDS:
+            with self.subTest(backend=backend):
+                engine = self.make_engine(backend)
+                self.assertTrue(os.path.isfile(self.snapshot_path))
+
+                reloaded = self.open_engine(self.alloc_file, backend)
+                self.assertEqual(str(reloaded), str(engine))
+                self.assertEqual([acc.get_alloc_time() for acc in reloaded.get_accounts()],
+                        [acc.get_alloc_time() for acc in engine.get_accounts()])
+                self.assertEqual(reloaded.get_accounts_ip("10.0.0.2")[0].get_mc_uuid(), "uuid1")
+
+                # It carries on from there like any other
+                reloaded.allocate_one_account("10.0.0.3", TEST_USERNAME)
+                self.assertEqual(str(self.open_engine(self.alloc_file, backend)), str(reloaded))
+
+                self.tearDown()
+                self.setUp()
+
+    def test_used(self):
+        for backend in ALLOC_BACKENDS:
+            with self.subTest(backend=backend):
+                # A snapshot which differs from the store, so it can be told apart
+                engine = self.make_engine(backend)
+                rows = [acc.to_fields() for acc in engine.get_accounts()]
+                rows[2][FIELDS.index("mc_username")] = "Snapshot"
+                snapshot = BinarySnapshot(self.alloc_file)
+                snapshot.prepare(rows, engine.store_fingerprint())
+                snapshot.install()
+                engine.get_store().close()
+
+                reloaded = self.open_engine(self.alloc_file, backend)
+                self.assertEqual(reloaded.get_accounts()[2].get_mc_username(), "Snapshot")
+                self.assertIsNone(reloaded.get_accounts()[2].changed_fields())
+
+                self.tearDown()
+                self.setUp()
+
+    def test_discarded_on_commit(self):
+        engine = self.make_engine()
+        engine.release_account_ip("10.0.0.1")
+        self.assertFalse(os.path.exists(self.snapshot_path))
+        self.assertEqual(str(self.open_engine(self.alloc_file)), str(engine))
+
+    def test_bad_checksum(self):
+        engine = self.make_engine()
+        with open(self.snapshot_path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 1]))
+
+        self.assertIsNone(BinarySnapshot(self.alloc_file).read(engine.store_fingerprint()))
+        self.assertEqual(str(self.open_engine(self.alloc_file)), str(engine))
+
+    def test_cut_short(self):
+        engine = self.make_engine()
+        with open(self.snapshot_path, "r+b") as f:
+            f.truncate(HEADER_SIZE - 1)
+        self.assertEqual(str(self.open_engine(self.alloc_file)), str(engine))
+
+    def test_edited_by_hand(self):
+        self.make_engine()
+        with open(self.alloc_file + STATE_SUFFIX, "r") as f:
+            lines = f.readlines()
+        lines[3] = "10.0.0.3,{},{}\n".format(TEST_USERNAME, TEST_TIME)
+        with open(self.alloc_file + STATE_SUFFIX, "w") as f:
+            f.write("".join(lines))
+
+        reloaded = self.open_engine(self.alloc_file)
+        self.assertEqual(reloaded.get_accounts()[2].get_client_ip(), "10.0.0.3")
+
+    def test_commit_during_compaction(self):
+        engine = self.make_engine()
+        compaction = engine.start_compaction()
+        engine.release_account_ip("10.0.0.1")
+        engine.finish_compaction(compaction)
+
+        self.assertFalse(os.path.exists(self.snapshot_path))
+        self.assertFalse(os.path.exists(self.snapshot_path + SNAPSHOT_TEMP_SUFFIX))
+        self.assertEqual(str(self.open_engine(self.alloc_file)), str(engine))
+
+    def test_saved(self):
+        engine = self.make_engine()
+        engine.set_autocommit(False)
+        engine.release_account_ip("10.0.0.1")
+        engine.write_changes()
+        self.assertFalse(os.path.exists(self.snapshot_path))
+
+        engine.save_binary_snapshot()
+        self.assertTrue(os.path.isfile(self.snapshot_path))
+        self.assertEqual(str(self.open_engine(self.alloc_file)), str(engine))
+
+    def test_no_accounts(self):
+        open(self.alloc_file, "w").close()
+        engine = self.open_engine(self.alloc_file)
+        engine.save_binary_snapshot()
+        self.assertEqual(self.open_engine(self.alloc_file).get_accounts(), [])
+
+    def test_separator_in_field(self):
+        row = ["", "", ""] + ["x"] * (len(FIELDS) - 3)
+        BinarySnapshot.encode([row])
+        row[4] = "x" + FIELD_SEP
+        with self.assertRaises(ValueError):
+            BinarySnapshot.encode([row])
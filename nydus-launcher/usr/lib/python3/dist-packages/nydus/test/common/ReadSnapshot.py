@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import unittest
+
+from nydus.common.ReadSnapshot import *
+from nydus.common.allocater import AllocEngine
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME, TEST_TIME
+
+"""
+The fields of a made-up account, unallocated unless client_ip is given.
+"""
+def make_row(i, client_ip=""):
+    alloc = [client_ip, TEST_USERNAME, TEST_TIME] if client_ip else ["", "", ""]
+    return alloc + ["ms{}@example.com".format(i), "msal", TEST_TIME, "xbl", TEST_TIME,
+            "xsts", TEST_TIME, "hash", "mc{}".format(i), TEST_TIME, "Player{}".format(i), "uuid{}".format(i)]
+
+class TestReadSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [make_row(i) for i in range(ROWS_PER_CHUNK * 2 + 1)]
+        self.snapshot = ReadSnapshot.from_rows(self.rows)
+
+    def test_from_rows(self):
+        self.assertEqual(self.snapshot.num_accounts(), len(self.rows))
+        self.assertEqual(self.snapshot.get_rows(), [tuple(row) for row in self.rows])
+        self.assertEqual(self.snapshot.get_row(ROWS_PER_CHUNK), tuple(self.rows[ROWS_PER_CHUNK]))
+        with self.assertRaises(IndexError):
+            self.snapshot.get_row(len(self.rows))
+        self.assertEqual(ReadSnapshot().get_rows(), [])
+
+    def test_apply(self):
+        alloc = ["10.0.0.1", TEST_USERNAME, TEST_TIME]
+        changed = self.snapshot.apply([(1, alloc)])
+
+        self.assertEqual(changed.get_row(1), tuple(make_row(1, "10.0.0.1")))
+        self.assertEqual(changed.find_ip("10.0.0.1"), [tuple(make_row(1, "10.0.0.1"))])
+
+        # The old snapshot is as it was, and the
+        # chunks without changes are shared
+        self.assertEqual(self.snapshot.find_ip("10.0.0.1"), [])
+        self.assertIsNot(changed.chunks[0], self.snapshot.chunks[0])
+        self.assertIs(changed.chunks[1], self.snapshot.chunks[1])
+
+        tokens = make_row(7)[len(ALLOC_FIELDS):]
+        changed = changed.apply([(1, tokens)])
+        self.assertEqual(changed.find_uuid("uuid7"), [tuple(make_row(7, "10.0.0.1")), tuple(make_row(7))])
+
+    def test_new_rows(self):
+        start = len(self.rows)
+        changed = self.snapshot.apply([(n, make_row(n)) for n in range(start, start + ROWS_PER_CHUNK + 1)])
+        self.assertEqual(changed.num_accounts(), start + ROWS_PER_CHUNK + 1)
+        self.assertEqual(changed.get_rows(), ReadSnapshot.from_rows(make_row(n) for n in range(changed.num_accounts())).get_rows())
+        self.assertEqual(self.snapshot.num_accounts(), start)
+
+    def test_parts(self):
+        parts = list(rows_to_parts(self.snapshot.iter_rows()))
+        self.assertEqual("".join(parts), rows_to_string(self.snapshot.get_rows()))
+        self.assertEqual(len(parts), 1 + -(-len(self.rows) // ROWS_PER_PART))
+        self.assertEqual(parts[1].count("\n"), ROWS_PER_PART)
+        self.assertEqual(list(rows_to_parts([])), [rows_to_string([])])
+
+    def test_bad_changes(self):
+        with self.assertRaises(ValueError):
+            self.snapshot.apply([(len(self.rows) + 1, make_row(0))])
+        with self.assertRaises(ValueError):
+            self.snapshot.apply([(len(self.rows), ["10.0.0.1", TEST_USERNAME, TEST_TIME])])
+        with self.assertRaises(ValueError):
+            self.snapshot.apply([(0, ["10.0.0.1", TEST_USERNAME])])
+
+    def test_published_on_commit(self):
+        with tempfile.TemporaryDirectory() as directory:
+            alloc_file = os.path.join(directory, "alloc.csv")
+            make_alloc_file(alloc_file, 3)
+            engine = AllocEngine(alloc_file)
+            engine.set_autocommit(False)
+            before = engine.get_read_snapshot()
+            self.assertEqual(rows_to_string(before.get_rows()), str(engine))
+
+            engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+            self.assertIs(engine.get_read_snapshot(), before)
+
+            engine.write_changes()
+            self.assertEqual(rows_to_string(engine.get_read_snapshot().get_rows()), str(engine))
+            self.assertEqual(rows_to_string(engine.get_read_snapshot().find_ip("10.0.0.1")), engine.view_ip("10.0.0.1"))
+            self.assertEqual(before.find_ip("10.0.0.1"), [])
+            engine.get_store().close()
@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+import unittest
+
+from nydus.common.StripedLock import *
+
+class TestStripedLock(unittest.TestCase):
+
+    def test_bad_stripes(self):
+        for num_stripes in [0, -1, "4", 2.5]:
+            with self.assertRaises(ValueError):
+                StripedLock(num_stripes)
+
+    def test_same_key(self):
+        locks = StripedLock()
+        self.assertIs(locks.get_lock("uuid0"), locks.get_lock("uuid0"))
+
+    def test_one_stripe(self):
+        locks = StripedLock(1)
+        self.assertIs(locks.get_lock("uuid0"), locks.get_lock("uuid1"))
+
+    def test_keys_spread(self):
+        locks = StripedLock()
+        used = set(id(locks.get_lock("uuid{}".format(i))) for i in range(1000))
+        self.assertEqual(len(used), locks.get_num_stripes())
+
+    def test_other_key_not_held(self):
+        locks = StripedLock()
+        keys = ["uuid{}".format(i) for i in range(100)]
+        other = next(key for key in keys if locks.get_lock(key) is not locks.get_lock(keys[0]))
+        with locks.get_lock(keys[0]):
+            self.assertTrue(locks.get_lock(other).acquire(blocking=False))
+            locks.get_lock(other).release()
+            self.assertFalse(locks.get_lock(keys[0]).acquire(blocking=False))
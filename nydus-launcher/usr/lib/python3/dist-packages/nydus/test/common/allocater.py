@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+import datetime
+import os
+import tempfile
+import tracemalloc
+import unittest
+
+from nydus.common.allocater import *
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME
+
+class TestAllocEngineIndexes(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(self.alloc_file, 3)
+        self.engine = AllocEngine(self.alloc_file)
+
+    def tearDown(self):
+        self.engine.get_store().close()
+        self.dir.cleanup()
+
+    def uuids(self, accs):
+        return [acc.get_mc_uuid() for acc in accs]
+
+    def test_allocate_in_order(self):
+        accs = [self.engine.allocate_one_account("10.0.0.{}".format(i), TEST_USERNAME) for i in range(4)]
+        self.assertEqual(self.uuids(accs[:3]), ["uuid0", "uuid1", "uuid2"])
+        self.assertIsNone(accs[3])
+        self.assertEqual(self.engine.num_free_accounts(), 0)
+
+    def test_released_goes_last(self):
+        self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        self.engine.release_account_ip("10.0.0.1")
+        acc = self.engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        self.assertEqual(acc.get_mc_uuid(), "uuid1")
+
+    def test_reallocate_client(self):
+        first = self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        second = self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        self.assertFalse(first.is_allocated())
+        self.assertEqual(self.engine.get_accounts_ip("10.0.0.1"), [second])
+        self.assertEqual(self.engine.num_free_accounts(), 2)
+
+    def test_allocate_uuid_of_free(self):
+        # uuid0 is at the front of the free queue, so is skipped
+        self.engine.allocate_uuid("uuid0", "10.0.0.1", TEST_USERNAME)
+        acc = self.engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        self.assertEqual(acc.get_mc_uuid(), "uuid1")
+
+        self.engine.release_account_uuid("uuid0")
+        self.assertEqual(self.engine.get_accounts_ip("10.0.0.1"), [])
+        self.assertEqual(self.engine.num_free_accounts(), 2)
+
+    def test_released_by_account(self):
+        # As the cleanup does
+        acc = self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        acc.release()
+        self.assertEqual(self.engine.get_allocated_accounts(), [])
+        self.assertEqual(self.engine.num_free_accounts(), 3)
+
+    def test_allocated_on_load(self):
+        self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        self.engine.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        engine = AllocEngine(self.alloc_file)
+        self.assertEqual(self.uuids(engine.get_accounts_ip("10.0.0.2")), ["uuid1"])
+        self.assertEqual(engine.allocate_one_account("10.0.0.3", TEST_USERNAME).get_mc_uuid(), "uuid2")
+        engine.get_store().close()
+
+    def test_only_changed_taken(self):
+        self.engine.set_autocommit(False)
+        self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        self.assertEqual([row for row, fields in self.engine.take_changes()], [0])
+        self.assertEqual(self.engine.take_changes(), [])
+
+class TestLazyTokens(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(self.alloc_file, 3)
+        self.engine = AllocEngine(self.alloc_file)
+
+    def tearDown(self):
+        self.engine.get_store().close()
+        self.dir.cleanup()
+
+    def test_not_decoded(self):
+        acc = self.engine.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        self.assertEqual((acc.get_mc_username(), acc.get_mc_uuid(), acc.get_mc_token()), ("Player0", "uuid0", "mc0"))
+        self.engine.view_ip("10.0.0.1")
+        self.assertTrue(all(acc.aat == None for acc in self.engine.get_accounts()))
+
+    def test_decoded(self):
+        acc = self.engine.get_accounts()[1]
+        before = repr(acc)
+        self.assertEqual(acc.get_xsts_hash(), "hash")
+        self.assertIsNotNone(acc.aat)
+        self.assertEqual(repr(acc), before)
+        self.assertEqual(acc.get_mc_uuid(), "uuid1")
+
+    def test_bad_token(self):
+        fields = self.engine.get_accounts()[0].to_fields()
+        fields[FIELDS.index("msal_expiry")] = "never"
+        acc = AllocAccount(*fields)
+        with self.assertRaises(ValueError):
+            acc.get_msal_expiry()
+
+class TestAccountMemory(unittest.TestCase):
+
+    NUM_ACCOUNTS = 2000
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(alloc_file, self.NUM_ACCOUNTS)
+        self.rows = CsvAllocStore(alloc_file).load()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    """
+    Bytes each account takes, apart from the strings
+    it was made from, measured with tracemalloc.
+    """
+    def bytes_per_account(self, decode):
+        # So caches filled by the first decode aren't counted
+        AllocAccount(*self.rows[0]).get_account_auth_tokens()
+
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            accs = [AllocAccount(*fields) for fields in self.rows]
+            if decode:
+                for acc in accs:
+                    acc.get_account_auth_tokens()
+            used = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        return used / len(accs)
+
+    def test_no_dict(self):
+        acc = AllocAccount(*self.rows[0])
+        aat = acc.get_account_auth_tokens()
+        for obj in [acc, aat, aat.get_msal_token(), aat.get_minecraft_account()]:
+            self.assertFalse(hasattr(obj, "__dict__"))
+
+    def test_mc_token_shared(self):
+        aat = AllocAccount(*self.rows[0]).get_account_auth_tokens()
+        self.assertIs(aat.get_minecraft_token().get_token(), aat.get_minecraft_account().get_token())
+
+    def test_lazy_size(self):
+        size = self.bytes_per_account(False)
+        self.assertLess(size, 280, "{:.0f} bytes per undecoded account".format(size))
+
+    def test_decoded_size(self):
+        size = self.bytes_per_account(True)
+        self.assertLess(size, 850, "{:.0f} bytes per decoded account".format(size))
+
+class TestUpdateTokens(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(self.alloc_file, 2)
+        self.engine = AllocEngine(self.alloc_file)
+
+    def tearDown(self):
+        self.engine.get_store().close()
+        self.dir.cleanup()
+
+    def test_from_copy(self):
+        # As renew_tokens does
+        acc = self.engine.get_accounts()[1]
+        renewed = acc.copy()
+        renewed.update_msal_token(AccessToken("new", datetime.datetime(2031, 1, 1)))
+        self.assertIsNone(acc.changed_fields())
+
+        acc.update_account_auth_tokens(renewed.get_account_auth_tokens())
+        self.assertEqual(acc.get_msal_at().get_token(), "new")
+        self.engine.autocommit_changes()
+
+        engine = AllocEngine(self.alloc_file)
+        self.assertEqual(engine.get_accounts()[1].get_msal_at().get_token(), "new")
+        self.assertEqual(engine.get_accounts()[0].get_msal_at().get_token(), "msal")
+        engine.get_store().close()
+
+    def test_bad_tokens(self):
+        with self.assertRaises(TypeError):
+            self.engine.get_accounts()[0].update_account_auth_tokens(None)
+
+    def test_needs_renewal(self):
+        fields = self.engine.get_accounts()[0].to_fields()
+        fields[FIELDS.index("mc_expiry")] = "01-01-2020 00:00:00"
+        acc = AllocAccount(*fields)
+        check_interval = datetime.timedelta(minutes=30)
+        self.assertFalse(acc.msal_needs_renewal(check_interval))
+        self.assertFalse(acc.xboxlive_needs_renewal(check_interval))
+        self.assertFalse(acc.xsts_needs_renewal(check_interval))
+        self.assertTrue(acc.minecraft_needs_renewal(check_interval))
@@ -0,0 +1,106 @@
+#!/usr/bin/python3
+
+import socket
+import unittest
+
+from nydus.common.protocol import *
+
+class TestEncodeFrame(unittest.TestCase):
+
+    def test_header(self):
+        frame = encode_frame({"cmd": "RELEASE"})
+        version, length = decode_header(frame[:FRAME_HEADER.size])
+        self.assertEqual(version, PROTOCOL_VERSION)
+        self.assertEqual(length, len(frame) - FRAME_HEADER.size)
+
+    def test_roundtrip(self):
+        message = {"cmd": "REQUEST", "username": "crutech"}
+        frame = encode_frame(message)
+        self.assertEqual(decode_payload(frame[FRAME_HEADER.size:]), message)
+
+    def test_version(self):
+        frame = encode_frame({}, version=7)
+        self.assertEqual(decode_header(frame[:FRAME_HEADER.size])[0], 7)
+
+    def test_not_dict(self):
+        with self.assertRaises(TypeError):
+            encode_frame(["cmd", "REQUEST"])
+
+    def test_too_long(self):
+        with self.assertRaises(ProtocolError):
+            encode_frame({"username": "a" * MAX_PAYLOAD})
+
+class TestDecode(unittest.TestCase):
+
+    def test_bad_magic(self):
+        with self.assertRaises(ProtocolError):
+            decode_header(b"RELEASE")
+
+    def test_huge_length(self):
+        with self.assertRaises(ProtocolError):
+            decode_header(FRAME_HEADER.pack(FRAME_MAGIC, 1, MAX_PAYLOAD + 1))
+
+    def test_not_json(self):
+        with self.assertRaises(ProtocolError):
+            decode_payload(b"{cmd")
+
+    def test_not_object(self):
+        with self.assertRaises(ProtocolError):
+            decode_payload(b"[1, 2]")
+
+    def test_bad_utf8(self):
+        with self.assertRaises(ProtocolError):
+            decode_payload(b"\xff\xfe")
+
+class TestNegotiateVersion(unittest.TestCase):
+
+    def test_same(self):
+        self.assertEqual(negotiate_version(PROTOCOL_VERSION), PROTOCOL_VERSION)
+
+    def test_newer_peer(self):
+        self.assertEqual(negotiate_version(PROTOCOL_VERSION + 1), PROTOCOL_VERSION)
+
+    def test_too_old(self):
+        with self.assertRaises(ProtocolError):
+            negotiate_version(MIN_PROTOCOL_VERSION - 1)
+
+class TestFrameReader(unittest.TestCase):
+
+    def setUp(self):
+        self.ours, self.theirs = socket.socketpair()
+        self.reader = FrameReader(self.ours.recv_into)
+
+    def tearDown(self):
+        self.ours.close()
+        self.theirs.close()
+
+    def test_one(self):
+        self.theirs.sendall(encode_frame({"cmd": "HEARTBEAT"}))
+        self.assertEqual(self.reader.read_frame(), (PROTOCOL_VERSION, {"cmd": "HEARTBEAT"}))
+
+    def test_back_to_back(self):
+        self.theirs.sendall(encode_frame({"n": 1}) + encode_frame({"n": 2}))
+        self.assertEqual(self.reader.read_frame()[1], {"n": 1})
+        self.assertEqual(self.reader.read_frame()[1], {"n": 2})
+
+    def test_byte_at_a_time(self):
+        # Includes a multibyte character, which arrives split across receives
+        frame = encode_frame({"mc_username": "Stève"})
+        for i in range(len(frame)):
+            self.theirs.sendall(frame[i:i+1])
+        self.assertEqual(self.reader.read_frame()[1], {"mc_username": "Stève"})
+
+    def test_prefix(self):
+        frame = encode_frame({"cmd": "RELEASE"})
+        self.theirs.sendall(frame[len(FRAME_MAGIC):])
+        self.assertEqual(self.reader.read_frame(prefix=FRAME_MAGIC)[1], {"cmd": "RELEASE"})
+
+    def test_closed(self):
+        self.theirs.close()
+        self.assertIsNone(self.reader.read_frame())
+
+    def test_truncated(self):
+        self.theirs.sendall(encode_frame({"cmd": "RELEASE"})[:-2])
+        self.theirs.close()
+        with self.assertRaises(ProtocolError):
+            self.reader.read_frame()
@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+import unittest
+
+from nydus.server.AdmissionControl import *
+
+"""
+An AdmissionControl whose clock only moves when told to.
+"""
+class StoppedClockAdmissionControl(AdmissionControl):
+
+    def __init__(self, rate, burst, max_in_flight):
+        self.clock = 1000.0
+        super().__init__(rate, burst, max_in_flight)
+
+    def now(self):
+        return self.clock
+
+class TestAdmissionControl(unittest.TestCase):
+
+    def setUp(self):
+        self.admission = StoppedClockAdmissionControl(2, 3, 10)
+
+    def admit_done(self, client_ip):
+        retry_after_ms = self.admission.admit(client_ip)
+        if retry_after_ms == None:
+            self.admission.done()
+        return retry_after_ms
+
+    def test_bad_rate(self):
+        with self.assertRaises(ValueError):
+            AdmissionControl(0, 3, 10)
+
+    def test_bad_burst(self):
+        with self.assertRaises(ValueError):
+            AdmissionControl(2, 0, 10)
+
+    def test_bad_max_in_flight(self):
+        with self.assertRaises(ValueError):
+            AdmissionControl(2, 3, 0)
+
+    def test_burst(self):
+        for i in range(3):
+            self.assertIsNone(self.admit_done("10.0.0.1"))
+        self.assertEqual(self.admit_done("10.0.0.1"), 500)
+
+    def test_refill(self):
+        for i in range(3):
+            self.admit_done("10.0.0.1")
+        self.admission.clock += 0.25
+        self.assertEqual(self.admit_done("10.0.0.1"), 250)
+        self.admission.clock += 0.25
+        self.assertIsNone(self.admit_done("10.0.0.1"))
+
+    def test_refill_capped(self):
+        self.admit_done("10.0.0.1")
+        self.admission.clock += 100
+        for i in range(3):
+            self.assertIsNone(self.admit_done("10.0.0.1"))
+        self.assertIsNotNone(self.admit_done("10.0.0.1"))
+
+    def test_per_client(self):
+        for i in range(3):
+            self.admit_done("10.0.0.1")
+        self.assertIsNotNone(self.admit_done("10.0.0.1"))
+        self.assertIsNone(self.admit_done("10.0.0.2"))
+
+    def test_ceiling(self):
+        admission = StoppedClockAdmissionControl(2, 3, 2)
+        self.assertIsNone(admission.admit("10.0.0.1"))
+        self.assertIsNone(admission.admit("10.0.0.2"))
+        self.assertEqual(admission.admit("10.0.0.3"), CEILING_RETRY_MS)
+        admission.done()
+        self.assertIsNone(admission.admit("10.0.0.3"))
+        self.assertEqual(admission.num_in_flight(), 2)
+
+    def test_shed_costs_no_token(self):
+        admission = StoppedClockAdmissionControl(2, 1, 1)
+        admission.admit("10.0.0.1")
+        self.assertEqual(admission.admit("10.0.0.2"), CEILING_RETRY_MS)
+        admission.done()
+        self.assertIsNone(admission.admit("10.0.0.2"))
+
+    def test_prune(self):
+        self.admit_done("10.0.0.1")
+        self.admission.clock += PRUNE_PERIOD + 1
+        self.admit_done("10.0.0.2")
+        self.assertEqual(list(self.admission.buckets.keys()), ["10.0.0.2"])
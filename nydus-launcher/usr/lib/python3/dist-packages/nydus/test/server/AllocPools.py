@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+from nydus.server.AllocPools import *
+from nydus.server.AllocService import AllocService
+from nydus.common.allocater import AllocEngine
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME
+
+LEASE_TIME = 60
+
+class TestAllocPools(unittest.TestCase):
+
+    def setUp(self):
+        self.default_pool = AllocPool(None, "default.csv", "default.txt", "1.20.6")
+
+    def test_find(self):
+        lab = AllocPool("10.1.0.0/16", "lab.csv", "lab.txt")
+        room = AllocPool("10.1.5.0/24", "room.csv", "room.txt", "1.19.4")
+        pools = AllocPools(self.default_pool, [lab, room])
+
+        self.assertIs(pools.find("10.1.2.3"), lab)
+        self.assertIs(pools.find("10.1.5.3"), room)
+        self.assertIs(pools.find("10.2.0.1"), self.default_pool)
+        self.assertEqual(pools.get_pools(), [self.default_pool, room, lab])
+        self.assertTrue(pools.is_pooled())
+        with self.assertRaises(ValueError):
+            pools.find("not an address")
+
+    def test_mc_version(self):
+        lab = AllocPool("10.1.0.0/16", "lab.csv", "lab.txt")
+        room = AllocPool("10.2.0.0/16", "room.csv", "room.txt", "1.19.4")
+        pools = AllocPools(self.default_pool, [lab, room])
+        self.assertEqual(pools.get_mc_version("10.1.0.1"), "1.20.6")
+        self.assertEqual(pools.get_mc_version("10.2.0.1"), "1.19.4")
+        self.assertEqual(pools.get_mc_version("10.3.0.1"), "1.20.6")
+
+    def test_bad_pools(self):
+        with self.assertRaises(ValueError):
+            AllocPool("10.1.0.1/16", "lab.csv", "lab.txt")
+        with self.assertRaises(ValueError):
+            AllocPool("10.1.0.0/16", "lab.csv", "lab.txt", "latest")
+        with self.assertRaises(ValueError):
+            AllocPools(self.default_pool, [AllocPool("10.1.0.0/16", "default.csv", "lab.txt")])
+        with self.assertRaises(ValueError):
+            AllocPools(self.default_pool, [AllocPool("10.1.0.0/16", "a.csv", "a.txt"),
+                    AllocPool("10.1.0.0/16", "b.csv", "b.txt")])
+        with self.assertRaises(ValueError):
+            AllocPools(self.default_pool, [AllocPool(None, "a.csv", "a.txt")])
+
+    def test_read(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "pools")
+            with open(path, "w") as f:
+                f.write("# Labs\n\n10.1.0.0/16 lab.csv lab.txt\n  10.2.0.0/16 room.csv room.txt 1.19.4\n")
+            pools = AllocPools.read("default.csv", "default.txt", "1.20.6", path)
+            self.assertEqual([pool.get_alloc_file() for pool in pools.get_pools()], ["default.csv", "lab.csv", "room.csv"])
+            self.assertEqual(pools.get_mc_version("10.2.0.1"), "1.19.4")
+
+            with open(path, "w") as f:
+                f.write("10.1.0.0/16 lab.csv\n")
+            with self.assertRaises(ValueError):
+                AllocPools.read("default.csv", "default.txt", "1.20.6", path)
+
+        self.assertFalse(AllocPools.read("default.csv", "default.txt", "1.20.6", "").is_pooled())
+
+
+class TestPooledAllocService(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.files = {}
+        for name, subnet in [("default", None), ("lab", "10.1.0.0/16")]:
+            alloc_file = os.path.join(self.dir.name, name + ".csv")
+            make_alloc_file(alloc_file, 2)
+            self.files[subnet] = alloc_file
+
+        self.default_pool = AllocPool(None, self.files[None], "default.txt")
+        self.lab = AllocPool("10.1.0.0/16", self.files["10.1.0.0/16"], "lab.txt")
+        self.pools = AllocPools(self.default_pool, [self.lab])
+        self.services = {pool: AllocService(pool.get_alloc_file(), threading.Lock(), LEASE_TIME, 0)
+                for pool in self.pools.get_pools()}
+        self.service = PooledAllocService(self.pools, self.services)
+        self.engines = []
+
+    def tearDown(self):
+        for service in self.services.values():
+            service.close()
+        for engine in self.engines:
+            engine.get_store().close()
+        self.dir.cleanup()
+
+    """
+    A new engine for the allocation file at path, to check what the
+    services have written; its store is closed when the test ends.
+    """
+    def open_engine(self, path):
+        engine = AllocEngine(path)
+        self.engines.append(engine)
+        return engine
+
+    def allocated_ips(self, pool):
+        return [acc.get_client_ip() for acc in self.open_engine(pool.get_alloc_file()).get_allocated_accounts()]
+
+    def test_routed(self):
+        self.assertIsNotNone(self.service.allocate("10.1.0.1", TEST_USERNAME))
+        self.assertIsNotNone(self.service.allocate("10.2.0.1", TEST_USERNAME))
+        self.assertEqual(self.allocated_ips(self.lab), ["10.1.0.1"])
+        self.assertEqual(self.allocated_ips(self.default_pool), ["10.2.0.1"])
+
+        self.assertTrue(self.service.renew("10.1.0.1"))
+        self.service.release("10.1.0.1")
+        self.assertEqual(self.allocated_ips(self.lab), [])
+        self.assertFalse(self.service.renew("10.1.0.1"))
+
+    def test_pool_runs_out(self):
+        self.service.allocate("10.1.0.1", TEST_USERNAME)
+        self.service.allocate("10.1.0.2", TEST_USERNAME)
+        self.assertIsNone(self.service.allocate("10.1.0.3", TEST_USERNAME))
+        self.assertIsNotNone(self.service.allocate("10.2.0.1", TEST_USERNAME))
+
+    def test_batch(self):
+        requests = [("10.2.0.1", TEST_USERNAME), ("10.1.0.1", TEST_USERNAME),
+                ("10.2.0.2", TEST_USERNAME), ("10.1.0.2", TEST_USERNAME), ("10.1.0.3", TEST_USERNAME)]
+        mc_accounts = self.service.allocate_batch(requests)
+        self.assertEqual([mc_account != None for mc_account in mc_accounts], [True, True, True, True, False])
+        self.assertEqual(sorted(self.allocated_ips(self.lab)), ["10.1.0.1", "10.1.0.2"])
+        self.assertEqual(sorted(self.allocated_ips(self.default_pool)), ["10.2.0.1", "10.2.0.2"])
+
+    def test_uuid(self):
+        # Each pool's file has its own uuid0 and uuid1
+        self.service.allocate_uuid("uuid1", "10.1.0.1", TEST_USERNAME)
+        self.assertEqual(self.allocated_ips(self.lab), ["10.1.0.1"])
+        self.assertEqual(self.allocated_ips(self.default_pool), [])
+        with self.assertRaises(ValueError):
+            self.service.allocate_uuid("uuid5", "10.1.0.1", TEST_USERNAME)
+
+        self.service.release_uuid("uuid1")
+        self.assertEqual(self.allocated_ips(self.lab), [])
+
+    def test_locks_apart(self):
+        # A pool whose lock is held doesn't hold up another
+        with self.services[self.lab].get_lock():
+            self.assertIsNotNone(self.service.allocate("10.2.0.1", TEST_USERNAME))
+
+    def test_view(self):
+        self.service.allocate("10.1.0.1", TEST_USERNAME)
+        lab_engine = self.open_engine(self.files["10.1.0.0/16"])
+        self.assertEqual("".join(self.service.view_ip("10.1.0.1")), lab_engine.view_ip("10.1.0.1"))
+        self.assertEqual("".join(self.service.view_ip("10.2.0.1")).count("\n"), 1)
+        self.assertEqual("".join(self.service.view_uuid("uuid0")).count("\n"), 3)
+        self.assertEqual("".join(self.service.view()).split("\n# ")[1],
+                "{}\n{}".format(self.lab, lab_engine))
+
+    def test_view_without_lock(self):
+        # Views read the last commit, so an allocation
+        # holding the lock doesn't keep them waiting
+        self.service.allocate("10.1.0.1", TEST_USERNAME)
+        with self.services[self.lab].get_lock():
+            self.assertIn("10.1.0.1", "".join(self.service.view_ip("10.1.0.1")))
+
+    def test_missing_service(self):
+        with self.assertRaises(ValueError):
+            PooledAllocService(self.pools, {self.default_pool: self.services[self.default_pool]})
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import os
+import tempfile
+import threading
+import unittest
+
+from nydus.server.ControlSocket import *
+from nydus.server.AllocService import AllocService
+from nydus.common.ReadSnapshot import ROWS_PER_PART
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME
+
+LEASE_TIME = 60
+
+NUM_ACCOUNTS = ROWS_PER_PART * 3 + 1
+
+class TestControlSocket(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        alloc_file = os.path.join(self.dir.name, "alloc.csv")
+        make_alloc_file(alloc_file, NUM_ACCOUNTS)
+        self.service = AllocService(alloc_file, threading.Lock(), LEASE_TIME, 0)
+        self.server = ControlServer(self.service, os.path.join(self.dir.name, "control"))
+        self.client = ControlClient(self.server.get_path())
+        self.threads = []
+
+    def tearDown(self):
+        for thread in self.threads:
+            thread.join()
+        self.server.close_listener()
+        self.service.close()
+        self.dir.cleanup()
+
+    """
+    Has the server answer the next num_connections connections.
+    """
+    def serve(self, num_connections=1):
+        def accept():
+            for n in range(num_connections):
+                conn, _ = self.server.sock.accept()
+                self.server.handle_connection(conn)
+        thread = threading.Thread(target=accept)
+        thread.start()
+        self.threads.append(thread)
+
+    def test_call(self):
+        self.serve(2)
+        self.assertIsNotNone(self.client.allocate("10.0.0.1", TEST_USERNAME))
+        with self.assertRaises(ControlError):
+            self.client.allocate_uuid("uuid0", "not an address", TEST_USERNAME)
+
+    def test_view_in_parts(self):
+        self.serve()
+        parts = list(self.client.view())
+        self.assertEqual("".join(parts), "".join(self.service.view()))
+        self.assertEqual(len(parts), 5)
+        self.assertEqual("".join(parts).count("\n"), NUM_ACCOUNTS + 1)
+
+    def test_view_ip(self):
+        self.serve(2)
+        self.client.allocate("10.0.0.1", TEST_USERNAME)
+        self.assertEqual("".join(self.client.view_ip("10.0.0.1")), "".join(self.service.view_ip("10.0.0.1")))
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+
+import time
+import threading
+import unittest
+
+from nydus.server.GroupCommit import *
+
+"""
+Stands in for an AllocEngine. Changes are just numbers,
+and commits take a while, like an fsync.
+"""
+class FakeEngine:
+
+    def __init__(self, commit_time=0):
+        self.commit_time = commit_time
+        self.pending = []
+        self.committed = []
+        self.commits = 0
+        self.failures = 0
+
+    def change(self, n):
+        self.pending.append(n)
+
+    def take_changes(self):
+        changes = self.pending
+        self.pending = []
+        return changes
+
+    def commit_changes(self, changes):
+        time.sleep(self.commit_time)
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError("Disk full")
+        self.committed += changes
+        self.commits += 1
+
+    def restore_changes(self, changes):
+        self.pending = changes + self.pending
+
+class TestGroupCommit(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+
+    def change(self, group_commit, engine, n):
+        with self.lock:
+            engine.change(n)
+            commit = group_commit.changed()
+        group_commit.wait_durable(commit)
+
+    def test_bad_window(self):
+        with self.assertRaises(ValueError):
+            GroupCommit(FakeEngine(), self.lock, -1)
+
+    def test_one(self):
+        engine = FakeEngine()
+        group_commit = GroupCommit(engine, self.lock)
+        self.change(group_commit, engine, 1)
+        self.assertEqual(engine.committed, [1])
+
+    def test_durable_on_return(self):
+        engine = FakeEngine(0.01)
+        group_commit = GroupCommit(engine, self.lock)
+        threads = [threading.Thread(target=self.change, args=(group_commit, engine, n)) for n in range(20)]
+        for thread in threads:
+            thread.start()
+
+        for n, thread in enumerate(threads):
+            thread.join()
+            self.assertIn(n, engine.committed)
+
+    def test_grouped(self):
+        engine = FakeEngine(0.05)
+        group_commit = GroupCommit(engine, self.lock)
+        threads = [threading.Thread(target=self.change, args=(group_commit, engine, n)) for n in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(engine.committed), list(range(20)))
+        self.assertLess(engine.commits, 20)
+
+    def test_failed_write(self):
+        engine = FakeEngine()
+        engine.failures = 1
+        group_commit = GroupCommit(engine, self.lock)
+        with self.assertRaises(OSError):
+            self.change(group_commit, engine, 1)
+        self.assertEqual(engine.committed, [])
+
+        # The next commit writes the change the failed one didn't
+        self.change(group_commit, engine, 2)
+        self.assertEqual(engine.committed, [1, 2])
+
+    def test_failed_write_lock_order(self):
+        engine = FakeEngine(0.1)
+        engine.failures = 1
+        group_commit = GroupCommit(engine, self.lock)
+        errors = []
+        def failing_change():
+            try:
+                self.change(group_commit, engine, 1)
+            except OSError as e:
+                errors.append(e)
+        thread = threading.Thread(target=failing_change)
+        thread.start()
+        time.sleep(0.03)
+
+        # As a compaction does, while the write that's about to fail is
+        # under way; the failed write must still be able to finish
+        with self.lock:
+            got_write_lock = group_commit.get_write_lock().acquire(timeout=2)
+            if got_write_lock:
+                group_commit.get_write_lock().release()
+        thread.join(2)
+        self.assertTrue(got_write_lock)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(engine.pending, [1])
+
+    def test_nothing_changed(self):
+        engine = FakeEngine()
+        group_commit = GroupCommit(engine, self.lock)
+        with self.lock:
+            commit = group_commit.changed()
+        group_commit.wait_durable(commit)
+        self.assertEqual(engine.committed, [])
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+import unittest
+
+from nydus.server.LeaseTable import *
+
+"""
+A LeaseTable whose clock only moves when told to.
+"""
+class StoppedClockLeaseTable(LeaseTable):
+
+    def __init__(self, lease_time):
+        self.clock = 1000.0
+        super().__init__(lease_time)
+
+    def now(self):
+        return self.clock
+
+class TestLeaseTable(unittest.TestCase):
+
+    def setUp(self):
+        self.table = StoppedClockLeaseTable(10)
+
+    def test_bad_lease_time(self):
+        with self.assertRaises(ValueError):
+            LeaseTable(0)
+
+    def test_not_expired(self):
+        self.table.grant("10.0.0.1")
+        self.table.clock += 9
+        self.assertEqual(self.table.take_expired(), [])
+        self.assertTrue(self.table.has_lease("10.0.0.1"))
+
+    def test_expired(self):
+        self.table.grant("10.0.0.1")
+        self.table.clock += 10
+        self.assertEqual(self.table.take_expired(), ["10.0.0.1"])
+        self.assertFalse(self.table.has_lease("10.0.0.1"))
+
+    def test_expiry_order(self):
+        self.table.grant("10.0.0.1", 30)
+        self.table.grant("10.0.0.2", 20)
+        self.table.grant("10.0.0.3")
+        self.table.clock += 25
+        self.assertEqual(self.table.take_expired(), ["10.0.0.3", "10.0.0.2"])
+        self.assertEqual(self.table.num_leases(), 1)
+
+    def test_renew(self):
+        self.table.grant("10.0.0.1")
+        self.table.clock += 8
+        self.assertTrue(self.table.renew("10.0.0.1"))
+        self.table.clock += 8
+        self.assertEqual(self.table.take_expired(), [])
+        self.table.clock += 2
+        self.assertEqual(self.table.take_expired(), ["10.0.0.1"])
+
+    def test_renew_never_shortens(self):
+        self.table.grant("10.0.0.1", 100)
+        self.assertTrue(self.table.renew("10.0.0.1"))
+        self.table.clock += 50
+        self.assertEqual(self.table.take_expired(), [])
+
+    def test_renew_unknown(self):
+        self.assertFalse(self.table.renew("10.0.0.1"))
+
+    def test_renew_after_expiry(self):
+        self.table.grant("10.0.0.1")
+        self.table.clock += 10
+        self.table.take_expired()
+        self.assertFalse(self.table.renew("10.0.0.1"))
+
+    def test_revoke(self):
+        self.table.grant("10.0.0.1")
+        self.table.revoke("10.0.0.1")
+        self.table.clock += 10
+        self.assertEqual(self.table.take_expired(), [])
+
+    def test_regrant(self):
+        self.table.grant("10.0.0.1")
+        self.table.revoke("10.0.0.1")
+        self.table.clock += 5
+        self.table.grant("10.0.0.1")
+        self.table.clock += 6
+        self.assertEqual(self.table.take_expired(), [])
+        self.table.clock += 4
+        self.assertEqual(self.table.take_expired(), ["10.0.0.1"])
+
+    def test_compaction(self):
+        self.table.grant("10.0.0.1")
+        for i in range(3 * COMPACT_THRESHOLD):
+            self.table.clock += 1
+            self.table.renew("10.0.0.1")
+        self.assertLessEqual(len(self.table.heap), 2 + COMPACT_THRESHOLD)
+        self.table.clock += 10
+        self.assertEqual(self.table.take_expired(), ["10.0.0.1"])
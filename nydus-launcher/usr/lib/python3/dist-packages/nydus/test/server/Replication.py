@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+
+import io
+import os
+import ssl
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import unittest
+import contextlib
+
+from nydus.server.Replication import *
+from nydus.server.AllocService import AllocService
+from nydus.common.allocater import AllocEngine
+from nydus.common.AllocStore import ALLOC_FIELDS
+from nydus.test.common.AllocJournal import make_alloc_file, TEST_USERNAME
+
+LEASE_TIME = 60
+
+REPLICATION_IP = "127.0.0.1"
+
+# Seconds to wait for a change to reach the standby
+REPLICATION_WAIT = 5
+
+"""
+Writes a CA, and a certificate for REPLICATION_IP signed by it,
+into directory. Returns (cert_file, cert_privkey, ca_chain).
+"""
+def make_certs(directory):
+    ca_key = os.path.join(directory, "ca.key")
+    ca_cert = os.path.join(directory, "ca.crt")
+    key = os.path.join(directory, "server.key")
+    csr = os.path.join(directory, "server.csr")
+    cert = os.path.join(directory, "server.crt")
+    ext = os.path.join(directory, "server.ext")
+    with open(ext, "w") as f:
+        f.write("subjectAltName=IP:{}\n".format(REPLICATION_IP))
+
+    commands = [
+        ["req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", ca_key,
+            "-out", ca_cert, "-subj", "/CN=Nydus Test CA", "-days", "1"],
+        ["req", "-newkey", "rsa:2048", "-nodes", "-keyout", key,
+            "-out", csr, "-subj", "/CN={}".format(REPLICATION_IP)],
+        ["x509", "-req", "-in", csr, "-CA", ca_cert, "-CAkey", ca_key,
+            "-CAcreateserial", "-out", cert, "-days", "1", "-extfile", ext],
+    ]
+    for command in commands:
+        subprocess.run(["openssl"] + command, check=True, capture_output=True)
+    return (cert, key, ca_cert)
+
+"""
+Waits for condition() to be true, failing the test
+with message if it takes too long.
+"""
+def wait_until(test, condition, message="Change didn't reach the standby"):
+    deadline = time.monotonic() + REPLICATION_WAIT
+    while not condition():
+        if time.monotonic() > deadline:
+            test.fail(message)
+        time.sleep(0.01)
+
+"""
+Sets up a primary's allocation file and an empty one for a standby,
+and closes the files of the engines and services a test opens
+with open_engine and open_service when it ends.
+"""
+class ReplicationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.primary_file = os.path.join(self.dir.name, "primary.csv")
+        self.standby_file = os.path.join(self.dir.name, "standby.csv")
+        make_alloc_file(self.primary_file, 3)
+        open(self.standby_file, "w").close()
+        self.opened = []
+
+    def tearDown(self):
+        for close in self.opened:
+            close()
+        self.dir.cleanup()
+
+    def open_engine(self, path):
+        engine = AllocEngine(path)
+        self.opened.append(engine.get_store().close)
+        return engine
+
+    def open_service(self, path, standby=False):
+        service = AllocService(path, threading.Lock(), LEASE_TIME, 0, standby=standby)
+        self.opened.append(service.close)
+        return service
+
+class TestReplicateEngine(ReplicationTestCase):
+
+    """
+    A standby engine with a copy of every account in primary.
+    """
+    def copy_engine(self, primary):
+        standby = self.open_engine(self.standby_file)
+        standby.replicate([(row, acc.to_fields()) for row, acc in enumerate(primary.get_accounts())])
+        return standby
+
+    def test_copy(self):
+        primary = self.open_engine(self.primary_file)
+        standby = self.copy_engine(primary)
+        self.assertEqual(str(standby), str(primary))
+        self.assertEqual(str(self.open_engine(self.standby_file)), str(primary))
+
+    def test_commits(self):
+        primary = self.open_engine(self.primary_file)
+        standby = self.copy_engine(primary)
+        commits = []
+        primary.add_commit_listener(commits.append)
+
+        primary.allocate_one_account("10.0.0.1", TEST_USERNAME)
+        primary.allocate_one_account("10.0.0.2", TEST_USERNAME)
+        primary.release_account_ip("10.0.0.1")
+        self.assertEqual(len(commits), 3)
+        self.assertEqual(len(commits[0][0][1]), len(ALLOC_FIELDS))
+
+        for changes in commits:
+            standby.replicate(changes)
+        self.assertEqual(str(standby), str(primary))
+        self.assertEqual(standby.get_accounts_ip("10.0.0.2")[0].get_mc_uuid(), "uuid1")
+        self.assertEqual(standby.get_accounts_ip("10.0.0.1"), [])
+
+        # Which a later allocation on the standby takes into account
+        acc = standby.allocate_one_account("10.0.0.3", TEST_USERNAME)
+        self.assertEqual(acc.get_mc_uuid(), "uuid2")
+
+        primary.remove_commit_listener(commits.append)
+        primary.allocate_one_account("10.0.0.4", TEST_USERNAME)
+        self.assertEqual(len(commits), 3)
+
+    def test_unchanged_not_written(self):
+        primary = self.open_engine(self.primary_file)
+        standby = self.copy_engine(primary)
+        standby.set_autocommit(False)
+        standby.replicate([(row, acc.to_fields()) for row, acc in enumerate(primary.get_accounts())])
+        self.assertEqual(standby.take_changes(), [])
+
+    def test_uuid_changed(self):
+        primary = self.open_engine(self.primary_file)
+        standby = self.copy_engine(primary)
+        tokens = primary.get_accounts()[2].token_field_values()
+        standby.replicate([(0, tokens)])
+        self.assertEqual(len(standby.get_accounts_uuid("uuid2")), 2)
+        self.assertEqual(standby.get_accounts_uuid("uuid0"), [])
+
+    def test_past_end(self):
+        primary = self.open_engine(self.primary_file)
+        standby = self.open_engine(self.standby_file)
+        with self.assertRaises(ValueError):
+            standby.replicate([(1, primary.get_accounts()[1].to_fields())])
+
+    def test_bad_fields(self):
+        standby = self.copy_engine(self.open_engine(self.primary_file))
+        with self.assertRaises(ValueError):
+            standby.replicate([(0, ["10.0.0.1", TEST_USERNAME])])
+
+
+class TestChangeFeed(unittest.TestCase):
+
+    def test_take(self):
+        feed = ChangeFeed()
+        self.assertEqual(feed.take(0), [])
+        feed.add([(0, ["a"])])
+        feed.add([(1, ["b"]), (2, ["c"])])
+        self.assertEqual(feed.take(0), [(0, ["a"]), (1, ["b"]), (2, ["c"])])
+
+    def test_overflow(self):
+        feed = ChangeFeed()
+        for n in range(MAX_QUEUED_COMMITS + 1):
+            feed.add([(n, ["a"])])
+        with self.assertRaises(ProtocolError):
+            feed.take(0)
+
+    def test_split(self):
+        changes = [(n, ["a"]) for n in range(ROWS_PER_FRAME + 1)]
+        self.assertEqual([len(part) for part in split_changes(changes)], [ROWS_PER_FRAME, 1])
+        self.assertEqual(split_changes([]), [])
+
+
+class TestStandbyService(ReplicationTestCase):
+
+    def make_services(self):
+        primary = self.open_service(self.primary_file)
+        standby = self.open_service(self.standby_file, True)
+        return primary, standby
+
+    def test_subscribe(self):
+        primary, standby = self.make_services()
+        feed = ChangeFeed()
+        rows = primary.subscribe(feed.add)
+        standby.replicate(list(enumerate(rows)))
+        self.assertEqual(standby.num_accounts(), 3)
+
+        primary.allocate("10.0.0.1", TEST_USERNAME)
+        standby.replicate(feed.take(0))
+        primary.unsubscribe(feed.add)
+        primary.allocate("10.0.0.2", TEST_USERNAME)
+        self.assertEqual(feed.take(0), [])
+
+        standby_accounts = self.open_engine(self.standby_file).get_accounts()
+        primary_accounts = self.open_engine(self.primary_file).get_accounts()
+        self.assertEqual(str(standby_accounts[0]), str(primary_accounts[0]))
+        self.assertFalse(standby_accounts[1].is_allocated())
+
+    def test_promote(self):
+        primary, standby = self.make_services()
+        primary.allocate("10.0.0.1", TEST_USERNAME)
+        standby.replicate(list(enumerate(primary.subscribe(lambda changes: None))))
+
+        self.assertTrue(standby.is_standby())
+        self.assertFalse(standby.get_leases().has_lease("10.0.0.1"))
+        self.assertTrue(standby.promote())
+        self.assertFalse(standby.is_standby())
+        standby.wait_promoted()
+
+        # Allocations carried over keep their leases
+        self.assertTrue(standby.get_leases().has_lease("10.0.0.1"))
+        self.assertFalse(standby.promote())
+        with self.assertRaises(ValueError):
+            standby.replicate([])
+
+        # And it allocates as the primary would have
+        self.assertEqual(standby.allocate("10.0.0.2", TEST_USERNAME).get_uuid(), "uuid1")
+
+
+@unittest.skipUnless(shutil.which("openssl"), "needs openssl to make certificates")
+class TestReplicationLoopback(ReplicationTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.certs = make_certs(self.dir.name)
+
+    def start_standby(self, publisher, service):
+        port = publisher.get_address()[1]
+        replica = StandbyReplica(service, make_standby_context(*self.certs), REPLICATION_IP, port)
+        service.set_replica(replica)
+        threading.Thread(target=replica.run, daemon=True).start()
+        return replica
+
+    def test_follow_and_promote(self):
+        primary = self.open_service(self.primary_file)
+        publisher = ReplicationPublisher(primary, make_publisher_context(*self.certs), REPLICATION_IP, 0)
+        threading.Thread(target=publisher.serve_forever, daemon=True).start()
+
+        standby = self.open_service(self.standby_file, True)
+        replica = self.start_standby(publisher, standby)
+        self.assertTrue(replica.wait_synced(REPLICATION_WAIT))
+        self.assertEqual(standby.num_accounts(), 3)
+
+        primary.allocate("10.0.0.1", TEST_USERNAME)
+        wait_until(self, lambda: str(self.open_engine(self.standby_file)) == str(self.open_engine(self.primary_file)))
+
+        self.assertTrue(standby.promote())
+
+        # Changes on the old primary no longer reach it
+        primary.allocate("10.0.0.2", TEST_USERNAME)
+        self.assertEqual(standby.allocate("10.0.0.3", TEST_USERNAME).get_uuid(), "uuid1")
+
+    def test_untrusted_standby(self):
+        primary = self.open_service(self.primary_file)
+        publisher = ReplicationPublisher(primary, make_publisher_context(*self.certs), REPLICATION_IP, 0)
+        threading.Thread(target=publisher.serve_forever, daemon=True).start()
+
+        # A standby with no certificate of its own is turned away
+        standby = self.open_service(self.standby_file, True)
+        context = ssl.create_default_context(cafile=self.certs[2])
+        replica = StandbyReplica(standby, context, REPLICATION_IP, publisher.get_address()[1])
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises((ssl.SSLError, OSError, ProtocolError)):
+                replica.follow()
+            # The primary says why, on its own thread
+            wait_until(self, lambda: "failed the TLS handshake" in output.getvalue(),
+                    "Primary didn't report the failed handshake")
+        self.assertEqual(standby.num_accounts(), 0)
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+
+import time
+import threading
+import unittest
+
+from nydus.server.SingleFlight import *
+
+class TestSingleFlight(unittest.TestCase):
+
+    def setUp(self):
+        self.flight = SingleFlight()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def slow(self, value):
+        self.calls += 1
+        self.release.wait()
+        return value
+
+    def fail(self):
+        self.calls += 1
+        self.release.wait()
+        raise ValueError("failed")
+
+    """
+    Starts callers which all call do with the same key, gives
+    them time to all get there, then lets the call finish.
+    Returns what each caller got back or raised.
+    """
+    def run_callers(self, count, function, *args):
+        results = []
+
+        def caller():
+            try:
+                results.append(self.flight.do("key", function, *args))
+            except ValueError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=caller) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_single(self):
+        self.release.set()
+        self.assertEqual(self.flight.do("key", self.slow, 5), 5)
+        self.assertEqual(self.flight.num_in_flight(), 0)
+
+    def test_shared(self):
+        results = self.run_callers(4, self.slow, 7)
+        self.assertEqual(results, [7, 7, 7, 7])
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.flight.num_in_flight(), 0)
+
+    def test_error_shared(self):
+        results = self.run_callers(3, self.fail)
+        self.assertEqual(len(results), 3)
+        for result in results:
+            self.assertIsInstance(result, ValueError)
+        self.assertEqual(self.calls, 1)
+
+    def test_different_keys(self):
+        self.release.set()
+        self.assertEqual(self.flight.do("a", self.slow, 1), 1)
+        self.assertEqual(self.flight.do("b", self.slow, 2), 2)
+        self.assertEqual(self.calls, 2)
+
+    def test_sequential_not_shared(self):
+        self.release.set()
+        self.flight.do("key", self.slow, 1)
+        self.assertEqual(self.flight.do("key", self.slow, 2), 2)
+        self.assertEqual(self.calls, 2)